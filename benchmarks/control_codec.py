@@ -0,0 +1,59 @@
+# Compares encoding and decoding of control messages as "\b/" strings and as bin1 binary frames
+# "legacy" is the string parsing the server used before src.control: decode, split on spaces and join the rest again
+# Run from the repository root: python -m benchmarks.control_codec [iterations]
+import sys
+import time
+
+from src.control import decode_binary, decode_text, encode_binary, encode_text
+
+MESSAGES = [
+    ("ack", ("ack", 48213)),
+    ("ping", ("ping", time.perf_counter_ns())),
+    ("nick", ("nick", "office pc")),
+    ("chat 16 B", ("seq", 48214, ("chat", "9f86d081884c7d65", 6, "office-pc", "see you at lunch"))),
+    ("chat 1 KiB", ("seq", 48215, ("chat", "9f86d081884c7d65", 6, "office-pc", "x" * 1024))),
+]
+
+
+# The removed parser of the server | Nested messages of \b/seq were encoded again and parsed a second time
+def legacy_decode(data):
+    command = data.decode(errors='replace').split(" ")
+    args = " ".join(command[1:])
+    if command[0] == "\b/seq":
+        seq, _sep, msg = args.partition(' ')
+        return int(seq), legacy_decode(msg.encode())
+    if command[0] == "\b/chat":
+        return args.split(' ', 3)
+    return args
+
+
+# Method to get the time of one call in nanoseconds | The fastest of a few runs is the least disturbed by other processes
+def measure(function, argument, iterations, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            function(argument)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / iterations
+
+
+def run(iterations=50000):
+    print(f"{'message':<12} {'format':<7} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+    for label, message in MESSAGES:
+        text, binary = encode_text(message), encode_binary(message)
+        if decode_text(text) != message or decode_binary(binary) != message:
+            raise AssertionError(f"{label} did not survive encoding")
+        for name, size, encode_time, decode_time in (
+                ("legacy", len(text), measure(encode_text, message, iterations),
+                 measure(legacy_decode, text, iterations)),
+                ("text", len(text), measure(encode_text, message, iterations),
+                 measure(decode_text, text, iterations)),
+                ("bin1", len(binary), measure(encode_binary, message, iterations),
+                 measure(decode_binary, binary, iterations))):
+            print(f"{label:<12} {name:<7} {size:>6} {encode_time:>10.0f} {decode_time:>10.0f}")
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
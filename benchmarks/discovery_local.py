@@ -0,0 +1,127 @@
+# Runs chat nodes and bare discovery instances on loopback multicast and checks the LAN directory
+# Nodes: they find each other, /connect <nickname> connects from the directory and a stopped node leaves it at once
+# Segment: hundreds of instances with timers shortened by --speedup, the announcements per second of all of them
+# together are measured once they know each other, and the packets a joining instance causes
+# Exits with status 1 if a check fails or the segment sends more than the rate limit allows
+# Run from the repository root: python -m benchmarks.discovery_local [--nodes 5] [--instances 200] [--speedup 10]
+import argparse
+import sys
+import time
+
+import src.discovery as discovery
+from benchmarks.loopback import wait_for
+from benchmarks.stub import StubChatApp
+
+BASE_PORT = 26600
+NODE_DISCOVERY_PORT = 26700  # Not the default port, instances on the LAN must not hear the benchmark
+SEGMENT_DISCOVERY_PORT = 26701
+
+
+def check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+    return condition
+
+
+def run_nodes(count):
+    start = time.perf_counter()
+    nodes = [StubChatApp(BASE_PORT + number, discovery_port=NODE_DISCOVERY_PORT) for number in range(count)]
+    passed = True
+    try:
+        found = wait_for(lambda: all(len(node.discovery.entries()) == count - 1 for node in nodes), 10)
+        passed = check(found, "the nodes did not discover each other") and passed
+        print(f"nodes    {count} nodes discovered each other in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        first, second = nodes[0], nodes[1]
+        start = time.perf_counter()
+        first.connect(second.nickname)
+        connected = wait_for(lambda: second.sessions.by_nickname(first.nickname) is not None
+                             and first.client.is_connected, 5)
+        passed = check(connected, "/connect <nickname> did not connect") and passed
+        print(f"nodes    /connect {second.nickname} connected in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        second.set_nickname(["renamed"])
+        renamed = wait_for(lambda: first.discovery.find("renamed") is not None, 3)
+        passed = check(renamed, "the new nickname was not announced") and passed
+
+        last = nodes.pop()
+        last.stop()
+        left = wait_for(lambda: all(len(node.discovery.entries()) == count - 2 for node in nodes), 2)
+        passed = check(left, "a stopped node stayed in the directories") and passed
+    finally:
+        for node in nodes:
+            node.stop()
+    return passed
+
+
+def sent(instances):
+    return sum(instance.sent for instance in instances)
+
+
+def run_segment(count, speedup):
+    # Shorter timers, the rate limit grows by the same factor
+    discovery.ANNOUNCE_INTERVAL /= speedup
+    discovery.MIN_ANNOUNCE_GAP /= speedup
+    discovery.ANSWER_DELAY /= speedup
+    discovery.SEGMENT_RATE *= speedup
+
+    instances = []
+    passed = True
+    try:
+        start = time.perf_counter()
+        for number in range(count):
+            instance = discovery.Discovery(f"peer{number}", BASE_PORT + number, ["framed"], SEGMENT_DISCOVERY_PORT,
+                                           "127.0.0.1")
+            instance.open()
+            instance.start()
+            instances.append(instance)
+        found = wait_for(lambda: all(len(instance.entries()) == count - 1 for instance in instances), 60)
+        passed = check(found, "the instances did not discover each other") and passed
+        print(f"segment  {count} instances discovered each other in {time.perf_counter() - start:.1f} s, "
+              f"{sent(instances)} packets")
+
+        interval = instances[0].interval
+        time.sleep(interval)  # Answers and announcements of the start are over
+        before, start = sent(instances), time.perf_counter()
+        time.sleep(interval * 3)
+        rate = (sent(instances) - before) / (time.perf_counter() - start)
+        print(f"segment  steady {rate:.1f} packets/s, limit {discovery.SEGMENT_RATE:.0f}/s, "
+              f"interval {interval:.1f} s (without the limit {count / discovery.ANNOUNCE_INTERVAL:.1f} packets/s)")
+        passed = check(rate <= discovery.SEGMENT_RATE * 1.1, "the segment exceeded the rate limit") and passed
+
+        window = discovery.ANSWER_DELAY * 2 + discovery.TICK * 2
+        before, start = sent(instances), time.perf_counter()
+        joining = discovery.Discovery("joining", BASE_PORT + count, ["framed"], SEGMENT_DISCOVERY_PORT, "127.0.0.1")
+        joining.open()
+        joining.start()
+        instances.append(joining)
+        time.sleep(window)
+        caused = sent(instances) - before - rate * window
+        known = len(joining.entries())
+        print(f"segment  a joining instance caused about {max(caused, 0):.0f} packets and heard {known} peers "
+              f"in {window:.2f} s")
+        passed = check(caused <= discovery.QUERY_ANSWERS * 3, "a join caused too many answers") and passed
+        found = wait_for(lambda: len(joining.entries()) == count, interval * 2)
+        passed = check(found, "the joining instance did not hear every peer") and passed
+        print(f"segment  the joining instance knew all {count} peers after {time.perf_counter() - start:.1f} s")
+    finally:
+        for instance in instances:  # All threads end together instead of one after another in stop()
+            instance.stopped = True
+        for instance in instances:
+            instance.stop()
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--speedup', type=float, default=10, help="factor the discovery timers are shortened by")
+    args = parser.parse_args()
+    passed = run_nodes(args.nodes)
+    passed = run_segment(args.instances, args.speedup) and passed
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Sends a file between two in-process nodes on loopback with /send and reports the transfer speed
+# Hashing the file before the first chunk is reported separately from the transfer itself
+# Run from the repository root: python -m benchmarks.file_transfer [size in MB] [transport]
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.stub import StubChatApp
+
+BASE_PORT = 47500
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def run(size_mb=1024, transport="threads"):
+    directory = Path(tempfile.mkdtemp(prefix="p2p-chat-transfer-"))
+    try:
+        path = directory / "payload.bin"
+        block = os.urandom(BLOCK_SIZE)
+        with open(path, 'wb') as file:
+            remaining = size_mb * 1024 * 1024
+            while remaining:
+                remaining -= file.write(block[:remaining])
+
+        sender = StubChatApp(BASE_PORT, transport=transport)
+        receiver = StubChatApp(BASE_PORT + 1, transport=transport)
+        receiver.download_dir = directory / "downloads"
+        time.sleep(0.2)
+        sender.client.conn(['127.0.0.1', receiver.port])
+        deadline = time.time() + 5
+        while not sender.client.is_connected and time.time() < deadline:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        sender.input(f"/send {path}")
+        transfer = sender.transfers[0]
+        while transfer.source.digest is None:
+            time.sleep(0.001)
+        hashed = time.perf_counter()
+        transfer.join()
+        done = time.perf_counter()
+
+        received = receiver.download_dir / path.name
+        ok = received.exists() and received.stat().st_size == path.stat().st_size
+        sender.stop()
+        receiver.stop()
+
+        print(f"size: {size_mb} MB | transport: {transport} | complete: {ok}")
+        print(f"hashing: {hashed - start:.2f} s ({size_mb / (hashed - start):.0f} MB/s)")
+        print(f"transfer: {done - hashed:.2f} s ({size_mb / (done - hashed):.0f} MB/s)")
+        print(f"total: {done - start:.2f} s ({size_mb / (done - start):.0f} MB/s)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(*[int(arg) for arg in args[:1]], *args[1:2])
@@ -0,0 +1,52 @@
+# Pushes 100k framed messages over loopback and checks that every message arrives intact and in order
+# Run from the repository root: python -m benchmarks.framing_throughput [message count] [payload size]
+import socket
+import sys
+import threading
+import time
+
+from src.protocol import FrameReader, encode_frame
+
+
+def run(count=100000, size=64):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    port = listener.getsockname()[1]
+
+    received = []
+
+    def receive():
+        conn, _addr = listener.accept()
+        reader = FrameReader()
+        while len(received) < count:
+            messages = reader.recv(conn)
+            if messages is None:
+                break
+            received.extend(messages)
+        conn.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    sender = socket.create_connection(('127.0.0.1', port))
+    payloads = [(str(i) + ' ').encode().ljust(size, b'x') for i in range(count)]
+
+    start = time.perf_counter()
+    for payload in payloads:
+        sender.sendall(encode_frame(payload))
+    receiver.join()
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    listener.close()
+
+    if received != payloads:
+        raise AssertionError(f"Received {len(received)} of {count} messages or messages were corrupted")
+
+    print(f"{count} messages of {size} bytes in {elapsed:.3f}s | "
+          f"{count / elapsed:,.0f} msg/s | {count * size / elapsed / 1024 / 1024:.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
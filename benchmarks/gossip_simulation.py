@@ -0,0 +1,66 @@
+# Spins up N in-process nodes on loopback, connects them into a sparse mesh and lets every node send messages
+# Reports delivery ratio, delivery latency and how many forwards were redundant
+# Run from the repository root: python -m benchmarks.gossip_simulation [nodes] [links per node] [messages per node]
+import random
+import statistics
+import sys
+import time
+
+from benchmarks.stub import StubChatApp
+
+BASE_PORT = 47000
+
+
+def connect(a, b):
+    a.client.conn(['127.0.0.1', b.port])
+    b.client.conn(['127.0.0.1', a.port])
+
+
+def run(node_count=20, links=2, messages=5, transport="threads", seed=1):
+    random.seed(seed)
+    nodes = [StubChatApp(BASE_PORT + i, transport=transport) for i in range(node_count)]
+    time.sleep(0.2)
+
+    # A ring keeps the mesh connected, random chords shorten the paths
+    edges = {tuple(sorted((i, (i + 1) % node_count))) for i in range(node_count)}
+    while len(edges) < node_count * links:
+        a, b = random.sample(range(node_count), 2)
+        edges.add(tuple(sorted((a, b))))
+    for a, b in edges:
+        connect(nodes[a], nodes[b])
+
+    deadline = time.time() + 10  # The asyncio transport connects in the background
+    while sum(len(node.sessions.connected()) for node in nodes) < len(edges) * 2 and time.time() < deadline:
+        time.sleep(0.05)
+
+    sent = {}  # Message -> time it was sent
+    for round_number in range(messages):
+        for node in nodes:
+            msg = f"{node.nickname}-{round_number}"
+            sent[msg] = time.perf_counter()
+            node.client.broadcast(msg)
+
+    expected = len(sent) * (node_count - 1)
+    deadline = time.time() + 10
+    while sum(len(node.received) for node in nodes) < expected and time.time() < deadline:
+        time.sleep(0.05)
+
+    latencies = [(received - sent[msg]) * 1000 for node in nodes for received, _origin, msg in node.received]
+    forwarded = sum(node.relay.forwarded for node in nodes)
+    duplicates = sum(node.relay.duplicates for node in nodes)
+
+    for node in nodes:
+        node.stop()
+
+    latencies.sort()
+    print(f"nodes: {node_count} | links: {len(edges)} | messages: {len(sent)} | transport: {transport}")
+    print(f"delivered: {len(latencies)}/{expected} ({len(latencies) / expected:.1%})")
+    if latencies:
+        print(f"latency ms | p50: {statistics.median(latencies):.2f} | "
+              f"p99: {latencies[int(len(latencies) * 0.99) - 1]:.2f} | max: {latencies[-1]:.2f}")
+    print(f"forwards: {forwarded} | redundant: {duplicates} ({duplicates / max(forwarded, 1):.1%} of forwards)")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(*[int(arg) for arg in args[:3]], *args[3:4])
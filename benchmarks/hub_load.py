@@ -0,0 +1,112 @@
+# Load generator for hub mode | Opens many raw peer connections to a hub and measures how many messages it delivers
+# Every client sends chat messages at a fixed rate and counts the chat messages the hub sends back to it
+# Start a hub first (python run.py --hub --port 3333), then run from the repository root:
+# python -m benchmarks.hub_load [--clients 1000] [--processes 4] [--rate 1] [--duration 10]
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import time
+
+from src.control import BINARY, decode_binary, encode_binary
+from src.protocol import FrameReader, RECV_SIZE, build_init, encode_frame, parse_init_ack, split_init_ack
+from src.relay import new_message_id
+
+CAPABILITIES = ["framed", "relay", BINARY]  # No heartbeat and seq, every client would cost the hub a timer and a stream
+
+
+# Coroutine of one client | Returns the number of messages sent and received
+async def run_client(host, port, number, rate, deadline, connected):
+    reader, writer = await asyncio.open_connection(host, port)
+    nickname = f"load-{number}"
+    writer.write(build_init(nickname, "127.0.0.1", 40000 + number % 20000, CAPABILITIES))
+    data = b""
+    while split_init_ack(data) is None:  # Room frames may follow the ack in the same read
+        received = await reader.read(RECV_SIZE)
+        if not received:
+            raise ConnectionError(f"{nickname} got no init acknowledgement")
+        data += received
+    ack, rest = split_init_ack(data)
+    capabilities, _nickname = parse_init_ack(ack)
+    if "framed" not in capabilities:
+        raise ConnectionError(f"{nickname} got no framed connection")
+    connected.append(number)
+
+    counts = {"sent": 0, "received": 0}
+
+    async def receive():
+        frames = FrameReader()
+        data = rest
+        while True:
+            for frame in frames.feed(data):
+                if decode_binary(frame)[0] == "chat":
+                    counts["received"] += 1
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+
+    receiver = asyncio.get_running_loop().create_task(receive())
+    interval = 1 / rate
+    await asyncio.sleep(interval * (number % 100) / 100)  # Spread the clients over the interval
+    while time.monotonic() < deadline:
+        message = ("chat", new_message_id(), 0, nickname, f"message {counts['sent']} of {nickname}")
+        writer.write(encode_frame(encode_binary(message)))
+        counts["sent"] += 1
+        await asyncio.sleep(interval)
+    await asyncio.sleep(1)  # Messages still on their way
+    receiver.cancel()
+    writer.close()
+    return counts["sent"], counts["received"]
+
+
+async def run_clients(host, port, numbers, rate, duration):
+    connected = []
+    deadline = time.monotonic() + duration
+    results = await asyncio.gather(*[run_client(host, port, number, rate, deadline, connected) for number in numbers],
+                                   return_exceptions=True)
+    failed = sum(isinstance(result, BaseException) for result in results)
+    results = [result for result in results if not isinstance(result, BaseException)]
+    return sum(sent for sent, _ in results), sum(received for _, received in results), failed
+
+
+# Method run in every load process
+def run_process(host, port, numbers, rate, duration, results):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # One file descriptor per client
+    results.put(asyncio.run(run_clients(host, port, numbers, rate, duration)))
+
+
+def run(host, port, clients, processes, rate, duration):
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_process,
+                                       args=(host, port, range(index, clients, processes), rate, duration, results))
+               for index in range(processes)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    totals = [results.get() for _ in workers]
+    elapsed = time.monotonic() - start
+    for worker in workers:
+        worker.join()
+
+    sent = sum(total[0] for total in totals)
+    received = sum(total[1] for total in totals)
+    failed = sum(total[2] for total in totals)
+    expected = sent * (clients - failed - 1)
+    print(f"clients:   {clients - failed} connected, {failed} failed")
+    print(f"published: {sent} messages, {sent / duration:.0f} msg/s")
+    print(f"delivered: {received} messages, {received / duration:.0f} msg/s")
+    if expected:
+        print(f"delivery:  {received / expected * 100:.1f} % of {expected} in {elapsed:.1f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load generator for hub mode")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3333)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=1, help="load processes, so the generator is not the limit")
+    parser.add_argument("--rate", type=float, default=1, help="messages per second of each client")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send")
+    options = parser.parse_args()
+    run(options.host, options.port, options.clients, options.processes, options.rate, options.duration)
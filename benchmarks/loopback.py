@@ -0,0 +1,191 @@
+# Drives the real server and client of two in-process nodes over 127.0.0.1 and writes the results as JSON
+# Measures message latency (one-way and round trip), throughput per payload size, connect to completed init and restart()
+# Run from the repository root: python -m benchmarks.loopback [--transport threads asyncio] [--output results.json]
+import argparse
+import datetime
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.stub import StubChatApp
+
+BASE_PORT = 46000
+PAYLOAD_SIZES = [16, 256, 4096, 65536]
+POLL = 0.0002  # Seconds between two checks of a condition
+
+
+# Method to wait until condition() is true | Returns False on timeout
+def wait_for(condition, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(POLL)
+    return True
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else None
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(statistics.median(values) * 1000, 4) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 4) if values else None,
+        "max_ms": round(max(values) * 1000, 4) if values else None
+    }
+
+
+# One message at a time from a to b | Measured from send() until b handed it to the frontend
+def one_way_latency(a, b, count):
+    latencies = []
+    for number in range(count):
+        expected = len(b.received) + 1
+        start = time.perf_counter()
+        a.send(f"latency {number}")
+        if not wait_for(lambda: len(b.received) >= expected):
+            break
+        latencies.append(b.received[-1][0] - start)
+    return summary(latencies)
+
+
+# b answers every message of a | Measured from send() until the echo arrived at a
+def round_trip_latency(a, b, count):
+    b.on('message', lambda _nickname, msg, _direct: b.send(msg) if msg.startswith("echo ") else None)
+    latencies = []
+    for number in range(count):
+        expected = len(a.received) + 1
+        start = time.perf_counter()
+        a.send(f"echo {number}")
+        if not wait_for(lambda: len(a.received) >= expected):
+            break
+        latencies.append(a.received[-1][0] - start)
+    return summary(latencies)
+
+
+# Messages sent back to back | Measured until the last one arrived
+def throughput(a, b, size, count):
+    payload = os.urandom(size // 2 + 1).hex()[:size]  # Random text so compression does not flatter the result
+    expected = len(b.received) + count
+    start = time.perf_counter()
+    for _ in range(count):
+        a.send(payload)
+    complete = wait_for(lambda: len(b.received) >= expected, 60)
+    duration = time.perf_counter() - start
+    return {
+        "payload_bytes": size,
+        "messages": count,
+        "complete": complete,
+        "messages_per_second": round(count / duration, 1),
+        "megabytes_per_second": round(count * size / duration / 1024 / 1024, 2)
+    }
+
+
+# Time from conn() until both sides finished the \b/init handshake
+def connect_time(a, b, count):
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        a.client.conn(['127.0.0.1', b.port])
+        if not wait_for(lambda: a.client.is_connected and b.server.has_connection):
+            break
+        times.append(time.perf_counter() - start)
+
+        for session in a.sessions.connected():
+            a.client.close_session(session)
+            a.sessions.remove(session)
+        wait_for(lambda: not b.server.has_connection)
+    return summary(times)
+
+
+# Time from restart() until the server accepts connections again
+def restart_time(node, count):
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        node.restart()
+        if not wait_for(lambda: listening(node)):
+            break
+        times.append(time.perf_counter() - start)
+    return summary(times)
+
+
+# The asyncio server binds in the background and sets its server attribute once it listens
+def listening(node):
+    return getattr(node.server, "server", node.server) is not None and accepts(node.port)
+
+
+def accepts(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def run(transport, port, messages=1000, cycles=20):
+    a = StubChatApp(port, transport=transport)
+    b = StubChatApp(port + 1, transport=transport)
+    try:
+        wait_for(lambda: accepts(a.port) and accepts(b.port))
+        results = {"connect": connect_time(a, b, cycles)}
+
+        a.client.conn(['127.0.0.1', b.port])
+        b.client.conn(['127.0.0.1', a.port])
+        wait_for(lambda: a.client.is_connected and b.client.is_connected)
+
+        results["one_way_latency"] = one_way_latency(a, b, messages)
+        results["round_trip_latency"] = round_trip_latency(a, b, messages)
+        results["throughput"] = [throughput(a, b, size, max(100, messages * 10 // max(1, size // 1024)))
+                                 for size in PAYLOAD_SIZES]
+        results["restart"] = restart_time(a, cycles)
+        return results
+    finally:
+        a.stop()
+        b.stop()
+
+
+# Method to get the version of the code that is measured
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmarks of p2p-chat")
+    parser.add_argument("--transport", nargs="+", choices=["threads", "asyncio"], default=["threads", "asyncio"])
+    parser.add_argument("--messages", type=int, default=1000, help="messages per latency measurement")
+    parser.add_argument("--cycles", type=int, default=20, help="connects and restarts to measure")
+    parser.add_argument("--output", help="file to write the JSON results to instead of stdout")
+    options = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "transports": {}
+    }
+    for number, transport in enumerate(options.transport):
+        report["transports"][transport] = run(transport, BASE_PORT + number * 10, options.messages, options.cycles)
+
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as file:
+            file.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Queues chat messages while a node is offline and measures how fast its file outbox delivers them on the next connect
+# "writes" counts the send calls of the connection, a batched flush needs far fewer than one per message
+# Run from the repository root: python -m benchmarks.outbox_flush [messages] [--transport threads asyncio]
+import argparse
+import tempfile
+import time
+
+from benchmarks.loopback import wait_for
+from benchmarks.stub import StubChatApp
+
+BASE_PORT = 46300
+
+
+def run(transport, port, messages):
+    with tempfile.TemporaryDirectory() as directory:
+        sender = StubChatApp(port, transport=transport, outbox_dir=directory)
+        receiver = StubChatApp(port + 1, transport=transport)
+        try:
+            time.sleep(0.2)
+            sender.client.conn(["127.0.0.1", port + 1])  # Creates the outbox of the receiver
+            wait_for(lambda: sender.client.is_connected, 5)
+            sender.send("online")
+            wait_for(lambda: receiver.received, 5)
+            receiver.received.clear()
+            sender.restart()
+
+            start = time.perf_counter()
+            for number in range(messages):
+                sender.send(f"offline message {number}")
+            queued = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sender.client.conn(["127.0.0.1", port + 1])
+            if not wait_for(lambda: len(receiver.received) >= messages, 120):
+                raise AssertionError(f"{len(receiver.received)} of {messages} messages arrived")
+            flushed = time.perf_counter() - start
+            if [msg for _time, _nickname, msg in receiver.received] != [f"offline message {number}"
+                                                                      for number in range(messages)]:
+                raise AssertionError("Messages arrived out of order or twice")
+
+            connection = sender.sessions.connected()[0].outbound
+            writes = getattr(connection, 'writes', None)  # Only the threaded transport counts its send calls
+            print(f"{transport:<8} {messages:>8} {queued:>9.2f} {messages / queued:>10.0f} {flushed:>9.2f} "
+                  f"{messages / flushed:>10.0f} {'-' if writes is None else writes:>8}")
+        finally:
+            sender.stop()
+            receiver.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('messages', type=int, nargs='?', default=50000)
+    parser.add_argument('--transport', nargs='+', default=["threads", "asyncio"])
+    args = parser.parse_args()
+    print(f"{'':<8} {'messages':>8} {'queue s':>9} {'queued/s':>10} {'flush s':>9} {'flushed/s':>10} {'writes':>8}")
+    for number, transport in enumerate(args.transport):
+        run(transport, BASE_PORT + number * 10, args.messages)
+
+
+if __name__ == '__main__':
+    main()
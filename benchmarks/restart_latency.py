@@ -0,0 +1,97 @@
+# Measures /disconnect and /port of a connected node and checks that its port never refuses a connection meanwhile
+# A prober connects to the port over and over while the node restarts, every refused connection is a gap
+# Exits with status 1 if a connection was refused or the median restart took longer than --limit milliseconds
+# Run from the repository root: python -m benchmarks.restart_latency [--transport threads asyncio] [--cycles 50]
+import argparse
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from benchmarks.loopback import wait_for
+from benchmarks.stub import StubChatApp
+
+PROBE_INTERVAL = 0.001  # Seconds between two connections of the prober
+BASE_PORT = 26400  # Below the ephemeral ports, the prober leaves thousands of them in TIME_WAIT
+
+
+class Prober(threading.Thread):  # Connects to a port until stopped and counts refused connections
+    def __init__(self, port):
+        super(Prober, self).__init__(daemon=True)
+        self.port = port
+        self.stopped = False
+        self.attempts = 0
+        self.refused = 0
+
+    def run(self):
+        while not self.stopped:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+            except OSError:
+                self.refused += 1
+            self.attempts += 1
+            time.sleep(PROBE_INTERVAL)
+
+
+def restart_times(node, peer, cycles, ports):
+    times = []
+    for number in range(cycles):
+        node.client.conn(['127.0.0.1', peer.port])
+        wait_for(lambda: node.client.is_connected, 5)
+        args = None if ports is None else [str(ports[number % 2])]
+        start = time.perf_counter()
+        node.restart(args)
+        times.append(time.perf_counter() - start)
+        if ports is not None and not accepts(ports[number % 2]):  # The new port has to accept right away
+            raise AssertionError(f"Port {ports[number % 2]} does not accept connections after /port")
+    return times
+
+
+def accepts(port):
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def run(transport, port, cycles, limit):
+    node = StubChatApp(port, transport=transport)
+    peer = StubChatApp(port + 1, transport=transport)
+    failed = False
+    try:
+        time.sleep(0.2)
+        prober = Prober(port)
+        prober.start()
+        disconnect = restart_times(node, peer, cycles, None)
+        prober.stopped = True
+        prober.join()
+        switch = restart_times(node, peer, cycles, [port + 2, port])
+
+        for name, times in (("/disconnect", disconnect), ("/port", switch)):
+            median = statistics.median(times) * 1000
+            print(f"{transport:<8} {name:<12} p50 {median:7.2f} ms  max {max(times) * 1000:7.2f} ms")
+            failed = failed or median > limit
+        print(f"{transport:<8} {prober.attempts} connections during /disconnect, {prober.refused} refused")
+        failed = failed or prober.refused > 0
+    finally:
+        node.stop()
+        peer.stop()
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', nargs='+', choices=["threads", "asyncio"], default=["threads", "asyncio"])
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--limit', type=float, default=50, help="highest accepted median restart time in ms")
+    args = parser.parse_args()
+    passed = True
+    for number, transport in enumerate(args.transport):
+        passed = run(transport, BASE_PORT + number * 10, args.cycles, args.limit) and passed
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Builds a search index from a generated chat log and measures imports, queries, snapshots and loads
+# "grep" is what searching the log by hand costs: reading every line and matching all words
+# Run from the repository root: python -m benchmarks.search_index [lines]
+import datetime
+import gzip
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from src.journal import LOG_PREFIX
+from src.search import SearchIndex
+
+NICKNAMES = ["office-pc", "laptop", "flowei", "anna", "build-server", "kiosk"]
+WORDS = ("lunch meeting deploy server restart coffee build failed passed review merge branch release "
+         "tomorrow today weekend printer network password update ticket customer invoice holiday").split()
+QUERIES = [(["lunch"], None), (["deploy", "failed"], None), (["printer"], "kiosk"), (["holiday", "weekend", "coffee"], None)]
+LINES_PER_SEGMENT = 100000
+
+
+# Method to write log segments like the journal does | Finished segments are compressed
+def write_logs(directory, lines):
+    random.seed(1)
+    start = datetime.datetime(2024, 1, 1)
+    written = 0
+    while written < lines:
+        day = start + datetime.timedelta(days=written // LINES_PER_SEGMENT)
+        path = directory / f"{LOG_PREFIX}{day:%m-%d-%Y}.1.log.gz"
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as log:
+            for number in range(min(LINES_PER_SEGMENT, lines - written)):
+                time_of_day = day + datetime.timedelta(seconds=number * 86400 // LINES_PER_SEGMENT)
+                text = " ".join(random.choices(WORDS, k=6)) + f" #{written + number}"
+                log.write(f"[{time_of_day:%Y-%m-%d %H:%M:%S}] {random.choice(NICKNAMES)} >  {text}\n")
+        written += min(LINES_PER_SEGMENT, lines - written)
+
+
+def grep(directory, words, nickname):
+    count = 0
+    for path in sorted(directory.glob(f"{LOG_PREFIX}*")):
+        with gzip.open(path, "rt", encoding="utf-8") as log:
+            for line in log:
+                lowered = line.lower()
+                if all(word in lowered for word in words) and (nickname is None or f"] {nickname} >" in line):
+                    count += 1
+    return count
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run(lines=1000000):
+    with tempfile.TemporaryDirectory() as directory:
+        logs, index_directory = Path(directory) / "logs", Path(directory) / "search"
+        logs.mkdir()
+        write_logs(logs, lines)
+
+        index = SearchIndex(index_directory, logs)
+        _, elapsed = timed(index.load)
+        print(f"import of {len(index)} log lines: {elapsed:.1f} s")
+        _, elapsed = timed(index.save, True)
+        size = sum(path.stat().st_size for path in index_directory.iterdir())
+        print(f"snapshot: {elapsed:.1f} s, index on disk {size / 1024 / 1024:.1f} MiB")
+        index.close()
+
+        index = SearchIndex(index_directory, logs)
+        _, elapsed = timed(index.load)
+        print(f"load of the snapshot: {elapsed:.1f} s")
+
+        print(f"{'query':<36} {'matches':>8} {'index ms':>9} {'grep ms':>9}")
+        for words, nickname in QUERIES:
+            best = None
+            for _ in range(5):
+                (count, _results), elapsed = timed(index.search, words, nickname)
+                best = elapsed if best is None else min(best, elapsed)
+            expected, grep_time = timed(grep, logs, words, nickname)
+            if count != expected:
+                raise AssertionError(f"{words} found {count} messages instead of {expected}")
+            query = " ".join(words) + (f" from:{nickname}" if nickname else "")
+            print(f"{query:<36} {count:>8} {best * 1000:>9.2f} {grep_time * 1000:>9.0f}")
+        index.close()
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
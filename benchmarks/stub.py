@@ -0,0 +1,22 @@
+# Headless nodes for benchmarks | ChatEngine without journal that records every chat message it receives
+import time
+
+from src.engine import ChatEngine
+from src.outbox import OutboxStore
+
+
+class StubChatApp(ChatEngine):
+    def __init__(self, port, nickname=None, transport="threads", verbose=False, outbox_dir=None,
+                 discovery_port=None):
+        super(StubChatApp, self).__init__(port, nickname or f"node{port}", "127.0.0.1", transport, log=False,
+                                          peer_cache=False)
+        if outbox_dir is not None:  # Outboxes in files instead of memory
+            self.outboxes = OutboxStore(outbox_dir, self.outboxes.window, self.outbox_failed)
+        self.discovery_enabled = discovery_port is not None  # Announced on loopback multicast, never on the LAN
+        self.discovery_interface = "127.0.0.1"
+        self.discovery_port = discovery_port
+        self.received = []  # (time received, origin, message) of every chat message
+        self.on('message', lambda nickname, msg, _direct: self.received.append((time.perf_counter(), nickname, msg)))
+        if verbose:
+            self.on('system', lambda msg: print(f"[{self.nickname}] {msg}"))
+        self.start()
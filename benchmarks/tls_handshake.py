@@ -0,0 +1,98 @@
+# Measures TLS over 127.0.0.1: full and resumed handshakes, and the throughput of encrypted and plain streams
+# The channels are the ones the app uses, a resumed handshake is what a reconnect or a restart costs
+# Run from the repository root: python -m benchmarks.tls_handshake [handshakes] [megabytes]
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from src.protocol import RECV_SIZE
+from src.tls import TLS, TLSSocket
+
+CHUNK = 64 * 1024
+
+
+# Method to run a TLS server on a listening socket | Every accepted connection is handshaked and drained
+def serve(listener, tls, stop):
+    while not stop.is_set():
+        try:
+            sock, _ = listener.accept()
+        except socket.timeout:  # Checks stop now and then
+            continue
+        except OSError:
+            return
+        sock.settimeout(None)
+        with sock:
+            stream = TLSSocket(sock, tls.server()) if tls is not None else sock
+            try:
+                if tls is not None:
+                    stream.handshake()
+                while stream.recv(RECV_SIZE):
+                    pass
+            except OSError:
+                pass
+
+
+def handshakes(port, tls, count, resume):
+    times = []
+    for _ in range(count):
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            channel = tls.client("127.0.0.1:bench" if resume else f"127.0.0.1:{len(times)}")
+            start = time.perf_counter()
+            TLSSocket(sock, channel).handshake()
+            times.append(time.perf_counter() - start)
+            if channel.resumed != (resume and len(times) > 1):
+                raise AssertionError("The session was not resumed" if resume else "A session was resumed")
+            channel.encrypt(b"\0")  # Reading a record makes the client take the session ticket
+            sock.sendall(channel.outgoing.read())
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(0.05)
+            try:
+                TLSSocket(sock, channel).recv(RECV_SIZE)
+            except OSError:
+                pass
+    return times[1:] if resume else times
+
+
+def throughput(port, tls, megabytes):
+    data = bytes(CHUNK)
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        stream = sock
+        if tls is not None:
+            stream = TLSSocket(sock, tls.client("127.0.0.1:throughput"))
+            stream.handshake()
+        start = time.perf_counter()
+        for _ in range(megabytes * 1024 * 1024 // CHUNK):
+            stream.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        sock.recv(1)  # Waits until the server read everything and closed
+        return megabytes / (time.perf_counter() - start)
+
+
+def run(count=200, megabytes=256):
+    with tempfile.TemporaryDirectory() as directory:
+        tls = TLS(directory)
+        results = {}
+        for name, server_tls in (("tls", tls), ("plain", None)):
+            listener = socket.create_server(("127.0.0.1", 0))
+            listener.settimeout(0.1)
+            stop = threading.Event()
+            thread = threading.Thread(target=serve, args=(listener, server_tls, stop), daemon=True)
+            thread.start()
+            port = listener.getsockname()[1]
+            if server_tls is not None:
+                for label, resume in (("full handshake", False), ("resumed handshake", True)):
+                    times = handshakes(port, tls, count, resume)
+                    print(f"{label:<18} median {statistics.median(times) * 1000:.3f} ms, "
+                          f"p99 {sorted(times)[int(len(times) * 0.99)] * 1000:.3f} ms")
+            results[name] = throughput(port, server_tls and tls, megabytes)
+            stop.set()
+            listener.close()
+            thread.join(1)
+        print(f"throughput         tls {results['tls']:.0f} MB/s, plain {results['plain']:.0f} MB/s")
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -1,280 +1,174 @@
-import datetime
 import os
-import socket
-import sys
 import time
-from io import StringIO
 
 import npyscreen
-import pyperclip
 
-from src.client import Client
-from src.server import Server
+from src.engine import ChatEngine
 from src.form import ChatForm
-from src.settings import LANG, change_lang, change_settings
+from src.history import InputHistory
+from src.outbox import Receipt
+from src.render import RenderScheduler
+from src.scrollback import Scrollback
+from src.settings import LANG, get_setting
+from src.startup import PROFILE
+
+
+class SentLine:  # Line of a message we sent | Shows whether the peers acknowledged it, read again on every redraw
+    MARKS = {Receipt.PENDING: " …", Receipt.DELIVERED: " ✓", Receipt.FAILED: " ✗"}
+
+    def __init__(self, text, receipt):
+        self.text = text
+        self.receipt = receipt
+
+    def __str__(self):
+        return self.text + self.MARKS[self.receipt.state]
 
 
 # noinspection PyAttributeOutsideInit
-class ChatApp(npyscreen.NPSAppManaged):
+class ChatApp(npyscreen.NPSAppManaged):  # Curses frontend of the ChatEngine
+    def __init__(self, port=3333, nickname=None, transport=None):
+        super(ChatApp, self).__init__()
+        self.engine_options = {"port": port, "nickname": nickname, "transport": transport}
 
     # Method called at start by npyscreen
     def onStart(self):
 
+        # Lines of the chat feed | The ring buffer keeps memory flat however long the session runs
+        self.scrollback = Scrollback(get_setting('scrollback', 1000))
+
+        # Feed updates of all threads are queued and drawn by the UI thread at most max_fps times a second
+        self.renderer = RenderScheduler(self.render_lines, get_setting('max_fps', 20))
+
         # Add ChatForm as the main form of npyscreen
         self.form = self.addForm('MAIN', ChatForm, name=LANG['interface']['title'])
-
-        # Get these PCs public IP and catch errors
-        try:
-            self.hostname = socket.gethostbyname(socket.gethostname())
-        except socket.error:
-            self.system_message(LANG['noInternetAccess'])
-            self.system_message(LANG['failedFetchPublicIP'])
-            self.hostname = "0.0.0.0"
+        PROFILE.mark('interface')
 
         # Define initial variables
-        self.port = 3333  # Port the server runs on
-        self.nickname = os.getlogin()
-        self.peer = ""  # Peer nickname
-        self.peer_ip = "0"  # IP of peer
-        self.peer_port = "0"  # Port of peer
-        self.history_log = []  # Array for message log
-        self.message_log = []  # Array for chat log
-        self.history_pos = 0  # Int for current position in message history
-
-        self.start_threads()
-
-        self.system_message(LANG['nicknameInfo'].format(self.nickname))
-
-        # Dictionary for commands. Includes function to call and number of needed arguments
-        self.commands = {
-            "connect": [self.client.conn, 2],
-            "disconnect": [self.restart, 0],
-            "nickname": [self.set_nickname, 1],
-            "quit": [self.exit, 0],
-            "port": [self.restart, 1],
-            "connectback": [self.connect_back, 0],
-            "clear": [self.clear_chat, 0],
-            "eval": [self.eval_code, -1],
-            "status": [self.get_status, 0],
-            "log": [self.log_chat, 0],
-            "help": [self.help_command, 0],
-            "lang": [self.change_lang, 1]
-        }
-
-        # Dictionary for command aliases
-        self.commands_alias = {
-            "nick": "nickname",
-            "conn": "connect",
-            "q": "quit",
-            "connback": "connectback"
-        }
+        self.history = InputHistory()  # Lines typed by the user, walked with Up and Down
+
+        self.engine = ChatEngine(**self.engine_options)
+        self.engine.on('system', self.system_message)
+        self.engine.on('message', self.peer_message)
+        self.engine.on('sent', self.sent_message)
+        self.engine.on('receipt', lambda _receipt: self.renderer.invalidate())
+        self.engine.on('output', self.eval_output)
+        self.engine.on('clear', self.clear_chat)
+        self.engine.on('exit', self.exit)
+        self.engine.on('status', self.render_status)
+        self.engine.start()
 
         if os.name == "nt":
             os.system(LANG['interface']['title'])  # Set window title on windows
 
-    # Start Server and Client threads
-    def start_threads(self):
-        self.server = Server(self)
-        self.server.daemon = True
-        self.client = Client(self)
-        self.server.start()
-        self.client.start()
-
-    # Method to change interface language. Files need to be located in lang/
-    def change_lang(self, args):
-        self.system_message(LANG['changingLang'].format(args[0]))
-
-        try:
-            change_lang(args[0])
-        except Exception as e:
-            self.system_message(LANG['failedChangingLang'])
-            self.system_message(e)
-            return False
-
-        change_settings('language', args[0])
-
-    # Method to reset server and client sockets
-    def restart(self, args=None):
-        self.system_message(LANG['restarting'])
-
-        if args is not None and args[0] != self.port:
-            self.port = int(args[0])
-
-        if self.client.is_connected:
-            self.client.send("\b/quit")
-            time.sleep(0.2)
-
-        self.client.stop()
-        self.server.stop()
-
-        self.start_threads()
-
-    # Method to scroll back in the history of sent messages
+    # Method to scroll back in the history of sent messages | Only lines starting with the typed text are shown
     def history_back(self, _input):
-        if not self.history_log or self.history_pos == 0:
+        line = self.history.back(self.form.input.value)
+        if line is None:
             return False
-        self.history_pos -= 1
-        self.form.input.value = self.history_log[len(self.history_log) - 1 - self.history_pos]
+        self.form.input.value = line
+        self.form.input.entry_widget.cursor_position = len(line)
 
     # Method to scroll forward in the history of sent messages
     def history_forward(self, _input):
-        if not self.history_log:
+        line = self.history.forward(self.form.input.value)
+        if line is None:
             return False
-        if self.history_pos == len(self.history_log) - 1:
-            self.form.input.value = ""
-            return True
-        self.history_pos += 1
-        self.form.input.value = self.history_log[len(self.history_log) - 1 - self.history_pos]
-
-    # Method to set nickname of client | Nickname will be sent to peer for identification
-    def set_nickname(self, args):
-        self.nickname = args[0]
-        self.system_message("{0}".format(LANG['setNickname'].format(args[0])))
-        if self.client.is_connected:
-            self.client.send("\b/nick {0}".format(args[0]))
+        self.form.input.value = line
+        self.form.input.entry_widget.cursor_position = len(line)
 
     # Method to render system info on chat feed
     def system_message(self, msg):
         system_prefix = f"[{LANG['interface']['system']}] "
-        self.message_log.append(system_prefix + str(msg))
-        if len(self.form.feed.values) > self.form.y - 10:
-            self.clear_chat()
-        if len(str(msg)) > self.form.x - 20:
-            self.form.feed.values.append(system_prefix + str(msg[:self.form.x - 20]))
-            self.form.feed.values.append(str(msg[self.form.x - 20:]))
+        if len(msg) > self.form.x - 20:
+            self.feed_message(system_prefix + msg[:self.form.x - 20], msg[self.form.x - 20:])
         else:
-            self.form.feed.values.append(system_prefix + str(msg))
-        self.form.feed.display()
+            self.feed_message(system_prefix + msg)
 
-    # Method to send a message to a connected peer
+    # Method to hand the typed message or command to the engine
     def send_message(self, _input):
         msg = self.form.input.value
         if msg == "":
             return False
 
-        if len(self.form.feed.values) > self.form.y - 11:
-            self.clear_chat()
-
-        self.message_log.append(LANG['you'] + " > " + msg)
-        self.history_log.append(msg)
-        self.history_pos = len(self.history_log)
+        self.history.add(msg)
         self.form.input.value = ""
         self.form.input.display()
 
-        if msg.startswith('/'):
-            self.handle_command(msg)
+        self.engine.input(msg)
+        self.renderer.tick()
+
+    # Method to render a message of a peer on chat feed
+    def peer_message(self, nickname, msg, direct):
+        if direct:
+            self.feed_message("{0} > {1} >  {2}".format(nickname, LANG['you'], msg))
+        else:
+            self.feed_message("{0} >  {1}".format(nickname, msg))
+
+    # Method to render a message we sent on chat feed
+    def sent_message(self, msg, nickname, receipt=None):
+        if nickname is not None:
+            line = "{0} > {1} > {2}".format(LANG['you'], nickname, msg)
         else:
-            if self.client.is_connected:
-                if self.client.send(msg):
-                    self.form.feed.values.append(LANG['you'] + " > " + msg)
-                    self.form.feed.display()
-            else:
-                self.system_message(LANG['notConnected'])
-
-    # Method to connect to a peer that connected to the server
-    def connect_back(self):
-        if self.server.has_connection and not self.client.is_connected:
-            if self.peer_ip == "unknown" or self.peer_port == "unknown":
-                self.system_message(LANG['failedConnectPeerUnknown'])
-                return False
-            self.client.conn([self.peer_ip, int(self.peer_port)])
+            line = LANG['you'] + " > " + msg
+        self.feed_message(SentLine(line, receipt) if receipt is not None and receipt.tracked else line)
+
+    # Method to render the output of /eval on chat feed
+    def eval_output(self, text):
+        self.feed_message('> ' + text)
+
+    # Method to append lines to the chat feed | Safe to call from any thread, drawing happens on the next tick
+    def feed_message(self, *lines):
+        self.renderer.push(*lines)
+
+    # Method called by the render scheduler on the UI thread
+    def render_lines(self, lines):
+        start = time.perf_counter()
+        for line in lines:
+            self.scrollback.append(line, self.form.feed_height)
+        self.render_feed()
+        self.engine.metrics.render.record(time.perf_counter() - start)
+
+    # Method to show the visible part of the scrollback in the chat feed
+    def render_feed(self):
+        self.form.feed.values = [str(line) for line in self.scrollback.window(self.form.feed_height)]
+        if self.scrollback.offset:
+            self.form.feed.footer = LANG['interface']['scrolled'].format(self.scrollback.offset)
         else:
-            self.system_message(LANG['alreadyConnected'])
-
-    # Method to log the chat to a file | Files can be found in root directory
-    def log_chat(self):
-        try:
-            date = datetime.datetime.now().strftime("%m-%d-%Y")
-            log = open("p2p-chat-log_{0}.log".format(date), "a")
-            for msg in self.message_log:
-                log.write(msg + "\n")
-        except FileNotFoundError:
-            self.system_message(LANG['failedSaveLog'])
-            return False
+            self.form.feed.footer = None
+        self.form.feed.display()
+
+    # Method to scroll the chat feed one page back
+    def scroll_up(self, _input):
+        self.scrollback.page_up(self.form.feed_height)
+        self.renderer.invalidate()
+        self.renderer.tick()
 
-        log.close()
-        self.message_log = []
-        self.system_message(LANG['savedLog'].format(date))
+    # Method to scroll the chat feed one page forward
+    def scroll_down(self, _input):
+        self.scrollback.page_down(self.form.feed_height)
+        self.renderer.invalidate()
+        self.renderer.tick()
 
     # Method to clear the chat feed
     def clear_chat(self):
-        self.form.feed.values = []
-        self.form.feed.display()
+        self.scrollback.clear()
+        self.renderer.invalidate()
 
-    # Method to run python code inside the app | Useful to print app vars
-    def eval_code(self, code):
-        default_std_out = sys.stdout
-        redirected_std_out = sys.stdout = StringIO()
-        try:
-            exec(code)
-        except Exception as e:
-            self.system_message(e)
-        finally:
-            sys.stdout = default_std_out
-        self.form.feed.values.append('> ' + redirected_std_out.getvalue())
-        self.form.feed.display()
+    # Method to add the render statistics to /status
+    def render_status(self):
+        self.engine.system_message(LANG['renderStatusMessage'].format(
+            self.renderer.redraws, self.renderer.coalesced, round(1 / self.renderer.interval)))
 
-    # Method to exit the app | Exit command will be sent to a connected peer so that they can disconnect their sockets
+    # Method called after the engine stopped
     def exit(self):
-        self.system_message(LANG['exitApp'])
-        if self.client.is_connected:
-            self.client.send("\b/quit")
-        self.client.stop()
-        self.server.stop()
         exit(1)
 
     # Method to paste text from clipboard to the chat input
     def paste_from_clipboard(self, _input):
+        import pyperclip  # Imported on the first paste, it looks for a clipboard program when loaded
         self.form.input.value = pyperclip.paste()
         self.form.input.display()
 
-    # Method to handle commands
-    def handle_command(self, msg):
-        if msg.startswith("/eval"):
-            args = msg[6:]
-            self.eval_code(args)
-            return True
-
-        msg = msg.split(' ')
-        command = msg[0][1:]
-        args = msg[1:]
-        if command in self.commands_alias:
-            command = self.commands_alias[command]
-
-        if self.commands.get(command) is not None:
-            if self.commands[command][1] == 0:
-                self.commands[command][0]()
-            elif len(args) == self.commands[command][1]:
-                self.commands[command][0](args)
-            else:
-                self.system_message(LANG['commandWrongSyntax'].format(command, self.commands[command][1], len(args)))
-        else:
-            self.system_message(LANG['commandNotFound'])
-
-    # Method to print a list of all commands
-    def help_command(self):
-        if len(self.form.feed.values) + len(self.commands) + 1 > self.form.y - 10:
-            self.clear_chat()
-
-        self.system_message(LANG['commandList'])
-
-        for command in self.commands:
-            if not LANG['commands'][command] == "":
-                self.system_message(LANG['commands'][command])
-
-    # Method to print the status of server and client
-    def get_status(self):
-        self.system_message("STATUS:")
-        server_status = bool(self.server)
-        client_status = bool(self.client)
-
-        self.system_message(
-            LANG['serverStatusMessage'].format(server_status, self.port, self.server.has_connection))
-        self.system_message(LANG['clientStatusMessage'].format(client_status, self.client.is_connected))
-
-        if not self.nickname == "":
-            self.system_message(LANG['nicknameStatusMessage'].format(self.nickname))
-
 
 if __name__ == '__main__':
     chatApp = ChatApp().run()  # Start the app if chat.py is executed
@@ -1,18 +1,45 @@
+from src.startup import PROFILE  # First import so the profile covers everything below
+
+import argparse
+import json
 import sys
 import importlib.util
-import subprocess
 import os
 
-required_modules = ['socket', 'threading', 'curses', 'npyscreen', 'time', 'datetime', 'pyperclip', 'pathlib']
+parser = argparse.ArgumentParser(description="Peer-2-Peer Chat")
+parser.add_argument("--daemon", action="store_true", help="run without user interface, e.g. as a service")
+parser.add_argument("--port", type=int, default=3333, help="port the server runs on")
+parser.add_argument("--nickname", help="nickname to use instead of the login name")
+parser.add_argument("--transport", choices=["threads", "asyncio"], help="overrides the transport of settings.json")
+parser.add_argument("--no-input", action="store_true", help="daemon only: do not read commands from stdin")
+parser.add_argument("--hub", action="store_true", help="run as hub many peers connect to, without user interface")
+parser.add_argument("--workers", type=int, help="hub only: number of worker processes, default one per CPU core")
+parser.add_argument("--profile-startup", action="store_true", help="show how long each phase of the startup took")
+options = parser.parse_args()
+PROFILE.enabled = options.profile_startup
+PROFILE.mark('arguments')
+
+required_modules = []  # Modules of the standard library are always there
+if not options.daemon and not options.hub:  # The curses interface is not needed in daemon and hub mode
+    required_modules += ['curses', 'npyscreen', 'pyperclip']
 missing_modules = []
 
+# Result of the last successful check | Checked again if the interpreter or the list of modules changed
+dependency_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dependencies.json')
+dependency_key = {"python": sys.executable, "version": sys.version, "modules": required_modules}
+try:
+    with open(dependency_cache, encoding='utf-8') as cache_file:
+        dependencies_checked = json.loads(cache_file.read()) == dependency_key
+except (OSError, ValueError):
+    dependencies_checked = False
+
 required_python_version = (3, 3)
 
 if sys.version_info < required_python_version:  # Check the python version
     print(f"Python version {required_python_version[0]}.{required_python_version[1]}"
           f" is required to run p2p-chat. Your version is {sys.version}.")
     exit(1)
-else:
+elif not dependencies_checked:
     # Go through each module and check if its installed
     for module in required_modules:
         if module not in sys.modules and importlib.util.find_spec(module) is None:
@@ -31,6 +58,7 @@ else:
                         print("Curses needs to be installed manually. See https//github.com/F1xw/p2p-chat#Requirements")
                         continue
                     try:
+                        import subprocess
                         pip = subprocess.Popen([sys.executable, "-m", "pip", "install", module])
                         pip.wait()
                     except Exception:
@@ -48,7 +76,36 @@ if missing_modules:
         print("-", module)
         i = input("Press Enter to Exit >>")
         exit(1)
+
+if not dependencies_checked:
+    try:
+        with open(dependency_cache, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(json.dumps(dependency_key))
+    except OSError:
+        pass
+PROFILE.mark('dependency check')
+
+if options.hub:
+    from src.hub import Hub
+    PROFILE.mark('imports')
+
+    if not Hub(options.port, options.workers, options.nickname or "hub").run():  # Run worker processes until stopped
+        exit(1)
+elif options.daemon:
+    from src.daemon import Daemon
+    from src.engine import ChatEngine
+    PROFILE.mark('imports')
+
+    engine = ChatEngine(port=options.port, nickname=options.nickname, transport=options.transport)
+    Daemon(engine, read_input=not options.no_input).run()  # Run the Chat Engine without user interface
 else:
-    import chat
+    try:
+        import chat
+    except ImportError as error:  # A module was removed after the cached check
+        os.remove(dependency_cache)
+        print(error)
+        print("Please start p2p-chat again to check the required modules.")
+        exit(1)
+    PROFILE.mark('imports')
 
-    chatApp = chat.ChatApp().run()  # Run the Chat App
+    chatApp = chat.ChatApp(options.port, options.nickname, options.transport).run()  # Run the Chat App
@@ -0,0 +1,312 @@
+import asyncio
+import threading
+import time
+
+from src.client import HEARTBEAT_TICK, OutboundHandler
+from src.protocol import INIT_ACK_TIMEOUT, MAX_ACK_SIZE, RECV_SIZE, build_init, parse_init_ack, set_nodelay, \
+    split_init_ack
+from src.server import PeerHandler
+from src.session import SEND_BUFFER_SIZE, Connection
+from src.settings import LANG
+
+
+class EventLoopThread(threading.Thread):  # One event loop shared by all asyncio servers and clients of the app
+    def __init__(self):
+        super(EventLoopThread, self).__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    # Start method called by threading module
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Method to schedule a coroutine without blocking the calling thread
+    def submit(self, coroutine):
+        if threading.current_thread() is self:
+            return self.loop.create_task(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Method to call a plain function on the loop thread
+    def call(self, function, *args):
+        if threading.current_thread() is self:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+
+_loop_thread = None
+
+
+# Method to get the shared event loop thread | The loop survives restarts so no threads are created per session
+def get_loop_thread():
+    global _loop_thread
+    if _loop_thread is None:
+        _loop_thread = EventLoopThread()
+        _loop_thread.start()
+    return _loop_thread
+
+
+class StreamConnection(Connection):  # Connection backed by an asyncio stream writer
+    def __init__(self, writer, loop_thread, framed=False, capabilities=(), limit=SEND_BUFFER_SIZE):
+        super(StreamConnection, self).__init__(None, framed, capabilities)
+        self.writer = writer
+        self.loop_thread = loop_thread
+        self.limit = limit  # The write buffer of the transport is the send queue
+        self.handed = 0  # Bytes handed to the loop that did not reach the transport yet
+        self.handed_lock = threading.Lock()
+
+    # Method to write bytes to the peer | The write is handed to the event loop so the caller never blocks
+    def write_raw(self, data):
+        if self.writer.is_closing():
+            raise ConnectionResetError(LANG['failedSendData'])
+        with self.handed_lock:
+            self.handed += len(data)
+        self.loop_thread.call(self.write_now, data)
+
+    # Method running on the loop | Writes queued before the connection broke are dropped instead of logging a warning each
+    def write_now(self, data):
+        with self.handed_lock:
+            self.handed -= len(data)
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    # The transport gathers everything written while the socket was busy and sends it with the next call
+    @property
+    def queued(self):
+        return self.handed + self.writer.transport.get_write_buffer_size()
+
+    @property
+    def full(self):
+        return self.queued >= self.limit
+
+    def close(self):
+        if self.transfer is not None:
+            self.transfer.close()
+        self.loop_thread.call(self.writer.close)
+
+
+class AsyncServer(PeerHandler):  # Listener running as stream server on the shared event loop
+    def __init__(self, chat_app, listener=None):
+        super(AsyncServer, self).__init__(chat_app, listener)
+        self.loop_thread = get_loop_thread()
+        self.server = None
+        self.connections = set()  # Tasks serving connected peers
+
+    # Method called by Chat App to start listening
+    def start(self):
+        self.loop_thread.submit(self.listen())
+
+    # Coroutine serving the listener | asyncio closes the socket it serves, so it gets a duplicate the next server can not lose
+    async def listen(self):
+        if self.listener is None:
+            return
+        try:
+            self.server = await asyncio.start_server(self.serve, sock=self.listener.dup())
+        except OSError as error:
+            self.chat_app.system_message(error)
+            return
+        self.chat_app.system_message(LANG['serverStarted'].format(self.port))
+
+    # Coroutine serving one connected peer | Every peer is a task on the loop, not a thread
+    async def serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        connection = StreamConnection(writer, self.loop_thread, limit=self.send_buffer_size)
+        connection.address = (writer.get_extra_info('peername') or (None,))[0]
+        set_nodelay(writer.get_extra_info('socket'), self.tcp_nodelay)
+        self.accept_tls(connection)
+        try:
+            while True:  # Receive loop
+                timeout = self.idle_timeout(connection)
+                if timeout is None:
+                    data = await reader.read(RECV_SIZE)
+                else:  # Peers with heartbeats that stay silent are gone
+                    data = await asyncio.wait_for(reader.read(RECV_SIZE), timeout)
+                if not data:
+                    self.handle_disconnect(connection)
+                    break
+                for message in connection.reader.feed(data):
+                    if not self.handle_message(connection, message):
+                        return
+                self.acknowledge(connection)
+        except (OSError, ValueError, asyncio.TimeoutError):  # OSError includes failed TLS handshakes
+            self.handle_disconnect(connection)
+        except asyncio.CancelledError:  # Cancelled by stop()
+            pass
+        finally:
+            self.connections.discard(task)
+            connection.close()
+
+    # Method called by Chat App to reset server socket | Shutdown cancels the tasks instead of waking accept()
+    def stop(self, close_listener=True):
+        self.loop_thread.submit(self.close())
+        if close_listener:
+            self.close_listener()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        for task in list(self.connections):
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.server = None
+
+
+class AsyncClient(OutboundHandler):  # Outbound connections running as streams on the shared event loop
+    def __init__(self, chat_app):
+        super(AsyncClient, self).__init__(chat_app)
+        self.loop_thread = get_loop_thread()
+        self.ticker = None
+
+    # Method called by Chat App | Connections are opened on demand by conn(), only the heartbeat runs all the time
+    def start(self):
+        self.ticker = self.loop_thread.submit(self.tick())
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_TICK)
+            self.heartbeat()
+
+    def stop(self):
+        super(AsyncClient, self).stop()
+        if self.ticker is not None:
+            self.ticker.cancel()
+
+    # Method called by the heartbeat
+    def reconnect(self, ip, port):
+        self.loop_thread.submit(self.connect(ip, port, True))
+
+    # Method to connect to a peer without blocking the calling thread
+    def conn(self, args):
+        if self.chat_app.nickname == "":  # Check if a nickname is set and return False if not
+            self.chat_app.system_message(LANG['nickNotSet'])
+            return False
+
+        self.loop_thread.submit(self.connect(args[0], int(args[1])))
+
+    # Coroutine to connect to a peer | Reconnects are quiet and only report success
+    # plain skips TLS, it is set when connecting again after a failed handshake
+    async def connect(self, host, port, quiet=False, plain=False):
+        if not quiet:
+            self.chat_app.system_message(LANG['connectingToPeer'].format(host, port))
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            if quiet:
+                self.reconnect_failed(host, port)
+            else:
+                self.chat_app.system_message(LANG['failedConnectingTimeout'])
+            return False
+
+        # Encrypt the connection | Reconnects to the same address resume the TLS session instead of a full handshake
+        ip = writer.get_extra_info('peername')[0]
+        channel = None
+        if not plain and self.chat_app.uses_tls(ip, port):
+            channel = self.chat_app.tls.client(f"{ip}:{port}")
+            try:
+                await asyncio.wait_for(self.handshake(reader, writer, channel), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as error:
+                writer.close()
+                if self.chat_app.tls_failed(ip, port):
+                    return await self.connect(host, port, quiet, True)
+                if quiet:
+                    self.reconnect_failed(host, port)
+                else:
+                    self.chat_app.system_message(LANG['tlsFailed'].format(host, port))
+                    self.chat_app.system_message(error)
+                return False
+            if not self.verify_peer(ip, port, channel):
+                writer.close()
+                return False
+
+        # Exchange initial information (nickname, ip, port, capabilities)
+        if not self.chat_app.hostname_resolved.is_set():
+            await self.loop_thread.loop.run_in_executor(None, self.chat_app.hostname_resolved.wait)
+        init = build_init(self.chat_app.nickname, self.chat_app.hostname, self.chat_app.port)
+        writer.write(init if channel is None else channel.encrypt(init))
+        try:
+            capabilities, nickname, rest = await self.read_init_ack(reader, channel)
+        except OSError:
+            writer.close()
+            if quiet:
+                self.reconnect_failed(host, port)
+            return False
+
+        set_nodelay(writer.get_extra_info('socket'), self.tcp_nodelay)
+        connection = StreamConnection(writer, self.loop_thread, "framed" in capabilities, capabilities,
+                                      self.send_buffer_size)
+        try:
+            connection.received = connection.reader.feed(rest)  # Frames that came with the ack, e.g. the room of a hub
+        except ValueError:
+            writer.close()
+            return False
+        if channel is not None:
+            self.encrypt(connection, channel)
+        self.attach(connection, ip, port, nickname)
+        self.loop_thread.loop.create_task(self.read_replies(reader, connection))
+        if not quiet:
+            self.chat_app.system_message(LANG['connected'])
+        return True
+
+    @staticmethod
+    async def handshake(reader, writer, channel):
+        output = channel.handshake()
+        while True:
+            if output:
+                writer.write(output)
+            if channel.established:
+                return
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed during the TLS handshake")
+            output = channel.handshake(data)
+
+    # Coroutine waiting for the init acknowledgement of a peer | Returns the capabilities, the nickname of the peer
+    # and the bytes it sent after the ack | Old peers never answer and get no capabilities
+    async def read_init_ack(self, reader, channel):
+        data = b""
+        deadline = time.monotonic() + INIT_ACK_TIMEOUT
+        try:
+            while len(data) <= MAX_ACK_SIZE:
+                received = await asyncio.wait_for(self.read_plain(reader, channel),
+                                                  max(deadline - time.monotonic(), 0.001))
+                if not received:
+                    break
+                data += received
+                parts = split_init_ack(data)
+                if parts is not None:
+                    return parse_init_ack(parts[0]) + (parts[1],)
+        except asyncio.TimeoutError:
+            pass
+        if data.startswith(b"\b/init-ack"):  # Peers before ACK_END end the ack with the segment
+            return parse_init_ack(data) + (b"",)
+        return [], None, data
+
+    # Coroutine reading the next bytes of the peer, decrypted if the connection uses TLS
+    @staticmethod
+    async def read_plain(reader, channel):
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data or channel is None:
+                return data
+            plain = channel.decrypt(data)
+            if plain:
+                return plain
+
+    # Coroutine reading what a peer sends back on our connection
+    async def read_replies(self, reader, connection):
+        messages, connection.received = connection.received, []
+        try:
+            for data in messages:
+                self.handle_reply(connection, data)
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for message in connection.reader.feed(data):
+                    self.handle_reply(connection, message)
+        except (OSError, ValueError):
+            pass
+        if connection.session is not None:
+            self.connection_lost(connection.session, connection)
@@ -1,20 +1,437 @@
+import collections
+import random
+import selectors
 import socket
 import threading
+import time
 
-from src.settings import LANG
+from src.compression import negotiate
+from src.control import decode
+from src.protocol import build_init, receive_init_ack, set_nodelay
+from src.relay import Relay, new_message_id
+from src.session import SEND_BUFFER_SIZE, QueuedConnection, Session
+from src.settings import LANG, get_setting
+from src.tls import TLSReader, TLSSocket
 
+HEARTBEAT_TICK = 0.1  # Seconds between two checks of heartbeats and due reconnects
+RECONNECT_BASE = 0.1  # Delay of the first reconnect | Doubled on every failed attempt
+RECONNECT_MAX = 30  # Longest delay between two reconnects
+RECONNECT_ATTEMPTS = 15  # Attempts before a peer is given up
 
-class Client(threading.Thread):  # Client object is type thread so that it can run simultaneously with the server
+
+class OutboundHandler:  # Transport independent bookkeeping of the connections our client opened
     def __init__(self, chat_app):  # Initialize with a reference to the Chat App
-        super(Client, self).__init__()
         self.chat_app = chat_app
-        self.is_connected = False
-        self.socket = None
+        self.heartbeat_interval = get_setting('heartbeat_interval', 2)  # Seconds between two pings
+        self.heartbeat_timeout = get_setting('heartbeat_timeout', 6)  # Seconds without an answer until a peer is dead
+        self.connect_timeout = get_setting('connect_timeout', 5)
+        self.auto_reconnect = get_setting('reconnect', True)
+        self.reconnects = {}  # (ip, port) -> [nickname, failed attempts, time of the next attempt, time the peer was lost]
+        self.reconnect_lock = threading.Lock()
+        self.outboxes = chat_app.outboxes  # Chat messages peers did not acknowledge yet | Kept by the engine across restarts
+        self.tcp_nodelay = get_setting('tcp_nodelay', True)
+        self.send_buffer_size = get_setting('send_buffer_size', SEND_BUFFER_SIZE)  # Bytes queued per peer at most
+
+    # Connection status | True if the client is connected to at least one peer
+    @property
+    def is_connected(self):
+        return bool(self.chat_app.sessions.connected())
+
+    # True while lost peers are reconnected in the background
+    @property
+    def reconnecting(self):
+        return bool(self.reconnects)
+
+    # Method to add an outbound connection to the session of the peer
+    def attach(self, connection, ip, port, nickname):
+        sessions = self.chat_app.sessions
+        session = sessions.get(ip, port)
+        if session is None and nickname is not None:
+            session = sessions.by_nickname(nickname, lambda other: other.outbound is None)
+        if session is None or session.outbound is not None:
+            session = sessions.add(Session(nickname or "Unknown", ip, port))
+        elif nickname is not None:
+            session.nickname = nickname
+        session.outbound = connection
+        connection.session = session
+        connection.codec = negotiate(connection.capabilities, self.chat_app.compression, self.chat_app.compression_threshold)
+
+        with self.reconnect_lock:
+            reconnect = self.reconnects.pop((session.ip, session.port), None)
+        if reconnect is not None:
+            self.chat_app.metrics.reconnects += 1
+            self.chat_app.system_message(LANG['reconnected'].format(
+                session.nickname, (time.monotonic() - reconnect[3]) * 1000))
+        self.chat_app.peers.connected(session.ip, session.port, session.nickname)
+        if "seq" in connection.capabilities:
+            self.resume(session)
+        return session
+
+    # Method to check the certificate of a peer against the fingerprint pinned on the first connection
+    def verify_peer(self, ip, port, channel):
+        if channel.resumed:
+            self.chat_app.metrics.tls_resumed += 1
+        else:
+            self.chat_app.metrics.tls_handshakes += 1
+        pinned = self.chat_app.peers.pin(ip, port, channel.peer_fingerprint)
+        if pinned is None:
+            return True
+        self.chat_app.system_message(LANG['tlsFingerprintChanged'].format(ip, port, pinned, channel.peer_fingerprint))
+        return False
+
+    # Method to encrypt an outbound connection whose handshake is done
+    @staticmethod
+    def encrypt(connection, channel):
+        connection.tls = channel
+        connection.reader = TLSReader(connection, channel, connection.reader)
+
+    # Method to announce our stream on a new connection and send everything the peer did not acknowledge
+    def resume(self, session):
+        outbox = self.outboxes.open(session.ip, session.port)
+        with outbox.lock:
+            self.write_all(session, [("stream", outbox.stream)] + outbox.unacknowledged())
+
+    # Method called if the peer acknowledged all chat messages up to seq | Frees the window for waiting messages
+    def acknowledged(self, session, seq):
+        outbox = self.outboxes.get(session.ip, session.port)
+        if outbox is None:
+            return
+        with outbox.lock:
+            messages = outbox.acknowledge(seq)
+            if messages:
+                self.write_all(session, messages)
+
+    # Method to close the outbound connection of one session | Closed sessions are not reconnected
+    def close_session(self, session, keep_outbox=False):
+        with self.reconnect_lock:
+            self.reconnects.pop((session.ip, session.port), None)
+        if not keep_outbox:  # The peer left on purpose, what it did not acknowledge is given up
+            self.outboxes.drop(session.ip, session.port)
+        connection = session.outbound
+        if connection is not None:
+            session.outbound = None  # First, close() waits for queued data while heartbeats keep running
+            connection.close()
+
+    # Method called by Chat App to reset client sockets | Outboxes are kept and sent on the next connection to the peer
+    def stop(self):
+        with self.reconnect_lock:
+            self.reconnects.clear()
+        for session in self.chat_app.sessions:
+            self.close_session(session, True)
+
+    # Method called if the connection to a peer broke without a \b/quit | The peer is reconnected in the background
+    def connection_lost(self, session, connection):
+        if session.outbound is not connection:
+            return  # Already handled or replaced by a new connection
+        connection.close()
+        session.outbound = None
+        self.chat_app.system_message(LANG['peerConnectionLost'].format(session.nickname))
+        if session.inbound is None:
+            self.chat_app.sessions.remove(session)
+        if self.auto_reconnect and session.address_known:
+            self.schedule_reconnect(session.ip, session.port, session.nickname)
+
+    # Method to reconnect to a peer after a growing delay | The jitter keeps peers that lost each other from retrying in lockstep
+    def schedule_reconnect(self, ip, port, nickname, attempt=0):
+        delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        now = time.monotonic()
+        with self.reconnect_lock:
+            lost = self.reconnects.get((ip, str(port)), [None, 0, 0, now])[3]
+            self.reconnects[(ip, str(port))] = [nickname, attempt, now + delay, lost]
+        if attempt == 0:
+            self.chat_app.system_message(LANG['reconnecting'].format(nickname, ip, port))
+
+    # Method called by the transport if a reconnect failed
+    def reconnect_failed(self, ip, port):
+        with self.reconnect_lock:
+            reconnect = self.reconnects.get((ip, str(port)))
+        if reconnect is None:
+            return  # Cancelled in the meantime
+        if reconnect[1] + 1 >= RECONNECT_ATTEMPTS:
+            with self.reconnect_lock:
+                self.reconnects.pop((ip, str(port)), None)
+            self.chat_app.system_message(LANG['reconnectFailed'].format(reconnect[0]))
+            return
+        self.schedule_reconnect(ip, port, reconnect[0], reconnect[1] + 1)
+
+    # Method called regularly by the transport | Sends pings, detects dead peers and starts due reconnects
+    def heartbeat(self):
+        now = time.monotonic()
+        for session in self.chat_app.sessions.connected():
+            connection = session.outbound
+            if connection is None or "heartbeat" not in connection.capabilities:
+                continue
+            if now - connection.last_seen > self.heartbeat_timeout:
+                self.connection_lost(session, connection)
+            elif now - connection.last_ping >= self.heartbeat_interval:
+                connection.last_ping = now
+                self.send_to(session, ("ping", time.perf_counter_ns()))
+
+        with self.reconnect_lock:
+            due = [address for address, reconnect in self.reconnects.items() if 0 < reconnect[2] <= now]
+            for address in due:
+                self.reconnects[address][2] = 0  # Attempt running
+        for ip, port in due:
+            self.reconnect(ip, int(port))
+
+    # Method to handle a message the peer sent back on our connection
+    def handle_reply(self, connection, data):
+        connection.last_seen = time.monotonic()
+        self.chat_app.metrics.messages_in += 1
+        self.chat_app.metrics.bytes_in += len(data)
+        if connection.codec is not None:
+            data = connection.codec.decode(data)
+        try:
+            message = decode(data, connection.binary)
+        except ValueError:
+            return
+        if message[0] == "quit" and connection.session is not None:  # The peer left on purpose
+            session = connection.session
+            self.chat_app.system_message(LANG['peerDisconnected'].format(session.nickname))
+            self.close_session(session)
+            self.chat_app.peers.disconnected(session.ip, session.port)
+            if session.inbound is None:
+                self.chat_app.sessions.remove(session)
+        elif message[0] == "chat" and connection.session is not None:  # A hub sends the room on the same connection
+            self.chat_app.server.dispatch(connection.session, message)
+        elif message[0] == "ack" and connection.session is not None:
+            self.acknowledged(connection.session, message[1])
+        elif message[0] == "pong":
+            rtt = (time.perf_counter_ns() - message[1]) / 1e9
+            connection.rtt = rtt if connection.rtt is None else connection.rtt * 0.8 + rtt * 0.2
+            self.chat_app.metrics.rtt.record(rtt)
+            session = connection.session
+            if session is not None:
+                self.chat_app.peers.seen(session.ip, session.port, connection.rtt)
+
+    # Method to send a message tuple to all connected peers | Returns True if at least one peer received it
+    def send(self, message):
+        sent = False
+        for session in self.chat_app.sessions.connected():
+            sent = self.send_to(session, message) or sent
+        return sent
+
+    # Method to send a chat message to all connected peers | Peers in the mesh get a frame they can relay
+    def broadcast(self, msg, receipt=None):
+        relay = self.chat_app.relay
+        message_id = new_message_id()
+        relay.seen.check(message_id)  # Drop the message when it comes back through the mesh
+        frame = Relay.build_frame(message_id, relay.ttl, self.chat_app.nickname, msg)
+
+        sent = False
+        for session in self.chat_app.sessions.connected():
+            relayed = "relay" in session.outbound.capabilities
+            sent = self.send_to(session, frame if relayed else ("text", msg), True, receipt) or sent
+        return self.queue_offline(frame, receipt) or sent
+
+    # Method to keep a chat message for peers that are not connected now | Sent with the rest of their outbox on resume
+    def queue_offline(self, frame, receipt):
+        connected = {(session.ip, session.port) for session in self.chat_app.sessions.connected()}
+        queued = False
+        for address, outbox in self.outboxes.items():
+            if address in connected:
+                continue
+            with outbox.lock:
+                try:
+                    outbox.push(frame, receipt)
+                    queued = True
+                except (OverflowError, OSError):
+                    pass
+        return queued
+
+    # Method to pass a chat message of the mesh on to all other peers | Returns the number of peers it was sent to
+    def forward(self, source, message_id, ttl, origin, msg):
+        frame = Relay.build_frame(message_id, ttl, origin, msg)
+        forwarded = 0
+        for session in self.chat_app.sessions.connected():
+            if session is not source and "relay" in session.outbound.capabilities:
+                forwarded += self.send_to(session, frame, True)
+        return forwarded
+
+    # Method to send a message only to one peer | Peers without support for direct messages get a plain message
+    def send_direct(self, session, msg, receipt=None):
+        if session.outbound is not None and "direct" in session.outbound.capabilities:
+            return self.send_to(session, ("msg", msg), True, receipt)
+        return self.send_to(session, ("text", msg), True, receipt)
+
+    # Method to send a message tuple to one peer | Reliable messages are numbered and kept until the peer acknowledged them
+    def send_to(self, session, message, reliable=False, receipt=None):
+        if session.outbound is None:
+            return False
+        if reliable and session.outbound.full:  # Refused instead of blocking until a stalled peer reads again
+            self.chat_app.metrics.buffer_full += 1
+            self.chat_app.system_message(LANG['sendBufferFull'].format(session.nickname))
+            if receipt is not None:
+                receipt.fail()
+            return False
+        if not reliable or "seq" not in session.outbound.capabilities:
+            return self.write(session, message)
+
+        outbox = self.outboxes.open(session.ip, session.port)
+        with outbox.lock:
+            try:
+                sequenced = outbox.push(message, receipt)
+            except (OverflowError, OSError) as error:  # OSError if the outbox file can not be written
+                self.chat_app.metrics.send_errors += 1
+                self.chat_app.system_message(LANG['failedSendData'])
+                self.chat_app.system_message(error)
+                return False
+            if sequenced is not None:  # Else it is sent once the peer acknowledged earlier messages
+                self.write(session, sequenced)
+        return True  # Kept in the outbox and sent again after a reconnect even if this write failed
+
+    # Method to write a message tuple to the connection of one peer
+    def write(self, session, message):
+        connection = session.outbound
+        if connection is None:
+            return False
+        metrics = self.chat_app.metrics
+        try:
+            metrics.bytes_out += connection.send_message(message)
+            metrics.messages_out += 1
+            return True
+        except socket.error as error:
+            self.write_failed(connection, error)
+            return False
+
+    # Method to write message tuples to the connection of one peer at once | Used to flush an outbox
+    def write_all(self, session, messages):
+        connection = session.outbound
+        if connection is None:
+            return False
+        metrics = self.chat_app.metrics
+        try:
+            metrics.bytes_out += connection.send_messages(messages)
+            metrics.messages_out += len(messages)
+            return True
+        except socket.error as error:
+            self.write_failed(connection, error)
+            return False
+
+    # Method called if a message could not be written | Also called by the client thread for data that had to wait
+    def write_failed(self, connection, error):
+        self.chat_app.metrics.send_errors += 1
+        self.chat_app.system_message(LANG['failedSendData'])
+        self.chat_app.system_message(error)
+        if connection.session is not None:
+            self.connection_lost(connection.session, connection)
+
+
+class Client(OutboundHandler, threading.Thread):  # Client object is type thread so that it can run simultaneously with the server
+    def __init__(self, chat_app):
+        threading.Thread.__init__(self, daemon=True)
+        OutboundHandler.__init__(self, chat_app)
+        self.stopped = False
+        self.selector = selectors.DefaultSelector()  # Reads what peers send back and writes what the sockets did not take
+        self.pending = []  # Connections to register, only the client thread touches the selector
+        self.writable = collections.deque()  # Connections with data waiting for their socket
+        self.wakeup, self.wakeup_writer = socket.socketpair()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
 
     # Start method called by threading module
     def run(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(5)
+        while not self.stopped:
+            for key, mask in self.selector.select(HEARTBEAT_TICK):
+                if key.data is None:
+                    self.wakeup.recv(1024)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(key.data)
+                if mask & selectors.EVENT_READ and not key.data.closed:
+                    self.receive(key.data)
+
+            # Forget connections closed by other threads first, a new socket may reuse the file descriptor of one
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None and (key.data.session is None or key.data.session.outbound is not key.data):
+                    self.selector.unregister(key.fileobj)
+            while self.pending:
+                connection = self.pending.pop(0)
+                if connection.session is not None and connection.session.outbound is connection:
+                    if not self.receive_early(connection):
+                        continue
+                    try:
+                        self.selector.register(connection.socket, self.events(connection), connection)
+                    except ValueError:
+                        pass  # Closed by another thread right after connecting
+            while self.writable:
+                connection = self.writable.popleft()
+                try:
+                    self.selector.modify(connection.socket, self.events(connection), connection)
+                except (KeyError, ValueError):
+                    pass  # Registered later with the events it needs then, or closed meanwhile
+            self.heartbeat()
+
+        self.selector.close()
+        self.wakeup.close()
+        self.wakeup_writer.close()
+
+    # Selector events of a connection | Writable is only watched while data waits
+    @staticmethod
+    def events(connection):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.queued else 0)
+
+    # Method to send the data waiting on a connection once its socket is writable
+    def flush(self, connection):
+        if connection.flush():
+            return
+        try:
+            self.selector.modify(connection.socket, selectors.EVENT_READ, connection)
+        except (KeyError, ValueError):
+            pass  # The connection failed and was closed
+
+    # Method called from any thread if data has to wait for the socket of a connection
+    def schedule_write(self, connection):
+        self.writable.append(connection)
+        self.wake()
+
+    # Method to handle the messages that came with the init acknowledgement | Returns False if they broke the connection
+    def receive_early(self, connection):
+        messages, connection.received = connection.received, []
+        try:
+            for data in messages:
+                self.handle_reply(connection, data)
+        except (OSError, ValueError):
+            if connection.session is not None:
+                self.connection_lost(connection.session, connection)
+            return False
+        return True
+
+    # Method to read what a peer sent back on our connection
+    def receive(self, connection):
+        try:
+            messages = connection.reader.recv(connection.socket)
+            for data in messages or ():
+                self.handle_reply(connection, data)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except (OSError, ValueError):
+            messages = None
+
+        if messages is None:
+            self.selector.unregister(connection.socket)
+            if connection.session is not None:
+                self.connection_lost(connection.session, connection)
+
+    def attach(self, connection, ip, port, nickname):
+        session = super(Client, self).attach(connection, ip, port, nickname)
+        self.pending.append(connection)
+        self.wake()
+        return session
+
+    def wake(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def stop(self):
+        super(Client, self).stop()
+        self.stopped = True
+        self.wake()
+
+    # Method called by the heartbeat | Connects in the background so heartbeats keep running
+    def reconnect(self, ip, port):
+        threading.Thread(target=self.connect, args=(ip, port, True), daemon=True).start()
 
     def conn(self, args):
 
@@ -22,33 +439,73 @@ class Client(threading.Thread):  # Client object is type thread so that it can r
             self.chat_app.system_message(LANG['nickNotSet'])
             return False
 
-        host = args[0]  # IP of peer
-        port = int(args[1])  # Port of peer
-        self.chat_app.system_message(LANG['connectingToPeer'].format(host, port))
+        return self.connect(args[0], int(args[1]))
 
+    # Method to connect to a peer | Reconnects are quiet and only report success
+    # plain skips TLS, it is set when connecting again after a failed handshake
+    def connect(self, host, port, quiet=False, plain=False):
+        if not quiet:
+            self.chat_app.system_message(LANG['connectingToPeer'].format(host, port))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
         try:
-            self.socket.connect((host, port))
+            sock.connect((host, port))
         except socket.error:
-            self.chat_app.system_message(LANG['failedConnectingTimeout'])
+            sock.close()
+            if quiet:
+                self.reconnect_failed(host, port)
+            else:
+                self.chat_app.system_message(LANG['failedConnectingTimeout'])
             return False
 
-        # Exchange initial information (nickname, ip, port)
-        self.socket.send(f"\b/init {self.chat_app.nickname} {self.chat_app.hostname} {self.chat_app.port}".encode())
-        self.chat_app.system_message(LANG['connected'])
-        self.is_connected = True  # Set connection status to true
-
-    # Method called by Chat App to reset client socket
-    def stop(self):
-        self.socket.close()
-
-    # Method to send data to a peer
-    def send(self, msg):
-        if msg != '':
+        # Encrypt the connection | Reconnects to the same address resume the TLS session instead of a full handshake
+        ip = sock.getpeername()[0]
+        channel = None
+        stream = sock
+        if not plain and self.chat_app.uses_tls(ip, port):
+            channel = self.chat_app.tls.client(f"{ip}:{port}")
+            stream = TLSSocket(sock, channel)
             try:
-                self.socket.send(msg.encode())
-                return True
+                stream.handshake()
             except socket.error as error:
-                self.chat_app.system_message(LANG['failedSentData'])
-                self.chat_app.system_message(error)
-                self.is_connected = False
+                sock.close()
+                if self.chat_app.tls_failed(ip, port):
+                    return self.connect(host, port, quiet, True)
+                if quiet:
+                    self.reconnect_failed(host, port)
+                else:
+                    self.chat_app.system_message(LANG['tlsFailed'].format(host, port))
+                    self.chat_app.system_message(error)
+                return False
+            if not self.verify_peer(ip, port, channel):
+                sock.close()
                 return False
+
+        # Exchange initial information (nickname, ip, port, capabilities)
+        self.chat_app.hostname_resolved.wait()
+        try:
+            stream.sendall(build_init(self.chat_app.nickname, self.chat_app.hostname, self.chat_app.port))
+            capabilities, nickname, rest = receive_init_ack(stream)
+        except socket.error:
+            sock.close()
+            if quiet:
+                self.reconnect_failed(host, port)
+            return False
+        if self.stopped:
+            sock.close()
+            return False
+        set_nodelay(sock, self.tcp_nodelay)
+        connection = QueuedConnection(sock, "framed" in capabilities, capabilities, self.send_buffer_size,
+                                      self.write_failed, self.schedule_write)
+        try:
+            connection.received = connection.reader.feed(rest)  # Frames that came with the ack, e.g. the room of a hub
+        except ValueError:
+            sock.close()
+            return False
+        if channel is not None:
+            self.encrypt(connection, channel)
+        self.attach(connection, ip, port, nickname)
+        if not quiet:
+            self.chat_app.system_message(LANG['connected'])
+        return True
@@ -0,0 +1,95 @@
+import time
+import zlib
+
+try:  # lz4 is optional | Peers only announce it when it is installed
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+CODECS = ["lz4", "zlib"] if lz4 is not None else ["zlib"]  # Announced in the \b/init handshake, preferred first
+RAW, ZLIB, LZ4 = 0, 1, 2  # Flag byte in front of every message of a connection with a negotiated codec
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Same limit as for frames so compressed messages can't exhaust memory
+DECODE_ERRORS = (zlib.error, lz4.block.LZ4BlockError) if lz4 is not None else (zlib.error,)
+SYNC_TAIL = b'\x00\x00\xff\xff'  # Ends every flushed deflate block | Stripped before sending and added on receive
+
+# Preset dictionary of the zlib stream | Protocol words and pasted tracebacks shrink from the first message on
+PRESET = (b"\b/nick \b/quit \b/msg \b/chat \b/syntaxErr "
+          b"Traceback (most recent call last):\n  File \"\", line , in \n    raise Error: Exception: "
+          b"ERROR WARNING INFO DEBUG http://https://www. the and you to is ")
+
+
+class CompressionStats:  # Counters of all connections of the app | Shown by /status
+    def __init__(self):
+        self.raw_bytes = 0  # Size of all sent messages before compression
+        self.wire_bytes = 0  # Size of all sent messages as they were written
+        self.compressed = 0  # Messages that were sent compressed
+        self.compress_time = 0.0  # CPU seconds spent compressing
+        self.decompress_time = 0.0  # CPU seconds spent decompressing
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+
+class Codec:  # Compression state of one connection | Each direction has its own zlib stream
+    def __init__(self, codec, stats, threshold=64):
+        self.codec = codec  # Codec used for sending, messages of the peer may use any codec we announced
+        self.stats = stats
+        self.threshold = threshold  # Messages below this size are sent raw
+        # The zlib streams span the whole connection, so everything sent before works as dictionary
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=PRESET)
+        self.decompressor = zlib.decompressobj(-15, zdict=PRESET)
+
+    # Method to compress one message | Callers have to keep the order of encode() and writes the same
+    def encode(self, data):
+        size = len(data)
+        self.stats.raw_bytes += size
+        if size < self.threshold:
+            self.stats.wire_bytes += size + 1
+            return bytes((RAW,)) + data
+
+        start = time.thread_time()
+        if self.codec == "lz4":
+            payload = bytes((LZ4,)) + lz4.block.compress(data, store_size=True)
+        else:
+            payload = bytes((ZLIB,)) + self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)[:-4]
+        self.stats.compress_time += time.thread_time() - start
+        self.stats.compressed += 1
+        self.stats.wire_bytes += len(payload)
+        return payload
+
+    # Method to restore a received message | Raises ValueError for broken or oversized messages
+    def decode(self, payload):
+        if not payload:
+            raise ValueError("Empty message")
+        flag, data = payload[0], payload[1:]
+        if flag == RAW:
+            return data
+
+        start = time.thread_time()
+        try:
+            if flag == ZLIB:
+                message = self.decompressor.decompress(data + SYNC_TAIL, MAX_MESSAGE_SIZE)
+                if self.decompressor.unconsumed_tail:
+                    raise ValueError(f"Message exceeds {MAX_MESSAGE_SIZE} bytes")
+            elif flag == LZ4 and lz4 is not None:
+                if int.from_bytes(data[:4], 'little') > MAX_MESSAGE_SIZE:
+                    raise ValueError(f"Message exceeds {MAX_MESSAGE_SIZE} bytes")
+                message = lz4.block.decompress(data)
+            else:
+                raise ValueError(f"Unknown codec {flag}")
+        except DECODE_ERRORS as error:
+            raise ValueError(error)
+        finally:
+            self.stats.decompress_time += time.thread_time() - start
+        return message
+
+
+# Method to create the codec of a connection | Returns None if both peers have no codec in common or frames are off
+def negotiate(capabilities, stats, threshold=64):
+    if "framed" not in capabilities:
+        return None
+    for codec in CODECS:
+        if codec in capabilities:
+            return Codec(codec, stats, threshold)
+    return None
@@ -0,0 +1,268 @@
+import struct
+
+BINARY = "bin1"  # Capability of binary control frames | The digit is the version of the format
+SMALL = 0xf8  # Integers below are sent as one byte, above the byte is 0xf7 plus the number of big-endian bytes that follow
+BYTES = [bytes((value,)) for value in range(256)]  # Prebuilt single bytes for frame types and small integers
+# Readers of big-endian integers by byte count | Sizes without a struct format are read with int.from_bytes()
+UNSIGNED = [None, struct.Struct("!B"), struct.Struct("!H"), None, struct.Struct("!I"), None, None, None,
+            struct.Struct("!Q")]
+MASKS = [(1 << 8 * size) - 1 for size in range(9)]  # Keep the last size bytes of 8 bytes read at once
+
+# Messages peers exchange after the handshake | Name -> (frame type, fields)
+# Fields: s text, i unsigned integer, m nested message. Only the last field may be a nested message
+# Integers and the lengths in front of text and nested messages take one byte up to 247, so small chat messages stay small
+COMMANDS = {
+    "text": (0, "s"),  # Plain chat message | Sent without a command to peers that do not support binary frames
+    "nick": (1, "s"),
+    "quit": (2, ""),
+    "msg": (3, "s"),
+    "chat": (4, "siss"),  # Message ID, TTL, origin, message
+    "ping": (5, "i"),
+    "pong": (6, "i"),
+    "stream": (7, "s"),
+    "seq": (8, "im"),
+    "ack": (9, "i"),
+    "syntaxErr": (10, ""),
+    "members": (11, "i"),  # Peers of a hub worker | Only sent from hub workers to their coordinator
+}
+class UnknownCommand(ValueError):  # The peer sent a command or frame type we do not know
+    pass
+
+
+# Method to encode a message tuple like ("ping", 123) for a connection | Binary if both peers support it
+def encode(message, binary=False):
+    return encode_binary(message) if binary else encode_text(message)
+
+
+# Method to decode a received message into a tuple | Raises ValueError for malformed and unknown messages
+def decode(data, binary=False):
+    return decode_binary(data) if binary else decode_text(data)
+
+
+# Method to build a "\b/"-prefixed string command | Plain chat messages stay as they are
+def encode_text(message):
+    if message[0] == "text":
+        return message[1].encode()
+    fields = COMMANDS[message[0]][1]
+    parts = [b"\b/" + message[0].encode()]
+    for kind, value in zip(fields, message[1:]):
+        parts.append(encode_text(value) if kind == "m" else str(value).encode())
+    return b" ".join(parts)
+
+
+# Method to parse a string command | The last field takes the rest, so it may contain spaces
+def decode_text(data):
+    if not data.startswith(b"\b/"):
+        return "text", data.decode(errors='replace')
+    name, separator, rest = data[2:].partition(b" ")
+    name = name.decode(errors='replace')
+    if name not in COMMANDS:
+        raise UnknownCommand(name)
+    fields = COMMANDS[name][1]
+    if not fields:
+        return name,
+    if not separator:
+        raise ValueError(f"{name} needs {len(fields)} arguments")
+    values = rest.split(b" ", len(fields) - 1)
+    if len(values) < len(fields):
+        raise ValueError(f"{name} needs {len(fields)} arguments")
+
+    message = [name]
+    for kind, value in zip(fields, values):
+        if kind == "i":
+            if not value.isdigit():
+                raise ValueError(f"{name} needs a number instead of {value!r}")
+            message.append(int(value))
+        elif kind == "m":
+            message.append(decode_text(value))
+        else:
+            message.append(value.decode(errors='replace'))
+    return tuple(message)
+
+
+# Method to encode an unsigned integer of up to 64 bits | Unlike 7 bit varints it is read with one int.from_bytes()
+def encode_integer(value):
+    if value < SMALL:
+        return BYTES[value]
+    size = (value.bit_length() + 7) // 8
+    if size > 8:
+        raise OverflowError(f"{value} does not fit into 64 bits")
+    return BYTES[SMALL - 1 + size] + value.to_bytes(size, 'big')
+
+
+# Method to build a binary frame | One byte frame type, then the fields with their lengths
+def encode_binary(message):
+    frame_type, fields = COMMANDS[message[0]]
+    parts = [BYTES[frame_type]]
+    for kind, value in zip(fields, message[1:]):
+        if kind == "i":
+            parts.append(BYTES[value] if value < SMALL else encode_integer(value))
+            continue
+        data = encode_binary(value) if kind == "m" else value.encode()
+        size = len(data)
+        parts.append(BYTES[size] if size < SMALL else encode_integer(size))
+        parts.append(data)
+    return b"".join(parts)
+
+
+# Method to read an integer or a length | Returns the value and the offset behind it
+def read_integer(data, offset, end):
+    if offset >= end:
+        raise ValueError("Frame is too short")
+    value = data[offset]
+    if value < SMALL:  # Most integers and lengths fit into one byte
+        return value, offset + 1
+    size = value - (SMALL - 1)
+    stop = offset + 1 + size
+    if stop > end:
+        raise ValueError("Truncated integer")
+    reader = UNSIGNED[size]
+    if reader is None:
+        return int.from_bytes(data[offset + 1:stop], 'big'), stop
+    return reader.unpack_from(data, offset + 1)[0], stop
+
+
+# Method to read a text field | Returns the text and the offset behind it
+def read_text(data, offset, end):
+    size, offset = read_integer(data, offset, end)
+    stop = offset + size
+    if stop > end:
+        raise ValueError(f"Field of {size} bytes exceeds the frame")
+    return str(data[offset:stop], 'utf-8', 'replace'), stop
+
+
+def check_end(name, offset, end):
+    if offset != end:
+        raise ValueError(f"{name} frame has {end - offset} bytes too many")
+
+
+# Decoders of the field layouts in COMMANDS | Built once per frame type, so decoding does not walk the field list
+def empty_decoder(name):
+    message = (name,)
+
+    def decode(_data, offset, end):
+        check_end(name, offset, end)
+        return message
+    return decode
+
+
+def integer_decoder(name):
+    def decode(data, offset, end):
+        size = end - offset
+        if size == 1 and data[offset] < SMALL:  # E.g. acknowledgements of the first 247 messages
+            return name, data[offset]
+        if size > 1 and data[offset] == SMALL - 2 + size:  # Size byte and integer fill the frame, e.g. heartbeat timestamps
+            reader = UNSIGNED[size - 1]
+            if reader is not None:
+                return name, reader.unpack_from(data, offset + 1)[0]
+            if end >= 8:  # 3, 5, 6 or 7 bytes | Read the 8 bytes ending with the integer and drop the ones in front
+                return name, UNSIGNED[8].unpack_from(data, end - 8)[0] & MASKS[size - 1]
+            return name, int.from_bytes(data[offset + 1:end], 'big')
+        value, offset = read_integer(data, offset, end)
+        check_end(name, offset, end)
+        return name, value
+    return decode
+
+
+def text_decoder(name):
+    def decode(data, offset, end):
+        if offset < end and data[offset] < SMALL and offset + 1 + data[offset] == end:  # Texts up to 247 bytes
+            return name, str(data[offset + 1:end], 'utf-8', 'replace')
+        value, offset = read_text(data, offset, end)
+        check_end(name, offset, end)
+        return name, value
+    return decode
+
+
+def chat_decoder(name):
+    def decode(data, offset, end):
+        # Message ID, TTL and origin are short, their lengths are read inline | Every offset is checked by the last one
+        start = offset
+        try:
+            size = data[offset]
+            ttl = data[offset + 1 + size]
+            origin_size = data[offset + 2 + size]
+            if size < SMALL and ttl < SMALL and origin_size < SMALL:
+                message_id = str(data[offset + 1:offset + 1 + size], 'utf-8', 'replace')
+                offset += 3 + size
+                origin = str(data[offset:offset + origin_size], 'utf-8', 'replace')
+                offset += origin_size
+                size = data[offset]
+                if size < SMALL and offset + 1 + size == end:
+                    return name, message_id, ttl, origin, str(data[offset + 1:end], 'utf-8', 'replace')
+                msg, offset = read_text(data, offset, end)
+                if offset == end:
+                    return name, message_id, ttl, origin, msg
+        except IndexError:
+            pass
+        return slow_decode(data, start, end)
+
+    def slow_decode(data, offset, end):
+        message_id, offset = read_text(data, offset, end)
+        ttl, offset = read_integer(data, offset, end)
+        origin, offset = read_text(data, offset, end)
+        msg, offset = read_text(data, offset, end)
+        check_end(name, offset, end)
+        return name, message_id, ttl, origin, msg
+    return decode
+
+
+def nested_decoder(name):
+    def decode(data, offset, end):
+        value = data[offset] if offset < end else SMALL
+        if value < SMALL:
+            offset += 1
+        else:
+            value, offset = read_integer(data, offset, end)
+        size, offset = read_integer(data, offset, end)
+        stop = offset + size
+        if stop != end:
+            raise ValueError(f"Nested message of {size} bytes does not end the {name} frame")
+        return name, value, decode_frame(data, offset, stop)
+    return decode
+
+
+# Decoder for layouts without one of their own | Walks the fields one by one
+def generic_decoder(name, fields):
+    def decode(data, offset, end):
+        message = [name]
+        for kind in fields:
+            if kind == "i":
+                value, offset = read_integer(data, offset, end)
+            elif kind == "s":
+                value, offset = read_text(data, offset, end)
+            else:
+                size, offset = read_integer(data, offset, end)
+                if offset + size > end:
+                    raise ValueError(f"Field of {size} bytes exceeds the frame")
+                value, offset = decode_frame(data, offset, offset + size), offset + size
+            message.append(value)
+        check_end(name, offset, end)
+        return tuple(message)
+    return decode
+
+
+LAYOUTS = {"": empty_decoder, "i": integer_decoder, "s": text_decoder, "siss": chat_decoder, "im": nested_decoder}
+DECODERS = [None] * 256  # Frame type -> decoder | A list is the fastest lookup for a byte
+for _name, (_frame_type, _fields) in COMMANDS.items():
+    DECODERS[_frame_type] = LAYOUTS[_fields](_name) if _fields in LAYOUTS else generic_decoder(_name, _fields)
+
+
+# Method to read a frame between two offsets of a buffer | Nested messages are read in place instead of copied
+def decode_frame(data, offset, end):
+    if offset >= end:
+        raise ValueError("Empty frame")
+    decoder = DECODERS[data[offset]]
+    if decoder is None:
+        raise UnknownCommand(f"frame type {data[offset]}")
+    return decoder(data, offset + 1, end)
+
+
+# Method to read a binary frame from bytes or a memoryview | Text is decoded from slices of it
+def decode_binary(data):
+    if not data:
+        raise ValueError("Empty frame")
+    decoder = DECODERS[data[0]]
+    if decoder is None:
+        raise UnknownCommand(f"frame type {data[0]}")
+    return decoder(data, 1, len(data))
@@ -0,0 +1,59 @@
+import datetime
+import signal
+import sys
+import threading
+
+from src.settings import LANG
+
+
+class Daemon:  # Headless frontend of the ChatEngine | Prints events to stdout and reads commands from stdin
+    def __init__(self, engine, output=sys.stdout, read_input=True):
+        self.engine = engine
+        self.output = output
+        self.read_input = read_input  # Set to False when stdin is not meant for commands
+        self.lock = threading.Lock()  # Events arrive from server, client and journal threads
+        self.stopped = threading.Event()
+
+        engine.on('system', lambda msg: self.print(f"[{LANG['interface']['system']}] {msg}"))
+        engine.on('message', self.peer_message)
+        engine.on('sent', self.sent_message)
+        engine.on('output', lambda text: self.print('> ' + text.rstrip('\n')))
+        engine.on('exit', self.stopped.set)
+
+    def print(self, line):
+        with self.lock:
+            self.output.write(f"{datetime.datetime.now():%H:%M:%S} {line}\n")
+            self.output.flush()
+
+    def peer_message(self, nickname, msg, direct):
+        if direct:
+            self.print("{0} > {1} >  {2}".format(nickname, LANG['you'], msg))
+        else:
+            self.print("{0} >  {1}".format(nickname, msg))
+
+    def sent_message(self, msg, nickname, _receipt=None):
+        if nickname is not None:
+            self.print("{0} > {1} > {2}".format(LANG['you'], nickname, msg))
+        else:
+            self.print(LANG['you'] + " > " + msg)
+
+    # Method to pass every line of stdin to the engine | Commands and messages work like in the curses frontend
+    def read_stdin(self):
+        for line in sys.stdin:
+            self.engine.input(line.rstrip('\n'))
+            if self.stopped.is_set():
+                break
+
+    # Method to run the daemon until /quit, SIGINT or SIGTERM
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda _signum, _frame: self.stopped.set())
+
+        self.engine.start()
+        if self.read_input and sys.stdin is not None:
+            threading.Thread(target=self.read_stdin, daemon=True).start()
+
+        while not self.stopped.wait(0.5):  # Wake up regularly so signals are handled
+            pass
+
+        self.engine.stop()
@@ -0,0 +1,210 @@
+import json
+import random
+import socket
+import threading
+import time
+
+from src.relay import new_message_id
+
+DISCOVERY_GROUP = "239.255.70.83"  # Organization-local multicast group, routers of the segment do not forward it
+DISCOVERY_PORT = 3332
+PACKET_PREFIX = b"p2p-chat/1 "  # Packets of other programs on the group are ignored
+MAX_PACKET = 1024
+MAX_NICKNAME = 64
+ANNOUNCE_INTERVAL = 30  # Seconds between two announcements of a node on a small segment
+SEGMENT_RATE = 5  # Announcements per second of all nodes together | The interval grows with the directory
+MIN_ANNOUNCE_GAP = 1  # Seconds between two announcements of a node, answers and changes included
+QUERY_ANSWERS = 20  # Answers a query gets on average however many nodes hear it
+ANSWER_DELAY = 1  # Seconds queries and answers are spread over | Queries heard meanwhile suppress our own
+EXPIRY_FACTOR = 3  # Announcements a peer may miss before it expires
+MAX_TTL = 3600
+TICK = 0.25  # Seconds the thread waits for packets before it checks its timers
+
+
+class DiscoveredPeer:  # Entry of the directory | Expires unless the peer announces itself again
+    def __init__(self, nickname, ip, port, capabilities, ttl):
+        self.nickname = nickname
+        self.ip = ip  # Source address of the announcement, no DNS involved
+        self.port = port
+        self.capabilities = capabilities
+        self.seen = time.monotonic()
+        self.expires = self.seen + ttl
+
+
+class Discovery(threading.Thread):  # Announces this node on the LAN over UDP multicast | Keeps a directory of the peers it hears
+    def __init__(self, nickname, port, capabilities, discovery_port=DISCOVERY_PORT, interface="0.0.0.0",
+                 on_address=None):
+        super(Discovery, self).__init__(daemon=True)
+        self.id = new_message_id()  # Tells our own looped back packets and instances on one host apart
+        self.nickname = nickname
+        self.port = port
+        self.capabilities = capabilities
+        self.discovery_port = discovery_port
+        self.interface = interface  # Address of the interface to join the group on | 0.0.0.0 lets the system choose
+        self.on_address = on_address  # Called with our address once our first announcement came back
+        self.address = None
+        self.peers = {}  # Instance ID -> DiscoveredPeer
+        self.lock = threading.Lock()
+        self.socket = None
+        self.stopped = False
+        self.sent = 0
+        self.received = 0
+
+        now = time.monotonic()
+        self.last_announce = 0
+        self.next_announce = now + random.uniform(0, ANSWER_DELAY)
+        self.query_at = now + random.uniform(0, ANSWER_DELAY)  # New nodes ask for the others once
+        self.answer_at = None
+
+    # Method to open the multicast socket | Raises OSError if the interface can not join the group
+    def open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            # Several instances on one host share the port, each of them gets every packet of the group
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("", self.discovery_port))
+            interface = socket.inet_aton(self.interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(DISCOVERY_GROUP) + interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # Stays on the segment
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # Instances on this host hear us
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(TICK)
+        self.socket = sock
+
+    def run(self):
+        while not self.stopped:
+            try:
+                data, address = self.socket.recvfrom(MAX_PACKET)
+            except socket.timeout:
+                data = None
+            except OSError:
+                if self.stopped:
+                    break
+                time.sleep(TICK)
+                continue
+            if data:
+                self.receive(data, address[0])
+            self.tick()
+
+    # Method to send what is due | Announcements, the query of a new node and answers to queries of others
+    def tick(self):
+        now = time.monotonic()
+        if self.query_at is not None and now >= self.query_at:
+            self.query_at = None
+            self.send({"type": "query"})
+        if self.answer_at is not None and now >= self.answer_at:
+            self.answer_at = None
+            self.announce()
+        elif now >= self.next_announce:
+            self.announce()
+
+    # Seconds between two announcements | All nodes together stay below SEGMENT_RATE announcements per second
+    @property
+    def interval(self):
+        return max(ANNOUNCE_INTERVAL, (len(self.entries()) + 1) / SEGMENT_RATE)
+
+    def announce(self):
+        now = time.monotonic()
+        if now - self.last_announce < MIN_ANNOUNCE_GAP:
+            self.next_announce = self.last_announce + MIN_ANNOUNCE_GAP
+            return
+        interval = self.interval
+        self.last_announce = now
+        self.next_announce = now + interval * random.uniform(0.8, 1.2)  # Nodes started together drift apart
+        self.send({"type": "announce", "nick": self.nickname, "port": self.port, "caps": self.capabilities,
+                   "ttl": round(interval * 1.2 * EXPIRY_FACTOR)})
+
+    def send(self, packet):
+        packet["id"] = self.id
+        data = PACKET_PREFIX + json.dumps(packet, separators=(',', ':')).encode()
+        if len(data) > MAX_PACKET:  # Only a very long capability list gets here
+            packet["caps"] = []
+            data = PACKET_PREFIX + json.dumps(packet, separators=(',', ':')).encode()
+        try:
+            self.socket.sendto(data, (DISCOVERY_GROUP, self.discovery_port))
+            self.sent += 1
+        except OSError:  # No route right now, e.g. the network is down | The next announcement tries again
+            pass
+
+    # Method to handle a packet of the group | Malformed packets are dropped
+    def receive(self, data, ip):
+        if not data.startswith(PACKET_PREFIX):
+            return
+        try:
+            packet = json.loads(data[len(PACKET_PREFIX):])
+        except ValueError:
+            return
+        if not isinstance(packet, dict) or not isinstance(packet.get("id"), str):
+            return
+        self.received += 1
+        kind = packet.get("type")
+        if packet["id"] == self.id:
+            if kind == "announce" and self.address is None:
+                self.address = ip
+                if self.on_address is not None:
+                    self.on_address(ip)
+            return
+
+        if kind == "query":
+            # Another node asked | Its answers reach us as well, and only some of the nodes answer
+            self.query_at = None
+            if self.answer_at is None and random.random() < QUERY_ANSWERS / (len(self.peers) + 1):
+                self.answer_at = time.monotonic() + random.uniform(0, ANSWER_DELAY)
+        elif kind == "announce":
+            nickname, port, ttl = packet.get("nick"), packet.get("port"), packet.get("ttl")
+            capabilities = packet.get("caps")
+            if not isinstance(nickname, str) or not 0 < len(nickname) <= MAX_NICKNAME or ' ' in nickname:
+                return
+            if not isinstance(port, int) or not 0 < port < 65536 or not isinstance(ttl, (int, float)) or ttl <= 0:
+                return
+            if not isinstance(capabilities, list):
+                capabilities = []
+            peer = DiscoveredPeer(nickname, ip, port, [str(capability) for capability in capabilities],
+                                  min(ttl, MAX_TTL))
+            with self.lock:
+                self.peers[packet["id"]] = peer
+        elif kind == "bye":
+            with self.lock:
+                self.peers.pop(packet["id"], None)
+
+    # Method to announce a new nickname or port right away | Still limited to one announcement per MIN_ANNOUNCE_GAP
+    def changed(self, nickname=None, port=None):
+        if nickname is not None:
+            self.nickname = nickname
+        if port is not None:
+            self.port = port
+        self.next_announce = time.monotonic()
+
+    # Method to get the peers that did not expire, sorted by nickname | Expired peers are removed here
+    def entries(self):
+        now = time.monotonic()
+        with self.lock:
+            for node in [node for node, peer in self.peers.items() if peer.expires <= now]:
+                del self.peers[node]
+            peers = list(self.peers.values())
+        return sorted(peers, key=lambda peer: (peer.nickname.lower(), peer.ip, peer.port))
+
+    # Method to look up a peer by nickname | The most recently heard one wins if several share it
+    def find(self, nickname):
+        peers = [peer for peer in self.entries() if peer.nickname == nickname]
+        return max(peers, key=lambda peer: peer.seen) if peers else None
+
+    # Method to look up a peer by the address it accepts connections on
+    def find_address(self, ip, port):
+        peers = [peer for peer in self.entries() if peer.ip == ip and peer.port == port]
+        return max(peers, key=lambda peer: peer.seen) if peers else None
+
+    # Method to leave the group | Peers drop us from their directories right away instead of waiting for the expiry
+    def stop(self):
+        if self.socket is None:
+            return
+        self.stopped = True
+        self.send({"type": "bye"})
+        if self.is_alive():
+            self.join(TICK * 4)
+        self.socket.close()
@@ -0,0 +1,616 @@
+import datetime
+import getpass
+import os
+import socket
+import sys
+import threading
+import time
+from io import StringIO
+
+from src.client import Client
+from src.compression import CODECS, CompressionStats
+from src.discovery import DISCOVERY_PORT, Discovery
+from src.journal import Journal
+from src.metrics import Metrics, MetricsExporter
+from src.outbox import SEND_WINDOW, OutboxStore, Receipt
+from src.peers import PeerCache
+from src.protocol import CAPABILITIES
+from src.relay import DEFAULT_TTL, Relay
+from src.search import SearchIndex, tokenize
+from src.server import Server, create_listener
+from src.session import SessionRegistry
+from src.settings import BASE_DIR, LANG, change_lang, change_settings, get_setting
+from src.startup import PROFILE
+from src.tls import TLS
+from src.transfer import FileSender, FileSource, format_size
+
+
+# Method to get the login name of the user | os.getlogin() fails without a controlling terminal
+def default_nickname():
+    try:
+        return os.getlogin()
+    except OSError:
+        return getpass.getuser()
+
+
+class ChatEngine:  # Peer state, command dispatch and chat log of the app without any user interface
+    # Events a frontend can subscribe to with on()
+    #   system(msg)                   | Information for the user
+    #   message(nickname, msg, direct) | Chat message of a peer
+    #   sent(msg, nickname, receipt)  | Chat message we sent. nickname is set for direct messages
+    #   receipt(receipt)              | A sent message was acknowledged by all peers or given up
+    #   output(text)                  | Output of /eval
+    #   clear()                       | The user asked to clear the chat feed
+    #   exit()                        | The engine stopped after /quit
+    #   status()                      | /status was printed, frontends may add their own lines
+    def __init__(self, port=3333, nickname=None, hostname=None, transport=None, log=True, peer_cache=True):
+        self.port = port  # Port the server runs on
+        self.nickname = nickname if nickname is not None else default_nickname()
+        self.hostname = hostname  # Resolved in the background on start() if not given
+        self.hostname_resolved = threading.Event()  # Connects wait for it, the handshake contains the hostname
+        self.transport = transport or get_setting('transport', 'threads')  # "threads" or "asyncio"
+        self.sessions = SessionRegistry()  # One session per connected peer
+        self.relay = Relay(get_setting('relay_ttl', DEFAULT_TTL))  # Message IDs and counters of the gossip mesh
+        self.compression = CompressionStats()  # Counters of all compressed connections
+        self.metrics = Metrics()  # Traffic counters and latency histograms shown by /stats
+        self.exporter = None
+        self.compression_threshold = get_setting('compression_threshold', 64)  # Smaller messages are sent raw
+        self.listeners = {}  # Event name -> list of callbacks
+        self.download_dir = BASE_DIR / get_setting('download_dir', 'downloads')  # Received files are saved here
+        self.transfers = []  # File senders of this run
+        self.peers = PeerCache(BASE_DIR / 'peers.json' if peer_cache else None)  # Known peers, reconnected on start
+        # Messages peers did not acknowledge, in files so restarts and the next run still deliver them
+        self.outboxes = OutboxStore(BASE_DIR / get_setting('outbox_dir', 'outbox') if peer_cache else None,
+                                    get_setting('send_window', SEND_WINDOW), self.outbox_failed)
+        self.tls = None  # Certificate and TLS sessions | Created on start() if TLS is enabled
+        self.tls_fallback = get_setting('tls_fallback', False)  # Connect unencrypted if the TLS handshake of a peer fails
+        self.discovery = None  # Announcements and directory of the peers on the LAN | Started on start() if enabled
+        self.discovery_enabled = get_setting('discovery', False)
+        self.discovery_interface = get_setting('discovery_interface', '0.0.0.0')  # Interface to announce on
+        self.discovery_port = get_setting('discovery_port', DISCOVERY_PORT)
+        self.server = None
+        self.client = None
+        self.running = False
+
+        # Chat log written in the background | Lines are batched, segments rotate daily and get compressed
+        self.journal = None
+        if log:
+            self.journal = Journal(BASE_DIR / get_setting('log_dir', 'logs'), on_error=self.journal_failed)
+
+        # Inverted index of all chat messages for /search | Built from the chat log on the first start
+        self.search_index = None
+        if log:
+            self.search_index = SearchIndex(BASE_DIR / get_setting('search_dir', 'search'), self.journal.directory)
+
+        # Dictionary for commands. Includes function to call and number of needed arguments
+        self.commands = {
+            "connect": [self.connect, -1],
+            "msg": [self.direct_message, -1],
+            "send": [self.send_file, -1],
+            "disconnect": [self.restart, 0],
+            "nickname": [self.set_nickname, 1],
+            "quit": [self.exit, 0],
+            "port": [self.restart, 1],
+            "connectback": [self.connect_back, 0],
+            "clear": [self.clear_chat, 0],
+            "eval": [self.eval_code, -1],
+            "status": [self.get_status, 0],
+            "peers": [self.list_peers, 0],
+            "stats": [self.get_stats, 0],
+            "log": [self.log_chat, 0],
+            "search": [self.search, -1],
+            "help": [self.help_command, 0],
+            "lang": [self.change_lang, 1]
+        }
+
+        # Dictionary for command aliases
+        self.commands_alias = {
+            "nick": "nickname",
+            "conn": "connect",
+            "q": "quit",
+            "connback": "connectback"
+        }
+
+    # Method to subscribe to an event of the engine
+    def on(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.listeners.get(event, ()):
+            callback(*args)
+
+    # Method to start the journal, server and client
+    def start(self):
+        self.running = True
+        if self.journal is not None:
+            self.journal.start()
+        if self.search_index is not None:  # Loading millions of messages must not delay the start
+            threading.Thread(target=self.load_search_index, daemon=True).start()
+        self.start_exporter()
+        self.outboxes.start()
+
+        # Get these PCs public IP in the background | Slow DNS must not keep the interface from starting
+        if self.hostname is None:
+            threading.Thread(target=self.resolve_hostname, daemon=True).start()
+        else:
+            self.hostname_resolved.set()
+
+        self.start_tls()
+        self.start_threads()
+        self.start_discovery()
+        self.system_message(LANG['nicknameInfo'].format(self.nickname))
+
+        # Reconnect to the peers we were connected to when the app was closed
+        if self.client.auto_reconnect:
+            for peer in self.peers.reconnectable():
+                self.client.schedule_reconnect(peer["ip"], peer["port"], peer["nickname"])
+
+        PROFILE.mark('engine')
+        if PROFILE.enabled:
+            self.system_message(LANG['startupProfile'].format(PROFILE.total * 1000))
+            for name, seconds in PROFILE.phases:
+                self.system_message(LANG['startupPhase'].format(name, seconds * 1000))
+
+    def resolve_hostname(self):
+        start = time.perf_counter()
+        try:
+            hostname = socket.gethostbyname(socket.gethostname())
+        except socket.error:
+            self.system_message(LANG['noInternetAccess'])
+            self.system_message(LANG['failedFetchPublicIP'])
+            hostname = "0.0.0.0"
+        if self.hostname_resolved.is_set():  # The discovery was faster and knows the address the LAN sees
+            return
+        self.hostname = hostname
+        self.hostname_resolved.set()
+        if PROFILE.enabled:
+            self.system_message(LANG['startupHostname'].format(self.hostname, (time.perf_counter() - start) * 1000))
+
+    # Method to announce this node on the LAN and hear the announcements of others if enabled in settings.json
+    def start_discovery(self):
+        if not self.discovery_enabled:
+            return
+        capabilities = CAPABILITIES + (["tls"] if self.tls is not None else [])
+        discovery = Discovery(self.nickname, self.port, capabilities, self.discovery_port, self.discovery_interface,
+                              self.discovered_address)
+        try:
+            discovery.open()
+        except OSError as error:  # E.g. no interface that can join the group | Connecting by address still works
+            self.system_message(LANG['discoveryUnavailable'])
+            self.system_message(error)
+            return
+        discovery.start()
+        self.discovery = discovery
+
+    # Method to take the source address of our own announcement as hostname | It is the address peers on the LAN see
+    def discovered_address(self, ip):
+        if self.hostname_resolved.is_set() and self.hostname != "0.0.0.0" and not self.hostname.startswith("127."):
+            return  # DNS found an address that is not the loopback one many hosts map their name to
+        self.hostname = ip
+        self.hostname_resolved.set()
+
+    # Method to publish the metrics for Prometheus if a file or socket is set in settings.json
+    def start_exporter(self):
+        path, socket_path = get_setting('metrics_file'), get_setting('metrics_socket')
+        if path is None and socket_path is None:
+            return
+        try:
+            self.exporter = MetricsExporter(self.metrics, path, socket_path, get_setting('metrics_interval', 10))
+        except (OSError, AttributeError) as error:  # AttributeError if the platform has no Unix sockets
+            self.system_message(LANG['failedExportMetrics'])
+            self.system_message(error)
+            return
+        self.exporter.start()
+
+    # Method to load the certificate, or to create one on the first start | Without it peers are connected unencrypted
+    def start_tls(self):
+        if not get_setting('tls', False):
+            return
+        try:
+            self.tls = TLS(BASE_DIR / get_setting('tls_dir', 'tls'))
+        except (OSError, ValueError) as error:  # ssl.SSLError is an OSError as well
+            self.system_message(LANG['tlsUnavailable'])
+            self.system_message(error)
+
+    # Method to decide whether a connection to a peer starts with a TLS handshake
+    # Peers with a pinned certificate always do | Only peers the LAN directory lists without "tls" are connected unencrypted
+    def uses_tls(self, ip, port):
+        if self.tls is None:
+            return False
+        if self.peers.fingerprint(ip, port) is not None:
+            return True
+        peer = self.discovery.find_address(ip, int(port)) if self.discovery is not None else None
+        return peer is None or "tls" in peer.capabilities
+
+    # Method called after a failed TLS handshake | Returns True if the peer may be connected unencrypted instead
+    # An attacker can break any handshake, so this needs tls_fallback and is never done for a pinned peer
+    def tls_failed(self, ip, port):
+        if not self.tls_fallback or self.peers.fingerprint(ip, port) is not None:
+            return False
+        self.system_message(LANG['tlsFallback'].format(ip, port))
+        return True
+
+    # Method to open the listening socket of the server | Returns None if the port can not be used
+    def bind(self, port):
+        try:
+            return create_listener("", port)
+        except OSError as error:
+            self.system_message(LANG['failedBindPort'].format(port))
+            self.system_message(error)
+            return None
+
+    # Start Server and Client | The asyncio transport runs both on one shared event loop instead of two threads
+    def start_threads(self, listener=None):
+        if listener is None:
+            listener = self.bind(self.port)
+        if self.transport == "asyncio":
+            from src.aio import AsyncClient, AsyncServer  # asyncio takes longer to import than the rest of the app
+            self.server = AsyncServer(self, listener)
+            self.client = AsyncClient(self)
+        else:
+            self.server = Server(self, listener)
+            self.server.daemon = True
+            self.client = Client(self)
+        self.server.start()
+        self.client.start()
+
+    # Method to stop server, client and journal without leaving the process
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.client.is_connected:
+            self.client.send(("quit",))
+        for transfer in self.transfers:
+            transfer.stop()
+        self.server.say_goodbye()
+        self.client.stop()
+        self.server.stop()
+        if self.discovery is not None:
+            self.discovery.stop()
+        self.peers.save()
+        self.outboxes.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+        if self.journal is not None:
+            self.journal.stop()
+        if self.search_index is not None:
+            self.search_index.close()
+
+    # Method to handle a line typed by the user | Lines starting with / are commands, all others are chat messages
+    def input(self, msg):
+        if msg == "":
+            return False
+
+        if msg.startswith('/'):
+            self.log(LANG['you'] + " > " + msg)
+            self.handle_command(msg)
+        else:
+            self.send(msg)
+
+    # Method to send a chat message to all connected peers | Peers that are not connected get it with their outbox later
+    def send(self, msg):
+        if not self.client.is_connected and not self.client.reconnecting and not len(self.outboxes):
+            self.system_message(LANG['notConnected'])
+            return False
+        receipt = Receipt(lambda changed: self.emit('receipt', changed))
+        if self.client.broadcast(msg, receipt):
+            if not self.client.is_connected:
+                self.system_message(LANG['queuedOffline'])
+            self.log(LANG['you'] + " > " + msg)
+            self.index_message(self.nickname, msg)
+            receipt.announce(lambda announced: self.emit('sent', msg, None, announced))
+            return True
+        return False
+
+    # Method to write a line to the chat log
+    def log(self, line):
+        if self.journal is not None:
+            self.journal.write(line)
+
+    # Method to add a chat message to the search index
+    def index_message(self, nickname, msg):
+        if self.search_index is not None:
+            self.search_index.add(nickname, msg)
+
+    def load_search_index(self):
+        try:
+            self.search_index.load(LANG['you'], self.nickname)
+        except OSError as error:
+            self.system_message(LANG['failedSearchIndex'])
+            self.system_message(error)
+
+    # Method to inform the user
+    def system_message(self, msg):
+        self.log(f"[{LANG['interface']['system']}] {msg}")
+        self.emit('system', str(msg))
+
+    # Method called by the server for every chat message of a peer
+    def peer_message(self, session, msg, direct=False, origin=None):
+        nickname = origin or session.nickname
+        if direct:
+            self.log("{0} > {1} >  {2}".format(nickname, LANG['you'], msg))
+        else:
+            self.log("{0} >  {1}".format(nickname, msg))
+        self.index_message(nickname, msg)
+        self.emit('message', nickname, msg, direct)
+
+    # Method to change interface language. Files need to be located in lang/
+    def change_lang(self, args):
+        self.system_message(LANG['changingLang'].format(args[0]))
+
+        try:
+            change_lang(args[0])
+        except Exception as e:
+            self.system_message(LANG['failedChangingLang'])
+            self.system_message(e)
+            return False
+
+        change_settings('language', args[0])
+
+    # Method to reset server and client sockets | The port is listened on all the time, a new port is bound before the old one is closed
+    def restart(self, args=None):
+        self.system_message(LANG['restarting'])
+
+        port = self.port if args is None else int(args[0])
+        listener = self.server.listener
+        if port != self.port or listener is None:
+            listener = self.bind(port)
+            if listener is None:  # Keep running on the old port
+                return False
+        if port != self.port and self.discovery is not None:
+            self.discovery.changed(port=port)
+        self.port = port
+
+        if self.client.is_connected:
+            self.client.send(("quit",))  # Closing the connections waits until it was sent
+
+        self.server.say_goodbye()
+        self.client.stop()
+        self.server.stop(close_listener=listener is not self.server.listener)
+        self.sessions.clear()
+        self.peers.disconnect_all()
+
+        self.start_threads(listener)
+
+    # Method to set nickname of client | Nickname will be sent to peer for identification
+    def set_nickname(self, args):
+        self.nickname = args[0]
+        self.system_message("{0}".format(LANG['setNickname'].format(args[0])))
+        if self.client.is_connected:
+            self.client.send(("nick", args[0]))
+        if self.discovery is not None:
+            self.discovery.changed(nickname=args[0])
+
+    # Method to connect to a peer by host and port or by a nickname of /peers | The client is looked up on every call
+    def connect(self, args):
+        args = args.split()
+        if len(args) == 1:
+            if self.discovery is None:  # Nicknames are only known from the LAN directory
+                self.system_message(LANG['discoveryOff'])
+                return False
+            peer = self.discovery.find(args[0])
+            if peer is None:
+                self.system_message(LANG['peerNotDiscovered'].format(args[0]))
+                return False
+            args = [peer.ip, peer.port]
+        elif len(args) != 2:
+            self.system_message(LANG['commandWrongSyntax'].format("connect", 2, len(args)))
+            return False
+        self.client.conn(args)
+
+    # Method to print the peers of the LAN directory | Nothing is looked up, the entries are the last announcements
+    def list_peers(self):
+        if self.discovery is None:
+            self.system_message(LANG['discoveryOff'])
+            return False
+        peers = self.discovery.entries()
+        if not peers:
+            self.system_message(LANG['peersNone'])
+            return
+        now = time.monotonic()
+        self.system_message(LANG['peersList'].format(len(peers)))
+        for peer in peers:
+            session = self.sessions.get(peer.ip, peer.port)
+            self.system_message(LANG['peersEntry'].format(
+                peer.nickname, peer.ip, peer.port, now - peer.seen,
+                session is not None and session.outbound is not None, "tls" in peer.capabilities))
+
+    # Method to connect to all peers that connected to the server but we are not connected to
+    def connect_back(self):
+        sessions = [session for session in self.sessions if session.inbound is not None and session.outbound is None]
+        if not sessions:
+            self.system_message(LANG['alreadyConnected'])
+            return False
+
+        for session in sessions:
+            if not session.address_known:
+                self.system_message(LANG['failedConnectPeerUnknown'])
+                continue
+            self.client.conn([session.ip, int(session.port)])
+
+    # Method to send a message to only one peer | The first word of the arguments is the nickname of the peer
+    def direct_message(self, args):
+        nickname, _sep, msg = args.partition(' ')
+        if msg == "":
+            self.system_message(LANG['commandWrongSyntax'].format("msg", 2, 1 if nickname else 0))
+            return False
+
+        session = self.sessions.by_nickname(nickname, lambda other: other.outbound is not None)
+        if session is None:
+            self.system_message(LANG['peerNotFound'].format(nickname))
+            return False
+
+        receipt = Receipt(lambda changed: self.emit('receipt', changed))
+        if self.client.send_direct(session, msg, receipt):
+            self.log("{0} > {1} > {2}".format(LANG['you'], nickname, msg))
+            self.index_message(self.nickname, msg)
+            receipt.announce(lambda announced: self.emit('sent', msg, nickname, announced))
+
+    # Method to send a file to all connected peers | Every transfer runs on its own connection
+    def send_file(self, path):
+        path = os.path.expanduser(path.strip())
+        if not os.path.isfile(path):
+            self.system_message(LANG['fileNotFound'].format(path))
+            return False
+        if not self.client.is_connected:
+            self.system_message(LANG['notConnected'])
+            return False
+
+        source = FileSource(path)
+        self.transfers = [transfer for transfer in self.transfers if transfer.is_alive()]
+        for session in self.sessions.connected():
+            if "file" not in session.outbound.capabilities:
+                self.system_message(LANG['fileNotSupported'].format(session.nickname))
+                continue
+            transfer = FileSender(self, source, session.ip, int(session.port), session.nickname)
+            self.transfers.append(transfer)
+            transfer.start()
+
+    # Method to write the chat log to disk now | Files can be found in the log directory
+    def log_chat(self):
+        if self.journal is None:
+            return False
+        self.journal.flush()
+        self.system_message(LANG['savedLog'].format(self.journal.directory))
+
+    # Method to find chat messages | Words must all occur, from:nickname and since:YYYY-MM-DD narrow the search
+    def search(self, args):
+        terms, nickname, since = [], None, None
+        for word in args.split():
+            if word.lower().startswith("from:"):
+                nickname = word[5:] or None
+            elif word.lower().startswith("since:"):
+                try:
+                    since = int(datetime.datetime.strptime(word[6:], "%Y-%m-%d").timestamp())
+                except ValueError:
+                    self.system_message(LANG['searchInvalidDate'].format(word[6:]))
+                    return False
+            else:
+                terms += tokenize(word)
+        if not terms and nickname is None:
+            self.system_message(LANG['searchUsage'])
+            return False
+        if self.search_index is None:
+            return False
+
+        start = time.perf_counter()
+        found = self.search_index.search(terms, nickname, since)
+        if found is None:
+            self.system_message(LANG['searchLoading'])
+            return False
+        count, results = found
+        for timestamp, sender, text in results:
+            self.system_message(LANG['searchResult'].format(f"{timestamp:%Y-%m-%d %H:%M}", sender, text))
+        self.system_message(LANG['searchFound'].format(count, len(self.search_index), (time.perf_counter() - start) * 1000))
+
+    # Method called if an outbox could not be read or written
+    def outbox_failed(self, error):
+        self.system_message(LANG['failedOutbox'])
+        self.system_message(error)
+
+    # Method called by the journal if the log could not be written
+    def journal_failed(self, error):
+        self.system_message(LANG['failedSaveLog'])
+        self.system_message(error)
+
+    # Method to ask the frontend to clear the chat feed
+    def clear_chat(self):
+        self.emit('clear')
+
+    # Method to run python code inside the app | Useful to print app vars
+    def eval_code(self, code):
+        default_std_out = sys.stdout
+        redirected_std_out = sys.stdout = StringIO()
+        try:
+            exec(code)
+        except Exception as e:
+            self.system_message(e)
+        finally:
+            sys.stdout = default_std_out
+        self.emit('output', redirected_std_out.getvalue())
+
+    # Method to exit the app | Exit command will be sent to a connected peer so that they can disconnect their sockets
+    def exit(self):
+        self.system_message(LANG['exitApp'])
+        self.stop()
+        self.emit('exit')
+
+    # Method to handle commands
+    def handle_command(self, msg):
+        if msg.startswith("/eval"):
+            args = msg[6:]
+            self.eval_code(args)
+            return True
+
+        msg = msg.split(' ')
+        command = msg[0][1:]
+        args = msg[1:]
+        if command in self.commands_alias:
+            command = self.commands_alias[command]
+
+        if self.commands.get(command) is not None:
+            if self.commands[command][1] == 0:
+                self.commands[command][0]()
+            elif self.commands[command][1] == -1:
+                self.commands[command][0](' '.join(args))
+            elif len(args) == self.commands[command][1]:
+                self.commands[command][0](args)
+            else:
+                self.system_message(LANG['commandWrongSyntax'].format(command, self.commands[command][1], len(args)))
+        else:
+            self.system_message(LANG['commandNotFound'])
+
+    # Method to print a list of all commands
+    def help_command(self):
+        self.system_message(LANG['commandList'])
+
+        for command in self.commands:
+            if not LANG['commands'][command] == "":
+                self.system_message(LANG['commands'][command])
+
+    # Method to print traffic counters and latency percentiles
+    def get_stats(self):
+        metrics = self.metrics
+        self.system_message(LANG['statsTraffic'].format(
+            metrics.messages_in, format_size(metrics.bytes_in), metrics.messages_out, format_size(metrics.bytes_out),
+            metrics.send_errors, metrics.reconnects, metrics.buffer_full))
+        for key, histogram in (('statsRtt', metrics.rtt), ('statsDispatch', metrics.dispatch),
+                               ('statsRender', metrics.render)):
+            self.system_message(LANG[key].format(histogram.count, *[
+                "-" if value is None else f"{value * 1000:.2f} ms"
+                for value in (histogram.percentile(50), histogram.percentile(90), histogram.percentile(99),
+                              histogram.max if histogram.count else None)]))
+        if self.tls is not None:
+            self.system_message(LANG['statsTls'].format(metrics.tls_handshakes, metrics.tls_resumed, self.tls.fingerprint))
+
+    # Method to print the status of server and client
+    def get_status(self):
+        self.system_message("STATUS:")
+        server_status = bool(self.server)
+        client_status = bool(self.client)
+
+        self.system_message(
+            LANG['serverStatusMessage'].format(server_status, self.port, self.server.has_connection))
+        self.system_message(LANG['clientStatusMessage'].format(client_status, self.client.is_connected))
+
+        for session in self.sessions:
+            outbound = session.outbound
+            rtt = outbound.rtt if outbound is not None else None
+            self.system_message(LANG['sessionStatusMessage'].format(
+                session.nickname, session.ip, session.port, session.inbound is not None, outbound is not None,
+                "-" if rtt is None else f"{rtt * 1000:.1f} ms",
+                "-" if outbound is None else format_size(outbound.queued) + (" (!)" if outbound.full else "")))
+
+        self.system_message(LANG['relayStatusMessage'].format(
+            self.relay.delivered, self.relay.forwarded, self.relay.duplicates, len(self.relay.seen)))
+
+        compression = self.compression
+        self.system_message(LANG['compressionStatusMessage'].format(
+            ", ".join(CODECS), compression.compressed, compression.raw_bytes, compression.wire_bytes,
+            compression.ratio, compression.compress_time * 1000, compression.decompress_time * 1000))
+
+        if not self.nickname == "":
+            self.system_message(LANG['nicknameStatusMessage'].format(self.nickname))
+
+        self.emit('status')
@@ -7,8 +7,10 @@ from .settings import LANG
 class ChatForm(npyscreen.FormBaseNew):
     def create(self):
         self.y, self.x = self.useable_space()
+        self.keypress_timeout = 1  # Call while_waiting every 0.1 seconds without input
         self.feed = self.add(npyscreen.BoxTitle, name=LANG['interface']['feed'], editable=False,
                              max_height=self.y - 7)
+        self.feed_height = self.y - 9  # Lines visible inside the box of the feed
         self.input = self.add(ChatInput, name=LANG['interface']['input'], footer=LANG['interface']['footer'],
                               rely=self.y - 5)
         self.input.entry_widget.handlers.update({curses.ascii.CR: self.parentApp.send_message})
@@ -16,12 +18,18 @@ class ChatForm(npyscreen.FormBaseNew):
         self.input.entry_widget.handlers.update({curses.KEY_UP: self.parentApp.history_back})
         self.input.entry_widget.handlers.update({curses.KEY_DOWN: self.parentApp.history_forward})
         self.input.entry_widget.handlers.update({curses.KEY_DOWN: self.parentApp.history_forward})
+        self.input.entry_widget.handlers.update({curses.KEY_PPAGE: self.parentApp.scroll_up})
+        self.input.entry_widget.handlers.update({curses.KEY_NPAGE: self.parentApp.scroll_down})
 
         handlers = {
             "^V": self.parentApp.paste_from_clipboard
         }
         self.add_handlers(handlers)
 
+    # Method called by npyscreen while no key is pressed | Draws queued feed updates
+    def while_waiting(self):
+        self.parentApp.renderer.tick()
+
 
 class ChatInput(npyscreen.BoxTitle):
     _contained_widget = npyscreen.MultiLineEdit
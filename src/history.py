@@ -0,0 +1,52 @@
+import bisect
+
+LAST_CHARACTER = "\U0010ffff"  # Sorts behind every character a line can contain
+
+
+class InputHistory:  # Lines the user typed | Up steps back through the earlier lines that start with the typed text
+    def __init__(self):
+        self.lines = []  # In the order they were typed
+        self.sorted = []  # (line, position) sorted by line, so all lines with a prefix are one slice
+        self.matches = None  # Positions of the lines of the current walk, oldest first | None while not walking
+        self.index = 0  # Position in matches of the shown line
+        self.prefix = ""  # Text typed before the walk started | Shown again when walking past the newest line
+        self.shown = None  # Line shown last | Typing something else starts a new walk
+
+    def add(self, line):
+        self.matches = None
+        if self.lines and self.lines[-1] == line:
+            return
+        bisect.insort(self.sorted, (line, len(self.lines)))
+        self.lines.append(line)
+
+    # Method to find the lines that start with a prefix | Only the newest position of a repeated line is kept
+    def find(self, prefix):
+        start = bisect.bisect_left(self.sorted, (prefix,))
+        end = bisect.bisect_left(self.sorted, (prefix + LAST_CHARACTER,))
+        newest = {}
+        for line, position in self.sorted[start:end]:
+            newest[line] = position  # Equal lines are sorted by position, the last one wins
+        return sorted(newest.values())
+
+    # Method to get the previous line starting with the typed text | Returns None if there is none
+    def back(self, current):
+        if self.matches is None or current != self.shown:
+            self.prefix = current
+            self.matches = self.find(current)
+            self.index = len(self.matches)
+        if self.index == 0:
+            return None
+        self.index -= 1
+        self.shown = self.lines[self.matches[self.index]]
+        return self.shown
+
+    # Method to get the next line of the walk | Returns the typed text behind the newest line, None if not walking
+    def forward(self, current):
+        if self.matches is None or current != self.shown:
+            return None
+        self.index += 1
+        if self.index >= len(self.matches):
+            self.matches = None
+            return self.prefix
+        self.shown = self.lines[self.matches[self.index]]
+        return self.shown
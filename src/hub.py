@@ -0,0 +1,308 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from src.aio import AsyncClient, AsyncServer
+from src.control import COMMANDS, encode, encode_binary, decode_binary
+from src.discovery import DISCOVERY_PORT, Discovery
+from src.engine import ChatEngine
+from src.protocol import CAPABILITIES, FrameReader, RECV_SIZE, encode_frame
+from src.relay import new_message_id
+from src.server import create_listener
+from src.session import QueuedConnection
+from src.settings import BASE_DIR, LANG, get_setting
+from src.tls import TLS
+
+STATS_INTERVAL = 5  # Seconds between two lines of hub statistics
+MEMBERS_INTERVAL = 1  # Seconds between two reports of a worker to the coordinator
+BACKLOG = 1024  # Connections the kernel queues per worker | Thousands of peers reconnect at once after a restart
+MEMBERS_TYPE = COMMANDS["members"][0]  # First byte of member reports, every other frame is a chat message
+WORKER_BUFFER_SIZE = 16 * 1024 * 1024  # Bytes queued for a worker before it misses messages
+STOP_TIMEOUT = 2  # Seconds stop() waits for the coordinator thread
+
+
+class HubServer(AsyncServer):  # Server of one hub worker | Shares the port with the other workers and their messages through the coordinator
+    def __init__(self, chat_app, socket_path):
+        try:
+            listener = create_listener("", chat_app.port, reuse_port=True, backlog=BACKLOG)
+        except OSError as error:
+            chat_app.system_message(error)
+            listener = None
+        super(HubServer, self).__init__(chat_app, listener)
+        self.socket_path = socket_path
+        self.coordinator = None  # Stream writer of the Unix socket to the coordinator
+        self.dropped = 0  # Messages not sent to peers whose send buffer was full
+
+    async def listen(self):
+        if self.listener is None:
+            return
+        try:
+            reader, self.coordinator = await asyncio.open_unix_connection(self.socket_path)
+            self.server = await asyncio.start_server(self.serve, sock=self.listener.dup())
+        except OSError as error:
+            self.chat_app.system_message(error)
+            return
+        self.loop_thread.loop.create_task(self.receive_room(reader))
+        self.loop_thread.loop.create_task(self.report_members())
+
+    # Coroutine reading the messages that peers of the other workers sent
+    async def receive_room(self, reader):
+        frames = FrameReader()
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return  # The coordinator stopped, the worker is terminated next
+            for frame in frames.feed(data):
+                self.deliver(None, decode_binary(frame))
+
+    async def report_members(self):
+        while True:
+            members = sum(session.inbound is not None for session in self.chat_app.sessions)
+            self.coordinator.write(encode_frame(encode_binary(("members", members))))
+            await asyncio.sleep(MEMBERS_INTERVAL)
+
+    # Method to send a chat message to the peers of this worker and to the other workers
+    def publish(self, source, message_id, origin, msg):
+        message = ("chat", message_id, 0, origin, msg)  # TTL 0, the hub already reaches everyone in the room
+        self.deliver(source, message)
+        if self.coordinator is not None:
+            self.coordinator.write(encode_frame(encode_binary(message)))
+
+    # Method to send a message to all peers of this worker except its author | Encoded once per format, not per peer
+    def deliver(self, source, message):
+        encoded = {}
+        for session in self.chat_app.sessions:
+            connection = session.inbound
+            if session is source or connection is None:
+                continue
+            if connection.full:  # A stalled peer must not hold up the room
+                self.dropped += 1
+                continue
+            binary = connection.binary
+            if binary not in encoded:
+                encoded[binary] = encode(message, binary)
+            try:
+                connection.send_data(encoded[binary])
+            except OSError:
+                pass
+
+    def plain_message(self, session, msg):
+        self.publish(session, new_message_id(), session.nickname, msg)
+
+    def relay_message(self, session, message_id, ttl, origin, msg):
+        if not self.chat_app.relay.seen.check(message_id):
+            self.publish(session, message_id, origin, msg)
+
+    def direct_message(self, session, msg):
+        pass  # Nobody reads messages sent to the hub itself
+
+
+class HubNode(ChatEngine):  # Headless engine of one hub worker process
+    def __init__(self, port, nickname, socket_path):
+        super(HubNode, self).__init__(port, nickname, None, "asyncio", log=False, peer_cache=False)
+        self.socket_path = socket_path
+        self.discovery_enabled = False  # The main process announces the hub once for all workers
+
+    def start_threads(self, _listener=None):  # Every worker binds the port itself with SO_REUSEPORT
+        self.server = HubServer(self, self.socket_path)
+        self.client = AsyncClient(self)
+        self.server.start()
+        self.client.start()
+
+    def start_exporter(self):
+        pass  # Workers would overwrite each other's metrics file
+
+
+# Method run in every worker process
+def run_worker(port, nickname, socket_path):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The main process stops the workers
+    HubNode(port, nickname, socket_path).start()
+    threading.Event().wait()
+
+
+class Coordinator(threading.Thread):  # Passes chat messages between the hub workers over a Unix socket | Runs in the main process
+    def __init__(self, path):
+        super(Coordinator, self).__init__(daemon=True)
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.wakeup, self.wakeup_writer = socket.socketpair()  # stop() writes to it so the thread leaves select() at once
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.workers = {}  # Connection of a worker -> number of peers it reported
+        self.messages = 0  # Chat messages published by the peers of all workers
+        self.dropped = 0  # Messages a worker missed because it read too slowly
+        self.stopped = False
+
+    @property
+    def members(self):
+        return sum(self.workers.values())
+
+    # Start method called by threading module
+    def run(self):
+        while not self.stopped:
+            for key, mask in self.selector.select(1):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(1024)
+                    continue
+                if key.data is None:
+                    conn, _addr = self.listener.accept()
+                    worker = QueuedConnection(conn, True, limit=WORKER_BUFFER_SIZE, on_error=self.worker_failed,
+                                              on_pending=self.schedule_write)
+                    self.workers[worker] = 0
+                    self.selector.register(conn, selectors.EVENT_READ, worker)
+                    continue
+                if mask & selectors.EVENT_WRITE and not key.data.flush() and not key.data.closed:
+                    self.selector.modify(key.fileobj, selectors.EVENT_READ, key.data)
+                if mask & selectors.EVENT_READ and not key.data.closed:
+                    self.receive(key.data)
+        for worker in list(self.workers):
+            worker.socket.close()
+        self.selector.close()
+        self.wakeup.close()
+
+    def receive(self, worker):
+        try:
+            messages = worker.reader.recv(worker.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError):
+            messages = None
+        if messages is None:
+            self.remove(worker)
+            return
+
+        for frame in messages:
+            if frame[0] == MEMBERS_TYPE:
+                self.workers[worker] = decode_binary(frame)[1]
+                continue
+            self.messages += 1
+            data = encode_frame(frame)  # Forwarded as it is, the workers decode it
+            for other in list(self.workers):
+                if other is worker or other.closed:
+                    continue
+                if other.full:  # A stalled worker must not hold up the others
+                    self.dropped += 1
+                    continue
+                try:
+                    other.write_raw(data)
+                except OSError:
+                    self.remove(other)
+
+    # Method called by the coordinator thread if data has to wait for the socket of a worker
+    def schedule_write(self, worker):
+        try:
+            self.selector.modify(worker.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, worker)
+        except (KeyError, ValueError):
+            pass  # Removed meanwhile
+
+    def worker_failed(self, worker, _error):
+        self.remove(worker)
+
+    def remove(self, worker):
+        try:
+            self.selector.unregister(worker.socket)
+        except (KeyError, ValueError):
+            pass
+        self.workers.pop(worker, None)
+        worker.fail()
+        worker.socket.close()
+
+    # Method to stop the coordinator | The thread closes the worker sockets once it left select()
+    def stop(self):
+        self.stopped = True
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+        if self.is_alive():
+            self.join(STOP_TIMEOUT)
+        self.wakeup_writer.close()
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Hub:  # One node many peers connect to | N worker processes share the port with SO_REUSEPORT
+    def __init__(self, port=3333, workers=None, nickname="hub", output=sys.stdout):
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.nickname = nickname
+        self.output = output
+        self.stopped = threading.Event()
+
+    def print(self, line):
+        self.output.write(f"{datetime.datetime.now():%H:%M:%S} {line}\n")
+        self.output.flush()
+
+    # Method to run the hub until SIGINT or SIGTERM
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            self.print(LANG['hubUnsupported'])
+            return False
+
+        capabilities = CAPABILITIES + ["hub"]
+        if get_setting('tls', False):  # Created once here, the workers would race to create the certificate
+            try:
+                TLS(BASE_DIR / get_setting('tls_dir', 'tls'))
+                capabilities = capabilities + ["tls"]
+            except (OSError, ValueError) as error:
+                self.print(LANG['tlsUnavailable'])
+                self.print(error)
+
+        path = os.path.join(tempfile.gettempdir(), f"p2p-chat-hub-{self.port}.sock")
+        if os.path.exists(path):
+            os.unlink(path)
+        coordinator = Coordinator(path)
+
+        # Workers are forked before the main process starts any thread
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_worker, args=(self.port, self.nickname, path), daemon=True)
+                     for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+        coordinator.start()
+        self.print(LANG['hubStarted'].format(self.workers, self.port))
+
+        discovery = None
+        if get_setting('discovery', False):
+            discovery = Discovery(self.nickname, self.port, capabilities, get_setting('discovery_port', DISCOVERY_PORT),
+                                  get_setting('discovery_interface', '0.0.0.0'))
+            try:
+                discovery.open()
+                discovery.start()
+            except OSError as error:
+                self.print(LANG['discoveryUnavailable'])
+                self.print(error)
+                discovery = None
+
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda _signum, _frame: self.stopped.set())
+        last_count, last_time = 0, time.monotonic()
+        while not self.stopped.wait(STATS_INTERVAL):
+            now = time.monotonic()
+            count = coordinator.messages
+            self.print(LANG['hubStats'].format(coordinator.members, len(coordinator.workers),
+                                               (count - last_count) / (now - last_time), coordinator.dropped))
+            last_count, last_time = count, now
+
+        if discovery is not None:
+            discovery.stop()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        coordinator.stop()
+        return True
@@ -0,0 +1,129 @@
+import datetime
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+
+LOG_PREFIX = "p2p-chat-log_"
+DATE_FORMAT = "%m-%d-%Y"
+
+_FLUSH = object()  # Queue marker for a forced flush
+_STOP = object()  # Queue marker to flush and end the writer thread
+
+
+class Journal(threading.Thread):  # Append-only chat log written by its own thread so disk I/O never blocks the UI
+    def __init__(self, directory, flush_lines=256, flush_interval=1.0, max_bytes=16 * 1024 * 1024, on_error=None):
+        super(Journal, self).__init__(daemon=True)
+        self.directory = Path(directory)
+        self.flush_lines = flush_lines  # Write once this many lines are queued
+        self.flush_interval = flush_interval  # Or once the oldest queued line is this many seconds old
+        self.max_bytes = max_bytes  # Size at which the current segment is closed and compressed
+        self.on_error = on_error  # Called with the exception if the log can not be written
+        self.queue = queue.Queue()
+        self.file = None
+        self.date = None
+        self.failed = False
+
+    # Path of the segment that is currently written
+    @property
+    def path(self):
+        return self.directory / f"{LOG_PREFIX}{self.date}.log"
+
+    # Method to queue a line for the log | Returns immediately
+    def write(self, line):
+        self.queue.put(f"[{datetime.datetime.now():%Y-%m-%d %H:%M:%S}] {line}\n")
+
+    # Method to write all queued lines without waiting for a threshold | Returns immediately
+    def flush(self):
+        self.queue.put(_FLUSH)
+
+    # Method to write all queued lines and end the thread
+    def stop(self, timeout=2):
+        self.queue.put(_STOP)
+        if self.is_alive():
+            self.join(timeout)
+
+    # Start method called by threading module
+    def run(self):
+        self.compress_old_segments()
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = _FLUSH
+
+            if isinstance(item, str):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.flush_lines:
+                    continue
+
+            self.write_batch(batch)
+            batch = []
+            deadline = None
+            if item is _STOP:
+                break
+
+        if self.file is not None:
+            self.file.close()
+
+    # Method to append a batch of lines with a single write
+    def write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            self.rotate_if_needed()
+            self.file.write(''.join(batch))
+            self.file.flush()
+            self.failed = False
+        except OSError as error:
+            if not self.failed and self.on_error is not None:
+                self.on_error(error)  # Only report the first of a series of failures
+            self.failed = True
+
+    # Method to start a new segment at midnight or once the current one is too large
+    def rotate_if_needed(self):
+        date = datetime.datetime.now().strftime(DATE_FORMAT)
+        if self.file is not None and date == self.date and self.file.tell() < self.max_bytes:
+            return
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.archive(self.path)
+
+        self.date = date
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    # Method to move a closed segment aside and compress it
+    def archive(self, path):
+        number = 1
+        while True:
+            target = path.with_name(f"{path.stem}.{number}.log.gz")
+            if not target.exists():
+                break
+            number += 1
+        with open(path, "rb") as source, gzip.open(target, "wb") as compressed:
+            shutil.copyfileobj(source, compressed)
+        os.remove(path)
+
+    # Method to compress segments of earlier days left behind by a previous session
+    def compress_old_segments(self):
+        today = f"{LOG_PREFIX}{datetime.datetime.now().strftime(DATE_FORMAT)}.log"
+        if not self.directory.is_dir():
+            return
+        for path in self.directory.glob(f"{LOG_PREFIX}*.log"):
+            if path.name != today and path.stem.count('.') == 0:
+                try:
+                    self.archive(path)
+                except OSError as error:
+                    if self.on_error is not None:
+                        self.on_error(error)
@@ -0,0 +1,156 @@
+import os
+import socket
+import threading
+
+SUB_BUCKET_BITS = 6  # 64 buckets per power of two | Values are kept with about 1.5% precision
+UNIT = 1e-6  # Histograms count microseconds
+
+
+class Histogram:  # HDR-style histogram | Log-linear buckets keep memory constant and percentiles exact to the bucket width
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0.0  # Sum of all values in seconds
+        self.max = 0.0
+
+    # Method to map a value in microseconds to its bucket
+    @staticmethod
+    def bucket(value):
+        if value < 2 << SUB_BUCKET_BITS:
+            return value
+        shift = value.bit_length() - SUB_BUCKET_BITS - 1
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+    # Method to get the highest value of a bucket in microseconds
+    @staticmethod
+    def bucket_value(index):
+        if index < 2 << SUB_BUCKET_BITS:
+            return index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        mantissa = index - (shift << SUB_BUCKET_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    # Method to add one value in seconds
+    def record(self, seconds):
+        index = self.bucket(max(0, int(seconds / UNIT)))
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Method to get a percentile in seconds | Returns None if nothing was recorded
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_value(index) * UNIT, self.max)
+        return self.max
+
+
+class Metrics:  # Counters and histograms of one app | Server and client write, /stats and the exporter read
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.send_errors = 0
+        self.reconnects = 0
+        self.buffer_full = 0  # Chat messages refused because a peer did not read fast enough
+        self.tls_handshakes = 0  # Full TLS handshakes of our client
+        self.tls_resumed = 0  # TLS handshakes that resumed an earlier session
+        self.rtt = Histogram()  # Round trip time of heartbeats
+        self.dispatch = Histogram()  # Time to handle a command of a peer
+        self.render = Histogram()  # Time to draw the chat feed
+
+    # Method to format all metrics in the Prometheus text format
+    def prometheus(self):
+        lines = []
+        for name, value, description in (
+                ("messages_received_total", self.messages_in, "Messages received from peers"),
+                ("bytes_received_total", self.bytes_in, "Bytes received from peers"),
+                ("messages_sent_total", self.messages_out, "Messages sent to peers"),
+                ("bytes_sent_total", self.bytes_out, "Bytes sent to peers"),
+                ("send_errors_total", self.send_errors, "Messages that could not be sent"),
+                ("reconnects_total", self.reconnects, "Successful automatic reconnects"),
+                ("send_buffer_full_total", self.buffer_full, "Chat messages refused because the send buffer was full"),
+                ("tls_handshakes_total", self.tls_handshakes, "Full TLS handshakes"),
+                ("tls_resumed_total", self.tls_resumed, "TLS handshakes that resumed a session")):
+            lines += [f"# HELP p2p_chat_{name} {description}", f"# TYPE p2p_chat_{name} counter",
+                      f"p2p_chat_{name} {value}"]
+
+        for name, histogram, description in (
+                ("rtt_seconds", self.rtt, "Round trip time of heartbeats"),
+                ("dispatch_seconds", self.dispatch, "Time to handle a command of a peer"),
+                ("render_seconds", self.render, "Time to draw the chat feed")):
+            lines += [f"# HELP p2p_chat_{name} {description}", f"# TYPE p2p_chat_{name} summary"]
+            for quantile in (0.5, 0.9, 0.99):
+                value = histogram.percentile(quantile * 100)
+                lines.append(f'p2p_chat_{name}{{quantile="{quantile}"}} {"NaN" if value is None else f"{value:.6f}"}')
+            lines += [f"p2p_chat_{name}_sum {histogram.total:.6f}", f"p2p_chat_{name}_count {histogram.count}"]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(threading.Thread):  # Publishes the metrics for Prometheus as a file, a Unix socket or both
+    def __init__(self, metrics, path=None, socket_path=None, interval=10):
+        super(MetricsExporter, self).__init__(daemon=True)
+        self.metrics = metrics
+        self.path = path  # File rewritten every interval seconds, e.g. for the textfile collector of node_exporter
+        self.socket_path = socket_path  # Unix socket answering every connection with the current metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.server = None
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(socket_path)
+            self.server.listen()
+            threading.Thread(target=self.serve, daemon=True).start()
+
+    # Start method called by threading module
+    def run(self):
+        while self.path is not None and not self.stopped.is_set():
+            self.write()
+            self.stopped.wait(self.interval)
+
+    # Method to replace the metrics file at once so a scraper never reads half a file
+    def write(self):
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, 'w') as file:
+                file.write(self.metrics.prometheus())
+            os.replace(temporary, self.path)
+        except OSError:
+            pass
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _addr = self.server.accept()
+            except OSError:
+                return  # Closed by stop()
+            try:
+                conn.sendall(self.metrics.prometheus().encode())
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.path is not None:
+            self.write()
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
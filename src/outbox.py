@@ -0,0 +1,507 @@
+import collections
+import json
+import os
+import threading
+from pathlib import Path
+
+from src.relay import new_message_id
+
+SEND_WINDOW = 256  # Messages that may be unacknowledged at once
+OUTBOX_LIMIT = 4096  # Messages kept per peer while the window is full or the peer reconnects
+DISK_OUTBOX_LIMIT = 1000000  # Messages kept per peer if the outbox is a file | Only the window is held in memory
+OUTBOX_SUFFIX = ".outbox"
+COMPACT_BYTES = 1024 * 1024  # Read records after which the file is rewritten without the acknowledged ones
+SYNC_INTERVAL = 0.2  # Seconds between two fsyncs of an outbox with new records
+STREAM_CACHE_SIZE = 1024  # Streams of peers the server remembers to drop resent messages
+STREAMS_FILE = "streams.log"  # Last delivered sequence number of every stream, next to the outboxes
+
+
+class Receipt:  # Delivery state of one message we sent | Delivered once every peer acknowledged it
+    PENDING, DELIVERED, FAILED = "pending", "delivered", "failed"
+
+    def __init__(self, on_change=None):
+        self.lock = threading.Lock()
+        self.on_change = on_change  # Called with the receipt when the state changed after announce()
+        self.outstanding = 0  # Peers that did not acknowledge the message yet
+        self.tracked = False  # Set if at least one peer acknowledges messages
+        self.announced = False
+        self.state = Receipt.PENDING
+
+    def add(self):
+        with self.lock:
+            self.outstanding += 1
+            self.tracked = True
+
+    # Method called once the message is shown | Changes before are reported by the state at that time
+    def announce(self, callback):
+        with self.lock:
+            self.announced = True
+            if self.tracked and not self.outstanding and self.state == Receipt.PENDING:
+                self.state = Receipt.DELIVERED
+            callback(self)  # Holding the lock keeps acknowledgements from overtaking the announcement
+
+    def acknowledge(self):
+        with self.lock:
+            self.outstanding -= 1
+            if self.outstanding or self.state != Receipt.PENDING or not self.announced:
+                return
+            self.state = Receipt.DELIVERED
+            if self.on_change is not None:
+                self.on_change(self)
+
+    def fail(self):
+        with self.lock:
+            if self.state != Receipt.PENDING:
+                return
+            self.state = Receipt.FAILED
+            if self.announced and self.on_change is not None:
+                self.on_change(self)
+
+
+class Outbox:  # Chat messages to one peer until it acknowledged them | Survives reconnects of the same client
+    def __init__(self, window=SEND_WINDOW, limit=OUTBOX_LIMIT):
+        self.stream = new_message_id()  # Lets the peer tell our resent messages from new ones
+        self.window = window
+        self.limit = limit
+        self.next_seq = 1
+        self.acked = 0  # Highest sequence number the peer acknowledged
+        self.in_flight = collections.deque()  # (seq, message, receipt) sent but not acknowledged
+        self.backlog = collections.deque()  # (seq, message, receipt) waiting for room in the window
+        self.lock = threading.RLock()  # Held while sending so sequence numbers go out in order
+
+    # Messages waiting for room in the window
+    @property
+    def waiting(self):
+        return len(self.backlog)
+
+    # Messages the peer did not acknowledge yet
+    @property
+    def pending(self):
+        return len(self.in_flight) + self.waiting
+
+    # Method to number a message | Returns the seq message to send now or None if it waits in the backlog
+    def push(self, message, receipt=None):
+        if self.pending >= self.limit:
+            raise OverflowError("Outbox is full")
+        entry = (self.next_seq, ("seq", self.next_seq, message), receipt)
+        self.next_seq += 1
+        if receipt is not None:
+            receipt.add()
+        if len(self.in_flight) < self.window and not self.waiting:
+            self.in_flight.append(entry)
+            return entry[1]
+        self.wait(entry)
+        return None
+
+    def wait(self, entry):
+        self.backlog.append(entry)
+
+    # Method to get the next count waiting entries in order
+    def take(self, count):
+        return [self.backlog.popleft() for _ in range(min(count, len(self.backlog)))]
+
+    # Method to handle a cumulative acknowledgement | Returns the messages that fit into the window now
+    def acknowledge(self, seq):
+        self.acked = max(self.acked, seq)
+        receipts = []
+        while self.in_flight and self.in_flight[0][0] <= seq:
+            receipts.append(self.in_flight.popleft()[2])
+        for receipt in receipts:
+            if receipt is not None:
+                receipt.acknowledge()
+        return self.refill()
+
+    def refill(self):
+        entries = self.take(self.window - len(self.in_flight))
+        self.in_flight.extend(entries)
+        return [entry[1] for entry in entries]
+
+    # Method to get everything to send again on a new connection
+    def unacknowledged(self):
+        return [entry[1] for entry in self.in_flight] + self.refill()
+
+    # Method to give up all messages, e.g. if the peer left on purpose
+    def drop(self):
+        for _seq, _message, receipt in list(self.in_flight) + list(self.backlog):
+            if receipt is not None:
+                receipt.fail()
+        self.in_flight.clear()
+        self.backlog.clear()
+
+    # Method to write what the outbox keeps to disk | Outboxes in memory have nothing to write
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DiskOutbox(Outbox):  # Outbox in an append-only file | Waiting messages are read back only when the window has room
+    def __init__(self, path, ip, port, window=SEND_WINDOW):
+        super(DiskOutbox, self).__init__(window, DISK_OUTBOX_LIMIT)
+        self.path = path
+        self.ip = ip
+        self.port = str(port)
+        self.receipts = {}  # seq -> receipt of a waiting message | The messages themselves stay in the file
+        self.on_disk = 0  # Messages waiting in the file
+        self.header_size = 0
+        self.read_offset = 0  # Offset of the first record that was not taken into the window yet
+        self.size = 0
+        self.file = None
+        self.dirty = False  # Set if records were written since the last fsync
+        if path.exists():
+            self.load()
+        else:
+            self.rewrite([])
+
+    @property
+    def waiting(self):
+        return self.on_disk
+
+    # Method to read an outbox of an earlier run | Everything that was not acknowledged waits to be sent again
+    def load(self):
+        with open(self.path, 'rb') as file:
+            header = json.loads(file.readline())
+            self.stream, self.acked, self.next_seq = header["stream"], header["acked"], header["next"]
+            end = self.header_size = file.tell()
+            for line in file:  # Records are [seq, message] or [acknowledged seq]
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    break  # Torn by a crash while writing, everything behind it is lost
+                if len(record) == 1:
+                    self.acked = max(self.acked, record[0])
+                else:
+                    self.next_seq = max(self.next_seq, record[0] + 1)
+                end += len(line)
+        self.file = open(self.path, 'r+b')
+        self.file.truncate(end)
+        self.size = end
+        self.on_disk = self.next_seq - 1 - self.acked
+        self.compact()
+
+    # Method to start the file again with only the records of unacknowledged messages
+    def compact(self):
+        self.file.seek(self.header_size)
+        self.rewrite(self.file)
+
+    # Method to replace the file by a header and the unacknowledged records | The old file stays until the new one is complete
+    def rewrite(self, lines):
+        taken = self.in_flight[-1][0] if self.in_flight else self.acked  # Records up to it were read into the window
+        header = {"stream": self.stream, "ip": self.ip, "port": self.port, "acked": self.acked, "next": self.next_seq}
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, 'wb') as file:
+            file.write(json.dumps(header).encode() + b"\n")
+            header_size = read_offset = file.tell()
+            for line in lines:
+                record = json.loads(line)
+                if len(record) == 2 and record[0] > self.acked:
+                    file.write(line)
+                    if record[0] <= taken:
+                        read_offset = file.tell()
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        if self.file is not None:
+            self.file.close()  # Windows can not replace an open file
+        try:
+            os.replace(temporary, self.path)
+        finally:
+            self.file = open(self.path, 'r+b')
+        self.header_size, self.read_offset, self.size = header_size, read_offset, size
+        self.dirty = False
+
+    def append(self, record):
+        line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+        self.file.seek(self.size)
+        self.file.write(line)
+        self.size += len(line)
+        self.dirty = True
+
+    def push(self, message, receipt=None):
+        sequenced = super(DiskOutbox, self).push(message, receipt)
+        self.append([self.next_seq - 1, message])
+        if sequenced is not None:  # Sent right away, the next record to read comes behind it
+            self.read_offset = self.size
+        return sequenced
+
+    def wait(self, entry):
+        self.on_disk += 1
+        if entry[2] is not None:
+            self.receipts[entry[0]] = entry[2]
+
+    # Method to read the next count waiting messages from the file
+    def take(self, count):
+        entries = []
+        if not self.on_disk or count <= 0:
+            return entries
+        self.file.seek(self.read_offset)
+        while len(entries) < count:
+            line = self.file.readline()
+            if not line:
+                break
+            self.read_offset += len(line)
+            record = json.loads(line)
+            if len(record) == 1 or record[0] <= self.acked:
+                continue
+            seq = record[0]
+            entries.append((seq, ("seq", seq, tuple(record[1])), self.receipts.pop(seq, None)))
+        self.on_disk -= len(entries)
+        return entries
+
+    def acknowledge(self, seq):
+        if seq > self.acked:
+            self.append([seq])
+        messages = super(DiskOutbox, self).acknowledge(seq)
+        if self.read_offset > COMPACT_BYTES:  # Most of what was read is acknowledged, keep the file small
+            try:
+                self.sync()
+                self.compact()
+            except OSError:
+                pass  # Tried again with the next acknowledgement
+        return messages
+
+    def drop(self):
+        for receipt in self.receipts.values():
+            receipt.fail()
+        self.receipts.clear()
+        self.on_disk = 0
+        super(DiskOutbox, self).drop()
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    # Method to make the records written since the last call durable | Called in batches, not for every message
+    def sync(self):
+        if not self.dirty or self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class OutboxStore:  # Outboxes of all peers | Kept by the engine, so restarts and the next run deliver what is left
+    def __init__(self, directory=None, window=SEND_WINDOW, on_error=None):
+        self.directory = Path(directory) if directory is not None else None  # Outboxes only live in memory without it
+        self.window = window
+        self.on_error = on_error  # Called with the exception if an outbox can not be read or written
+        self.outboxes = {}  # (ip, port) -> Outbox
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.syncer = None
+        self.streams = None  # Receiving ends of the outboxes of our peers
+        if self.directory is not None:
+            self.load()
+        if self.streams is None:
+            self.streams = StreamStore()
+
+    # Method to find the outboxes of an earlier run | Their messages are read when the peer is connected again
+    def load(self):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            paths = sorted(self.directory.glob(f"*{OUTBOX_SUFFIX}"))
+        except OSError as error:
+            self.failed(error)
+            return
+        try:
+            self.streams = StreamStore(self.directory / STREAMS_FILE)
+        except (OSError, ValueError) as error:
+            self.failed(error)
+        for path in paths:
+            try:
+                with open(path, 'rb') as file:
+                    header = json.loads(file.readline())
+                self.outboxes[(header["ip"], str(header["port"]))] = DiskOutbox(path, header["ip"], header["port"],
+                                                                               self.window)
+            except (OSError, ValueError, KeyError) as error:
+                self.failed(error)
+
+    # Method to start writing the outboxes to disk in the background
+    def start(self):
+        if self.directory is None or self.syncer is not None:
+            return
+        self.syncer = threading.Thread(target=self.run, daemon=True)
+        self.syncer.start()
+
+    # Syncer thread | One fsync per outbox and interval, however many messages were queued in between
+    def run(self):
+        while not self.stopped.wait(SYNC_INTERVAL):
+            self.sync()
+
+    def sync(self):
+        for outbox in self:
+            with outbox.lock:
+                try:
+                    outbox.sync()
+                except OSError as error:
+                    self.failed(error)
+        try:
+            self.streams.sync()
+        except OSError as error:
+            self.failed(error)
+
+    def failed(self, error):
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.outboxes.values()))
+
+    # Method to get (address, outbox) of all peers with an outbox
+    def items(self):
+        with self.lock:
+            return list(self.outboxes.items())
+
+    def __len__(self):
+        return len(self.outboxes)
+
+    def get(self, ip, port):
+        with self.lock:
+            return self.outboxes.get((ip, str(port)))
+
+    # Method to get the outbox of a peer and create it if there is none
+    def open(self, ip, port):
+        address = (ip, str(port))
+        with self.lock:
+            outbox = self.outboxes.get(address)
+            if outbox is not None:
+                return outbox
+            if self.directory is not None:
+                try:
+                    outbox = DiskOutbox(self.directory / f"{ip}_{port}{OUTBOX_SUFFIX}".replace(":", "-"), ip, port,
+                                        self.window)
+                except OSError as error:
+                    self.failed(error)
+            if outbox is None:  # Without a directory or if the file can not be created
+                outbox = Outbox(self.window)
+            self.outboxes[address] = outbox
+        return outbox
+
+    # Method to give up the outbox of a peer | Its messages are deleted and their receipts fail
+    def drop(self, ip, port):
+        with self.lock:
+            outbox = self.outboxes.pop((ip, str(port)), None)
+        if outbox is not None:
+            with outbox.lock:
+                outbox.drop()
+
+    # Method to write all outboxes and stop the syncer | Outboxes in memory are given up
+    def close(self):
+        self.stopped.set()
+        for outbox in self:
+            with outbox.lock:
+                if isinstance(outbox, DiskOutbox):
+                    try:
+                        outbox.close()
+                    except OSError as error:
+                        self.failed(error)
+                else:
+                    outbox.drop()
+        with self.lock:
+            self.outboxes = {}
+        try:
+            self.streams.close()
+        except OSError as error:
+            self.failed(error)
+
+
+class Stream:  # Receiving end of an outbox | Remembers the last delivered sequence number across reconnects
+    def __init__(self, stream_id, last=0):
+        self.id = stream_id
+        self.last = last
+        self.saved = last  # Last sequence number written to the stream log
+
+
+class StreamStore:  # Streams of the peers that send us sequenced messages | Kept by the engine across restarts of the server
+    # The log is written before messages are acknowledged, so a peer never resends what an earlier run already showed
+    def __init__(self, path=None):
+        self.path = path  # Streams only live in memory without it
+        self.streams = collections.OrderedDict()  # Stream ID -> Stream, least recently used first
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.dirty = False  # Set if records were written since the last fsync
+        if path is not None:
+            self.load()
+
+    # Method to read the log of an earlier run | Later records of a stream win
+    def load(self):
+        if self.path.exists():
+            with open(self.path, 'rb') as file:
+                for line in file:  # Records are [stream ID, last delivered seq]
+                    try:
+                        stream_id, last = json.loads(line) if line.endswith(b"\n") else (None, 0)
+                    except (ValueError, TypeError):
+                        stream_id = None
+                    if stream_id is None:
+                        break  # Torn by a crash while writing
+                    self.streams.pop(stream_id, None)
+                    self.streams[stream_id] = Stream(stream_id, last)
+        while len(self.streams) > STREAM_CACHE_SIZE:
+            self.streams.popitem(last=False)
+        self.rewrite()
+
+    # Method to replace the log by one record per stream | The old log stays until the new one is complete
+    def rewrite(self):
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, 'wb') as file:
+            for stream in self.streams.values():
+                file.write(json.dumps([stream.id, stream.last]).encode() + b"\n")
+            file.flush()
+            os.fsync(file.fileno())
+            size = file.tell()
+        if self.file is not None:
+            self.file.close()  # Windows can not replace an open file
+        try:
+            os.replace(temporary, self.path)
+        finally:
+            self.file = open(self.path, 'ab')
+        self.size = size
+        self.dirty = False
+
+    # Method to get the stream of a peer and create it if it is new
+    def open(self, stream_id):
+        with self.lock:
+            stream = self.streams.pop(stream_id, None) or Stream(stream_id)
+            self.streams[stream_id] = stream
+            if len(self.streams) > STREAM_CACHE_SIZE:
+                self.streams.popitem(last=False)
+        return stream
+
+    # Method to log the last delivered sequence number of a stream | Called before the peer gets the acknowledgement
+    # The record reaches the page cache at once, so it survives a crash of the app | The syncer makes it durable
+    def save(self, stream):
+        if self.path is None or stream.last == stream.saved:
+            return
+        with self.lock:
+            line = json.dumps([stream.id, stream.last]).encode() + b"\n"
+            self.file.write(line)
+            self.file.flush()
+            stream.saved = stream.last
+            self.size += len(line)
+            self.dirty = True
+            if self.size > COMPACT_BYTES:  # Mostly records of streams that were saved again later, keep the log small
+                self.rewrite()
+
+    # Method to make the records written since the last call durable
+    def sync(self):
+        with self.lock:
+            if not self.dirty or self.file is None or self.file.closed:
+                return
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
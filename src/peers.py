@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import time
+
+
+class PeerCache:  # Peers we were connected to, kept in peers.json next to settings.json
+    def __init__(self, path=None):
+        self.path = path  # Without a path the cache only lives in memory
+        self.lock = threading.Lock()
+        self.peers = {}  # "ip:port" -> address, port, nickname, last seen, RTT and whether we were connected
+        if path is not None and path.exists():
+            try:
+                with open(path, encoding='utf-8') as file:
+                    self.peers = json.loads(file.read())
+            except (OSError, ValueError):
+                self.peers = {}
+
+    # Method to remember a peer our client connected to
+    def connected(self, ip, port, nickname):
+        with self.lock:
+            peer = self.peers.setdefault(f"{ip}:{port}", {"ip": ip, "port": int(port), "rtt": None})
+            peer.update(nickname=nickname, last_seen=time.time(), connected=True)
+        self.save()
+
+    # Method to remember that we left a peer on purpose | These peers are not reconnected on start
+    def disconnected(self, ip, port):
+        with self.lock:
+            peer = self.peers.get(f"{ip}:{port}")
+            if peer is None:
+                return
+            peer["connected"] = False
+        self.save()
+
+    def disconnect_all(self):
+        with self.lock:
+            for peer in self.peers.values():
+                peer["connected"] = False
+        self.save()
+
+    # Method to pin the certificate of a peer on the first TLS connection | Returns the pinned fingerprint if it differs
+    def pin(self, ip, port, fingerprint):
+        with self.lock:
+            peer = self.peers.setdefault(f"{ip}:{port}", {"ip": ip, "port": int(port), "rtt": None, "connected": False})
+            pinned = peer.get("fingerprint")
+            if pinned is not None:
+                return pinned if pinned != fingerprint else None
+            peer["fingerprint"] = fingerprint
+        self.save()
+        return None
+
+    # Method to get the fingerprint pinned for a peer | None if we never had a TLS connection to it
+    def fingerprint(self, ip, port):
+        with self.lock:
+            return self.peers.get(f"{ip}:{port}", {}).get("fingerprint")
+
+    # Method to update the round trip time of a peer | Only kept in memory until the next save()
+    def seen(self, ip, port, rtt):
+        with self.lock:
+            peer = self.peers.get(f"{ip}:{port}")
+            if peer is not None:
+                peer["last_seen"] = time.time()
+                peer["rtt"] = round(rtt, 6)
+
+    # Method to get the peers we were connected to when the app was closed
+    def reconnectable(self):
+        with self.lock:
+            return [dict(peer) for peer in self.peers.values() if peer.get("connected")]
+
+    # Method to write the cache to disk | Written to a temporary file first so a crash never leaves half a file
+    def save(self):
+        if self.path is None:
+            return
+        temporary = self.path.with_suffix(".tmp")
+        with self.lock:
+            try:
+                with open(temporary, 'w', encoding='utf-8') as file:
+                    file.write(json.dumps(self.peers, indent=4))
+                os.replace(temporary, self.path)
+            except OSError:
+                pass
@@ -0,0 +1,146 @@
+import socket
+import struct
+import time
+
+from src.compression import CODECS
+from src.control import BINARY
+
+# Capabilities advertised in the \b/init handshake. Peers only use what both sides announce
+CAPABILITIES = ["framed", "direct", "relay", "file", "heartbeat", "seq", BINARY] + CODECS
+
+HEADER = struct.Struct("!I")  # Every frame starts with the payload length as 4 byte big-endian integer
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Refuse frames above 16 MiB so a broken peer can't exhaust memory
+RECV_SIZE = 65536  # Size of the reusable receive buffer
+INIT_ACK_TIMEOUT = 1  # Seconds a client waits for the init acknowledgement of a peer
+ACK_END = b"\n"  # Ends the unframed init acknowledgement | Frames the peer sends right after it follow this byte
+MAX_ACK_SIZE = 1024
+
+
+# Method to wrap a payload into a length prefixed frame
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+# Method to turn Nagle's algorithm off or on | Off sends small chat messages at once instead of waiting for an ACK
+def set_nodelay(sock, enabled):
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+    except OSError:
+        pass
+
+
+# Method to build the \b/init handshake message
+def build_init(nickname, hostname, port, capabilities=None):
+    if capabilities is None:
+        capabilities = CAPABILITIES
+    return f"\b/init {nickname} {hostname} {port} {','.join(capabilities)}".encode()
+
+
+# Method to build the answer to a \b/init handshake | Only capabilities both peers support are acknowledged
+def build_init_ack(capabilities, nickname):
+    return f"\b/init-ack {','.join(capabilities)} {nickname}".encode() + ACK_END
+
+
+# Method to parse an init acknowledgement | Returns the acknowledged capabilities and the nickname of the peer
+def parse_init_ack(ack):
+    try:
+        ack = ack.decode().split(' ', 2)  # The nickname is last and may contain spaces
+    except UnicodeDecodeError:
+        return [], None
+    if ack[0] != "\b/init-ack" or len(ack) < 2:
+        return [], None
+    return parse_capabilities(ack[1]), ack[2] if len(ack) > 2 else None
+
+
+# Method to split received bytes after the init acknowledgement | Returns the ack and the bytes of the first frames
+# Returns None while the end of the ack is missing
+def split_init_ack(data):
+    end = data.find(ACK_END)
+    if end == -1:
+        return None
+    return data[:end], data[end + len(ACK_END):]
+
+
+# Method to parse initial information of a peer | Returns nickname, ip, port and the token of the capabilities
+# Legacy peers send no capabilities | The nickname may contain spaces, the other fields are parsed from the right
+def parse_init(init):
+    fields = init.split(' ')
+    if len(fields) < 4 or fields[0] != "\b/init":
+        return None
+    capabilities = fields.pop() if not fields[-1].isdigit() else ""
+    if len(fields) < 4:
+        return None
+    port, ip = fields.pop(), fields.pop()
+    return ' '.join(fields[1:]), ip, port, capabilities
+
+
+# Method to parse capabilities from an init or init-ack token. Unknown capabilities are ignored
+def parse_capabilities(token):
+    return [capability for capability in token.split(',') if capability in CAPABILITIES]
+
+
+# Method to wait for the init acknowledgement of a peer | Old peers never answer and get no capabilities
+# Returns the capabilities, the nickname of the peer and the bytes it sent after the ack
+def receive_init_ack(sock, timeout=INIT_ACK_TIMEOUT):
+    previous_timeout = sock.gettimeout()
+    deadline = time.monotonic() + timeout
+    data = b""
+    try:
+        while len(data) <= MAX_ACK_SIZE:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            received = sock.recv(RECV_SIZE)
+            if not received:
+                break
+            data += received
+            parts = split_init_ack(data)
+            if parts is not None:
+                capabilities, nickname = parse_init_ack(parts[0])
+                return capabilities, nickname, parts[1]
+    except socket.timeout:
+        pass
+    finally:
+        sock.settimeout(previous_timeout)
+    if data.startswith(b"\b/init-ack"):  # Peers before ACK_END end the ack with the segment
+        capabilities, nickname = parse_init_ack(data)
+        return capabilities, nickname, b""
+    return [], None, data
+
+
+class FrameReader:  # Reassembles messages from a stream socket
+    def __init__(self, framed=True):
+        self.framed = framed  # Without framing every received chunk is treated as one message (legacy peers)
+        self.buffer = bytearray()  # Bytes of incomplete frames
+        self.chunk = bytearray(RECV_SIZE)  # Reusable receive buffer
+        self.view = memoryview(self.chunk)
+
+    # Method to read once from a socket | Returns None if the peer closed the connection
+    def recv(self, sock):
+        size = sock.recv_into(self.chunk)
+        if not size:
+            return None
+        return self.feed(self.view[:size])
+
+    # Method to add received bytes and return all messages that are complete
+    def feed(self, data):
+        if not self.framed:
+            return [bytes(data)] if data else []
+
+        self.buffer += data
+        messages = []
+        offset = 0
+        size = len(self.buffer)
+        while size - offset >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds the maximum frame size")
+            end = offset + HEADER.size + length
+            if end > size:
+                break
+            messages.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+
+        if offset:
+            del self.buffer[:offset]  # Drop all consumed frames at once instead of once per frame
+        return messages
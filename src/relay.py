@@ -0,0 +1,56 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 6  # Hops a chat message may travel through the mesh
+SEEN_CACHE_SIZE = 4096  # Maximum number of message IDs remembered
+SEEN_CACHE_AGE = 300  # Seconds after which a message ID is forgotten
+
+
+# Method to create a message ID that is unique across the mesh
+def new_message_id():
+    return os.urandom(8).hex()
+
+
+class SeenCache:  # LRU set of message IDs with a fixed size and age limit | Lookups and inserts are O(1)
+    def __init__(self, max_entries=SEEN_CACHE_SIZE, max_age=SEEN_CACHE_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()  # Message ID -> time it was first seen. Oldest entries come first
+        self.lock = threading.Lock()
+
+    # Method to check a message ID and remember it | Returns True if the ID was seen before
+    def check(self, message_id):
+        now = time.monotonic()
+        with self.lock:
+            if message_id in self.entries:
+                self.entries.move_to_end(message_id)
+                return True
+
+            self.entries[message_id] = now
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            while self.entries:
+                oldest = next(iter(self.entries.values()))
+                if now - oldest <= self.max_age:
+                    break
+                self.entries.popitem(last=False)
+            return False
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Relay:  # Gossip state shared by server and client | Survives restarts of the sockets
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=SEEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.seen = SeenCache(max_entries)
+        self.delivered = 0  # Messages of other peers shown to the user
+        self.forwarded = 0  # Messages sent on to other peers
+        self.duplicates = 0  # Messages dropped because they were seen before
+
+    # Method to build a chat message | The origin is the nickname of the peer that wrote the message
+    @staticmethod
+    def build_frame(message_id, ttl, origin, msg):
+        return "chat", message_id, ttl, origin, msg
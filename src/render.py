@@ -0,0 +1,46 @@
+import collections
+import time
+
+
+class RenderScheduler:  # Collects feed updates of all threads and redraws at most max_fps times a second
+    def __init__(self, render, max_fps=20):
+        self.render = render  # Called on the UI thread with all lines queued since the last redraw
+        self.interval = 1 / max_fps
+        self.queue = collections.deque()  # Appends and pops of a deque are thread safe
+        self.dirty = False
+        self.last_render = 0.0
+        self.requests = 0  # Number of updates writers asked for
+        self.redraws = 0  # Number of redraws that actually happened
+
+    # Method for writers of any thread to queue lines and mark the feed dirty | Never draws
+    def push(self, *lines):
+        self.queue.append(lines)
+        self.requests += 1
+        self.dirty = True
+
+    # Method to mark the feed dirty without new lines, e.g. after scrolling
+    def invalidate(self):
+        self.requests += 1
+        self.dirty = True
+
+    # Updates that were merged into another redraw
+    @property
+    def coalesced(self):
+        return max(0, self.requests - self.redraws)
+
+    # Method called regularly by the UI thread | Redraws if the feed is dirty and the frame interval has passed
+    def tick(self):
+        if not self.dirty:
+            return False
+        now = time.monotonic()
+        if now - self.last_render < self.interval:
+            return False
+
+        self.dirty = False
+        self.last_render = now
+        lines = []
+        while self.queue:
+            lines.extend(self.queue.popleft())
+        self.redraws += 1
+        self.render(lines)
+        return True
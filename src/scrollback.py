@@ -0,0 +1,65 @@
+import threading
+
+
+class RingBuffer:  # Fixed capacity list that overwrites its oldest item | Appends and indexing are O(1)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = [None] * capacity
+        self.start = 0  # Index of the oldest item
+        self.size = 0
+
+    def append(self, item):
+        self.items[(self.start + self.size) % self.capacity] = item
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self.items[(self.start + index) % self.capacity]
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.items = [None] * self.capacity
+        self.start = 0
+        self.size = 0
+
+
+class Scrollback:  # Lines of the chat feed and the part of them that is currently visible
+    def __init__(self, capacity=1000):
+        self.lines = RingBuffer(capacity)
+        self.offset = 0  # Number of lines the view is scrolled up from the newest line
+        self.lock = threading.Lock()
+
+    # Method to add a line | A scrolled view stays on the same lines while new ones arrive
+    def append(self, line, height=None):
+        with self.lock:
+            self.lines.append(line)
+            if self.offset:
+                # One more line below the view | Also when the buffer is full, every line moved up by one then
+                self.offset += 1
+                if height is not None:  # Only a view on the oldest lines moves, they were dropped
+                    self.offset = min(self.offset, max(0, len(self.lines) - height))
+
+    # Method to get the lines visible in a view of the given height | Costs O(height), not O(scrollback)
+    def window(self, height):
+        with self.lock:
+            end = len(self.lines) - self.offset
+            return [self.lines[index] for index in range(max(0, end - height), end)]
+
+    def page_up(self, height):
+        with self.lock:
+            self.offset = min(self.offset + height, max(0, len(self.lines) - height))
+
+    def page_down(self, height):
+        with self.lock:
+            self.offset = max(0, self.offset - height)
+
+    def clear(self):
+        with self.lock:
+            self.lines.clear()
+            self.offset = 0
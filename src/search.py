@@ -0,0 +1,268 @@
+import array
+import bisect
+import datetime
+import gzip
+import itertools
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from src.journal import LOG_PREFIX
+
+WORD = re.compile(r"\w{1,64}")  # Words are indexed lowercase, punctuation separates them
+LOG_LINE = re.compile(r"\[(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\] (.*)")
+DOCUMENTS = "messages.txt"  # One indexed message per line: time, nickname and text separated by tabs
+SNAPSHOT = "index.bin"  # Postings of the messages up to a size of the documents file | Newer lines are indexed on load
+MAGIC = b"P2PS"
+HEADER = struct.Struct("!4sIQ")  # Magic, number of messages and size of the documents file the snapshot covers
+TERM = struct.Struct("!HI")  # Length of the term and number of its postings
+NICKNAME = "\0"  # Prefix of the terms of nicknames | Never part of a word, so from:x and the word x stay apart
+LOOKUP_RATIO = 32  # Candidates are looked up with bisect if the other list is this many times longer
+SNAPSHOT_MESSAGES = 10000  # New messages that make a new snapshot worth writing | Fewer are indexed again faster than saved
+RESULT_LIMIT = 20  # Matches shown for one search, the newest ones
+
+
+# Method to split a text into the terms it is found by
+def tokenize(text):
+    return set(WORD.findall(text.lower()))
+
+
+# Method to read a line of the chat log | Returns (time, nickname, text) or None for system messages and commands
+def parse_log_line(line, you, own_nickname, midnights):
+    match = LOG_LINE.match(line)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, rest = match.groups()
+    if rest.startswith("["):
+        return None
+
+    if " >  " in rest:  # Message of a peer, "nick >  text" or "nick > you >  text" if it was direct
+        sender, text = rest.split(" >  ", 1)
+        nickname = sender.split(" > ", 1)[0]
+    elif " > " in rest:  # Message we sent
+        nickname, text = rest.split(" > ", 1)
+        if text.startswith("/"):
+            return None
+    else:
+        return None
+    if nickname == you:
+        nickname = own_nickname
+
+    date = (year, month, day)
+    if date not in midnights:  # strptime() is too slow for millions of lines
+        midnights[date] = int(time.mktime((int(year), int(month), int(day), 0, 0, 0, 0, 0, -1)))
+    return midnights[date] + int(hour) * 3600 + int(minute) * 60 + int(second), nickname, text
+
+
+# Method to sort log segments by date | p2p-chat-log_MM-DD-YYYY.log, finished ones as .N.log.gz
+def segment_order(path):
+    name = path.name[len(LOG_PREFIX):]
+    date, _sep, rest = name.partition(".")
+    try:
+        month, day, year = (int(part) for part in date.split("-"))
+    except ValueError:
+        return 0, 0, 0, 0
+    number = rest.split(".")[0]
+    return year, month, day, int(number) if number.isdigit() else 1 << 30  # The open segment is the newest of its day
+
+
+class SearchIndex:  # Inverted index of all chat messages | Term -> sorted IDs of the messages that contain it
+    def __init__(self, directory, log_directory=None):
+        self.directory = Path(directory)
+        self.log_directory = Path(log_directory) if log_directory is not None else None
+        self.postings = {}  # Term -> array of message IDs in ascending order
+        self.times = array.array('I')  # Message ID -> unix time | Ascending, messages are added in the order they arrive
+        self.offsets = array.array('Q')  # Message ID -> position of its line in the documents file
+        self.size = 0  # Bytes of the documents file
+        self.file = None
+        self.pending = []  # Messages that arrived while the index was loaded
+        self.ready = False
+        self.saved = 0  # Messages covered by the snapshot on disk
+        self.started = int(time.time())  # Log lines from here on are indexed as they arrive, not from the log
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.directory / DOCUMENTS
+
+    def __len__(self):
+        return len(self.times)
+
+    # Method to add a message | Returns immediately while the index is still loaded
+    def add(self, nickname, text, timestamp=None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        with self.lock:
+            if not self.ready:
+                self.pending.append((timestamp, nickname, text))
+                return
+            try:
+                self.append(timestamp, nickname, text)
+            except OSError:
+                pass  # The message is still in the chat log
+
+    # Method to write a message to the documents file and index it | Called with the lock held
+    def append(self, timestamp, nickname, text):
+        line = f"{timestamp}\t{nickname}\t{text}".replace("\n", " ") + "\n"
+        data = line.encode(errors='replace')
+        self.file.write(data)
+        self.index(timestamp, nickname, text, self.size)
+        self.size += len(data)
+
+    def index(self, timestamp, nickname, text, offset):
+        message_id = len(self.times)
+        self.times.append(timestamp)
+        self.offsets.append(offset)
+        for term in tokenize(text) | {NICKNAME + nickname.lower()}:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array('I')
+            postings.append(message_id)
+
+    # Method to load the index in the background | Builds it from the chat log the first time
+    def load(self, you="", own_nickname=""):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fresh = not self.path.exists()
+        self.file = open(self.path, "ab")
+        if not fresh:
+            self.read_snapshot()
+            self.index_documents()
+        elif self.log_directory is not None:
+            self.import_logs(you, own_nickname)
+        with self.lock:
+            for timestamp, nickname, text in self.pending:
+                self.append(timestamp, nickname, text)
+            self.pending = []
+            self.ready = True
+
+    # Method to restore the postings of a snapshot | A missing or broken snapshot leaves the index empty
+    def read_snapshot(self):
+        try:
+            with open(self.directory / SNAPSHOT, "rb") as snapshot:
+                data = zlib.decompress(snapshot.read())
+            magic, count, size = HEADER.unpack_from(data)
+            if magic != MAGIC or size > self.path.stat().st_size:
+                return
+            offset = HEADER.size
+            times, lengths = array.array('I'), array.array('I')
+            times.frombytes(data[offset:offset + count * 4])
+            lengths.frombytes(data[offset + count * 4:offset + count * 8])
+            offset += count * 8
+            postings = {}
+            while offset < len(data):
+                length, number = TERM.unpack_from(data, offset)
+                offset += TERM.size
+                term = data[offset:offset + length].decode()
+                offset += length
+                deltas = array.array('I')
+                deltas.frombytes(data[offset:offset + number * 4])
+                offset += number * 4
+                postings[term] = array.array('I', itertools.accumulate(deltas))  # Stored as gaps, they compress better
+        except (OSError, ValueError, zlib.error, struct.error):
+            return
+        self.postings, self.times, self.size, self.saved = postings, times, size, count
+        self.offsets = array.array('Q', itertools.accumulate(lengths, initial=0))
+        self.offsets.pop()  # The last sum is the end of the last line
+
+    # Method to index the lines of the documents file behind the snapshot
+    def index_documents(self):
+        with open(self.path, "rb") as documents:
+            documents.seek(self.size)
+            for data in documents:
+                if not data.endswith(b"\n"):  # Cut off by a crash
+                    break
+                try:
+                    timestamp, nickname, text = data.decode(errors='replace').rstrip("\n").split("\t", 2)
+                    self.index(int(timestamp), nickname, text, self.size)
+                except ValueError:
+                    pass
+                self.size += len(data)
+        self.file.truncate(self.size)
+
+    # Method to index the messages of all chat log segments, oldest first
+    def import_logs(self, you, own_nickname):
+        if not self.log_directory.is_dir():
+            return
+        midnights = {}
+        for path in sorted(self.log_directory.glob(f"{LOG_PREFIX}*"), key=segment_order):
+            opener = gzip.open if path.suffix == ".gz" else open
+            try:
+                with opener(path, "rt", encoding="utf-8", errors="replace") as log:
+                    for line in log:
+                        message = parse_log_line(line.rstrip("\n"), you, own_nickname, midnights)
+                        if message is not None and message[0] < self.started:
+                            self.append(*message)
+            except (OSError, EOFError):  # A segment that was cut off is indexed up to the damage
+                continue
+
+    # Method to find messages that contain all terms | Returns the total number of matches and the newest ones
+    def search(self, terms, nickname=None, since=None, limit=RESULT_LIMIT):
+        with self.lock:
+            if not self.ready:
+                return None
+            lists = [self.postings.get(term, ()) for term in terms]
+            if nickname is not None:
+                lists.append(self.postings.get(NICKNAME + nickname.lower(), ()))
+            if not lists:
+                return 0, []
+            lists.sort(key=len)
+            first = 0 if since is None else bisect.bisect_left(self.times, since)
+            smallest = lists[0]
+            matches = smallest[bisect.bisect_left(smallest, first):]
+            for postings in lists[1:]:
+                if len(matches) * LOOKUP_RATIO < len(postings):  # Few candidates are looked up in the long list
+                    matches = [message_id for message_id in matches if contains(postings, message_id)]
+                else:  # Lists of similar length are intersected in C
+                    matches = sorted(set(matches).intersection(postings))
+                if not matches:
+                    break
+            offsets = [self.offsets[message_id] for message_id in matches[-limit:]]
+            self.file.flush()
+
+        results = []
+        with open(self.path, "rb") as documents:
+            for offset in offsets:
+                documents.seek(offset)
+                timestamp, nickname, text = documents.readline().decode(errors='replace').rstrip("\n").split("\t", 2)
+                results.append((datetime.datetime.fromtimestamp(int(timestamp)), nickname, text))
+        return len(matches), results
+
+    # Method to write the postings to disk | Only a shortcut for the next load, the messages are in the documents file
+    def save(self, force=False):
+        with self.lock:
+            if not self.ready or (not force and len(self.times) - self.saved < SNAPSHOT_MESSAGES):
+                return
+            self.saved = len(self.times)
+            self.file.flush()
+            lengths = array.array('I', (end - start for start, end in
+                                        zip(self.offsets, itertools.chain(self.offsets[1:], (self.size,)))))
+            parts = [HEADER.pack(MAGIC, len(self.times), self.size), self.times.tobytes(), lengths.tobytes()]
+            for term, postings in self.postings.items():
+                encoded = term.encode()
+                parts.append(TERM.pack(len(encoded), len(postings)))
+                parts.append(encoded)
+                gaps = array.array('I', (b - a for a, b in zip(itertools.chain((0,), postings), postings)))
+                parts.append(gaps.tobytes())
+            data = zlib.compress(b"".join(parts), 1)
+
+        temporary = self.directory / (SNAPSHOT + ".tmp")
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(data)
+        os.replace(temporary, self.directory / SNAPSHOT)
+
+    def close(self):
+        try:
+            self.save()
+        except OSError:
+            pass
+        if self.file is not None:
+            self.file.close()
+
+
+# Method to check if a sorted array contains a message ID
+def contains(postings, message_id):
+    index = bisect.bisect_left(postings, message_id)
+    return index < len(postings) and postings[index] == message_id
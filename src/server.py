@@ -1,136 +1,454 @@
+import collections
+import selectors
 import socket
 import threading
 import time
 
-from src.settings import LANG
+from src.compression import negotiate
+from src.control import UnknownCommand, decode
+from src.protocol import build_init_ack, parse_capabilities, parse_init, set_nodelay
+from src.session import SEND_BUFFER_SIZE, QueuedConnection, Session
+from src.settings import LANG, get_setting
+from src.tls import TLSDetector
+from src.transfer import MAX_FILE_SIZE, IncomingTransfer, TransferRefused, parse_file_init
 
 
-class Server(threading.Thread):  # Server object is type thread so that it can run simultaneously with the client
-    def __init__(self, chat_app):  # Initialize with a reference to the Chat App and initial vars
-        super(Server, self).__init__()
+# Method to open a listening socket | Created apart from the server so restarts can hand it on without a gap
+def create_listener(host, port, reuse_port=False, backlog=None):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Rebind despite closed connections in TIME_WAIT
+        if reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((host, port))
+        listener.listen(*(() if backlog is None else (backlog,)))
+    except OSError:
+        listener.close()
+        raise
+    listener.setblocking(False)  # A peer may be gone again between select() and accept()
+    return listener
+
+
+class PeerHandler:  # Transport independent handling of everything peers send to the server
+    def __init__(self, chat_app, listener=None):  # Initialize with a reference to the Chat App and initial vars
         self.chat_app = chat_app
         self.port = self.chat_app.port  # Get the server port from the Chat App reference
         self.host = ""  # Accept all hostnames
-        self.has_connection = False  # Connection status
-        self.stop_socket = False  # Socket interrupt status
+        self.listener = listener  # Listening socket | None if the port could not be bound
+        self.heartbeat_timeout = get_setting('heartbeat_timeout', 6)  # Seconds of silence until a peer with heartbeats is dead
+        self.streams = chat_app.outboxes.streams  # Last delivered seq of every peer | Kept by the engine across restarts
+        self.tcp_nodelay = get_setting('tcp_nodelay', True)  # Acknowledgements and pongs go out without delay
+        self.send_buffer_size = get_setting('send_buffer_size', SEND_BUFFER_SIZE)  # Bytes queued per peer at most
+        self.max_file_size = get_setting('max_file_size', MAX_FILE_SIZE)  # Larger files are refused
 
-        # Information exchange commands used to communicate between peers
+        # Information exchange commands used to communicate between peers | Arguments are parsed by src.control
         self.commands = {
-            "nick": [self.set_peer_nickname, 1],
-            "quit": [self.peer_quit, 0],
-            "syntaxErr": [self.chat_client_versions_out_of_sync, 0]
+            "text": self.plain_message,
+            "nick": self.set_peer_nickname,
+            "quit": self.peer_quit,
+            "msg": self.direct_message,
+            "chat": self.relay_message,
+            "ping": self.ping,
+            "stream": self.open_stream,
+            "seq": self.sequenced_message,
+            "syntaxErr": self.chat_client_versions_out_of_sync
         }
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create new socket
-        self.socket.bind((self.host, self.port))  # Bind the socket to host and port stored in the servers vars
-        self.socket.listen()  # Set socket mode to listen
+    # Connection status | True if at least one peer is connected to the server
+    @property
+    def has_connection(self):
+        return any(session.inbound is not None for session in self.chat_app.sessions)
 
-        self.chat_app.system_message(LANG['serverStarted'].format(self.port))
+    # Method to handle a received message | Returns False if the peer quit
+    def handle_command(self, connection, data):
+        start = time.perf_counter()
+        try:
+            message = decode(data, connection.binary)
+        except UnknownCommand:
+            self.syntax_error(connection.session, LANG['peerInvalidCommand'])
+            return True
+        except ValueError:
+            self.syntax_error(connection.session, LANG['peerInvalidSyntax'])
+            return True
 
-    # Method to handle information exchange commands
-    def handle_command(self, command):
-        command = command.decode().split(" ")
-        if len(command) > 1:
-            args = command[1:]
-        command = command[0][2:]
+        try:
+            self.dispatch(connection.session, message)
+        finally:
+            self.chat_app.metrics.dispatch.record(time.perf_counter() - start)
+        return message[0] != "quit"
 
-        if self.commands.get(command) is not None:
-            if self.commands[command][1] == 0:
-                self.commands[command][0]()
-            elif len(args) == self.commands[command][1]:
-                self.commands[command][0](args)
-            else:
+    # Method to call the handler of a decoded message tuple
+    def dispatch(self, session, message):
+        handler = self.commands.get(message[0])
+        if handler is None:  # Known to the codec but only sent the other way, e.g. \b/ack
+            self.syntax_error(session, LANG['peerInvalidCommand'])
+            return
+        handler(session, *message[1:])
+
+    def syntax_error(self, session, msg):
+        self.chat_app.system_message(msg)
+        self.chat_app.client.send_to(session, ("syntaxErr",))
+
+    # Seconds a connection may stay silent | Only peers that send heartbeats are ever timed out
+    def idle_timeout(self, connection):
+        return self.heartbeat_timeout if "heartbeat" in connection.capabilities else None
+
+    # Method to prepare a new connection | Peers that start with a TLS handshake get an encrypted connection
+    # Without TLS their connection is closed at once, so they fall back to an unencrypted one without waiting
+    def accept_tls(self, connection):
+        connection.reader = TLSDetector(connection, self.chat_app.tls)
+
+    # Method to acknowledge all sequenced messages of a connection at once | Called after every read, not every message
+    def acknowledge(self, connection):
+        stream = connection.stream
+        if stream is None or stream.last == connection.acked:
+            return
+        try:
+            self.streams.save(stream)  # Logged first, the peer drops acknowledged messages from its outbox
+            connection.send_message(("ack", stream.last))
+        except OSError:
+            return  # Acknowledged after the next read
+        connection.acked = stream.last
+
+    # Method to close the listening socket | Not called if the next server takes it over
+    def close_listener(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    # Method to tell peers that read our answers that we leave on purpose | They do not try to reconnect then
+    def say_goodbye(self):
+        for session in self.chat_app.sessions:
+            connection = session.inbound
+            if connection is not None and "heartbeat" in connection.capabilities:
+                try:
+                    connection.send_message(("quit",))
+                except OSError:
+                    pass
+
+    # Method to handle one received message | Returns False if the peer ended the connection
+    def handle_message(self, connection, data):
+        connection.last_seen = time.monotonic()
+        metrics = self.chat_app.metrics
+        metrics.messages_in += 1
+        metrics.bytes_in += len(data)
+        if not connection.initialized and data.startswith(b'\b/file '):
+            return self.handle_file(connection, data)
+
+        if not connection.initialized:
+            capabilities = self.handle_init(connection, data)
+            if capabilities:  # Legacy clients do not announce capabilities and get no answer
+                try:
+                    connection.write(build_init_ack(capabilities, self.chat_app.nickname))
+                except OSError:
+                    return False
+            connection.framed = "framed" in capabilities
+            connection.reader.framed = connection.framed
+            connection.codec = negotiate(capabilities, self.chat_app.compression, self.chat_app.compression_threshold)
+            return True
+
+        if connection.codec is not None:
+            try:
+                data = connection.codec.decode(data)
+            except ValueError as error:
                 self.chat_app.system_message(LANG['peerInvalidSyntax'])
-                self.chat_app.client.send("\b/syntaxErr")
-        else:
-            self.chat_app.system_message(LANG['peerInvalidCommand'])
-            self.chat_app.client.send("\b/syntaxErr")
+                self.chat_app.system_message(error)
+                return False
 
-    # Method called by threading on start
-    def run(self):
-        conn, addr = self.socket.accept()  # Accept a connection
-        if self.stop_socket:  # Stop the socket if interrupt is set to true
-            exit(1)
-        init = conn.recv(1024)  # Wait for initial information from client
-        self.has_connection = True  # Set connection status to true
-
-        self.handle_init(init)
-
-        while True:  # Receive loop
-            if len(self.chat_app.form.feed.values) > self.chat_app.form.y - 10:
-                self.chat_app.clear_chat()
-
-            data = conn.recv(1024)  # Wait for data
-            if not data:
-                # If data is empty throw an error
-                self.chat_app.system_message(LANG['receivedEmptyMessage'])
-                self.chat_app.system_message(LANG['disconnectSockets'])
-                break
-
-            if data.decode().startswith('\b/'):
-                # If data is command for information exchange call the command handler
-                self.handle_command(data)
-                if data.decode() == '\b/quit':
-                    break
-            else:
-                # Else display the message in chat feed and append it to chat log
-                self.chat_app.message_log.append("{0} >  {1}".format(self.chat_app.peer, data.decode()))
-                self.chat_app.form.feed.values.append("{0} >  {1}".format(self.chat_app.peer, data.decode()))
-                self.chat_app.form.feed.display()
-
-    def handle_init(self, init):
-        if not init:  # If initial information is empty, set peer vars to unknown
-            self.chat_app.peer = "Unknown"
-            self.chat_app.peer_port = "unknown"
-            self.chat_app.peer_ip = 'unknown'
-        else:  # Decode initial information and set peer vars to values send by peer
+        return self.handle_command(connection, data)
+
+    # Method to handle a lost connection of a peer
+    def handle_disconnect(self, connection):
+        session = connection.session
+        if session is None or session.inbound is not connection:
+            return
+        self.chat_app.system_message(LANG['peerConnectionLost'].format(session.nickname))
+        session.inbound = None
+        if session.outbound is None:
+            self.chat_app.sessions.remove(session)
+
+    # Method to read initial information of a peer | Returns the capabilities both peers support
+    def handle_init(self, connection, init):
+        connection.initialized = True
+        nickname, ip, port, capabilities = "Unknown", "unknown", "unknown", []
+        try:
             init = init.decode()
-            if init.startswith("\b/init"):
-                init = init[2:].split(' ')
-                self.chat_app.peer = init[1]
-                self.chat_app.peer_ip = init[2]
-                self.chat_app.peer_port = init[3]
-            else:  # If initial information is not sent correctly
-                self.chat_app.peer = "Unknown"
-                self.chat_app.peer_port = "unknown"
-                self.chat_app.peer_ip = 'unknown'
-
-        if not self.chat_app.client.is_connected:
+        except UnicodeDecodeError:
+            init = ""
+        init = parse_init(init)  # Decode initial information and set peer vars to values send by peer
+        if init is not None:
+            nickname, ip, port = init[:3]
+            capabilities = parse_capabilities(init[3])
+
+        # Reuse the session if our client is already connected to the peer
+        session = None
+        if ip != "unknown":
+            session = self.chat_app.sessions.get(ip, port)
+        if session is None:
+            session = self.chat_app.sessions.by_nickname(nickname, lambda other: other.inbound is None)
+        if session is None or session.inbound is not None:
+            session = self.chat_app.sessions.add(Session(nickname, ip, port))
+        session.nickname = nickname
+        if ip != "unknown":
+            session.ip, session.port = ip, port
+        session.inbound = connection
+        connection.session = session
+        connection.capabilities = capabilities
+
+        if session.outbound is None:
             # Send message to inform about connectBack if client socket is not connected
-            if self.chat_app.peer_ip == "unknown" or self.chat_app.peer_port == "unknown":
+            if not session.address_known:
                 self.chat_app.system_message(LANG['failedConnbackPeerUnknown'])
             else:
                 self.chat_app.system_message(LANG['connbackInfo'])
-                self.chat_app.system_message(
-                    LANG['connbackHostInfo'].format(self.chat_app.peer_ip, self.chat_app.peer_port)
-                )
+                self.chat_app.system_message(LANG['connbackHostInfo'].format(session.ip, session.port))
+
+        self.chat_app.system_message(LANG['peerConnected'].format(session.nickname))  # Inform user about peer
+        return capabilities
 
-        self.chat_app.system_message(LANG['peerConnected'].format(self.chat_app.peer))  # Inform user about peer
+    # Method to turn a new connection into a file channel | All further bytes go to the transfer instead of the frame reader
+    def handle_file(self, connection, init):
+        connection.initialized = True
+        connection.framed = True  # Acknowledgements are sent back as frames
+        try:
+            init = parse_file_init(init)
+        except ValueError:
+            self.chat_app.system_message(LANG['peerInvalidSyntax'])
+            connection.send("\b/file-failed")
+            return False
 
-    # Method called by Chat App to reset server socket
-    def stop(self):
-        if self.has_connection:
-            self.socket.close()
+        connection.session = self.file_session(connection, init[4])
+        if connection.session is None:  # Only peers that are connected to us may send files
+            self.chat_app.system_message(LANG['fileNoSession'].format(connection.address))
+            connection.send("\b/file-failed")
+            return False
+
+        try:
+            connection.transfer = IncomingTransfer(self.chat_app, connection, init, self.max_file_size)
+        except TransferRefused as error:
+            self.chat_app.system_message(error)
+            connection.send("\b/file-failed")
+            return False
+        except (ValueError, OSError) as error:
+            self.chat_app.system_message(LANG['peerInvalidSyntax'])
+            self.chat_app.system_message(error)
+            connection.send("\b/file-failed")
+            return False
+        if connection.tls is not None:  # Received bytes are still decrypted first
+            connection.reader.reader = connection.transfer
         else:
-            self.stop_socket = True
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(('localhost', self.port))
-            time.sleep(0.2)
-            self.socket.close()
+            connection.reader = connection.transfer
+        connection.transfer.start()
+        return True
+
+    # Method to find the session a file channel belongs to | The chat connection of the peer comes from the same address
+    def file_session(self, connection, nickname):
+        if connection.address is None:
+            return None
+        sessions = [session for session in self.chat_app.sessions
+                    if session.inbound is not None and session.inbound.address == connection.address]
+        for session in sessions:  # Several peers may share an address, e.g. on one computer
+            if session.nickname == nickname:
+                return session
+        return sessions[0] if sessions else None
 
-        self.socket = None
+    # Method called for a chat message without command | Displayed in the chat feed and appended to the chat log
+    def plain_message(self, session, msg):
+        self.chat_app.peer_message(session, msg)
 
     # Method called if command for nickname change was received
-    def set_peer_nickname(self, nick):
-        old_nick = self.chat_app.peer
-        self.chat_app.peer = nick[0]
-        self.chat_app.system_message(LANG['peerChangedName'].format(old_nick, nick[0]))
+    def set_peer_nickname(self, session, nick):
+        old_nick = session.nickname
+        session.nickname = nick
+        self.chat_app.system_message(LANG['peerChangedName'].format(old_nick, nick))
+
+    # Method called if a connected peer quit | Only the session of that peer is closed
+    def peer_quit(self, session):
+        self.chat_app.system_message(LANG['peerDisconnected'].format(session.nickname))
+        self.chat_app.client.close_session(session)
+        self.chat_app.peers.disconnected(session.ip, session.port)
+        session.inbound = None  # The transport closes the connection once the handler returns
+        self.chat_app.sessions.remove(session)
 
-    # Method called if connected peer quit
-    def peer_quit(self):
-        self.chat_app.system_message(LANG['peerDisconnected'].format(self.chat_app.peer))
-        self.chat_app.client.is_connected = False
-        self.chat_app.restart()
+    # Method called if a peer sent a heartbeat | Answered on the same connection so the peer can measure the RTT
+    def ping(self, session, token):
+        try:
+            session.inbound.send_message(("pong", token))
+        except (OSError, AttributeError):
+            pass
+
+    # Method called if a peer starts or continues its stream of sequenced messages on a new connection
+    def open_stream(self, session, stream_id):
+        if session.inbound is None:
+            return
+        session.inbound.stream = self.streams.open(stream_id)
+
+    # Method called for a chat message with a sequence number | Messages resent after a reconnect are dropped
+    def sequenced_message(self, session, seq, message):
+        stream = session.inbound.stream if session.inbound is not None else None
+        if stream is not None:
+            if seq <= stream.last:
+                return False
+            stream.last = seq
+        self.dispatch(session, message)
+
+    # Method called if a peer sent a message only to us
+    def direct_message(self, session, msg):
+        self.chat_app.peer_message(session, msg, direct=True)
+
+    # Method called if a chat message of the mesh was received | Unseen messages are shown and forwarded
+    def relay_message(self, session, message_id, ttl, origin, msg):
+        relay = self.chat_app.relay
+        if relay.seen.check(message_id):
+            relay.duplicates += 1
+            return False
+
+        relay.delivered += 1
+        self.chat_app.peer_message(session, msg, origin=origin)
+        if ttl > 0:
+            relay.forwarded += self.chat_app.client.forward(session, message_id, ttl - 1, origin, msg)
 
     # Method called if connected peer uses an invalid information exchange command syntax
-    def chat_client_versions_out_of_sync(self):
+    def chat_client_versions_out_of_sync(self, _session):
         self.chat_app.system_message(LANG['versionOutOfSync'])
+
+
+IDLE_CHECK = 1  # Seconds between two checks for silent peers
+STOP_TIMEOUT = 1  # Seconds stop() waits for the server thread to close the connections
+
+
+class Server(PeerHandler, threading.Thread):  # Server object is type thread so that it can run simultaneously with the client
+    def __init__(self, chat_app, listener=None):
+        threading.Thread.__init__(self)
+        PeerHandler.__init__(self, chat_app, listener)
+        self.stop_socket = False  # Socket interrupt status
+        self.selector = selectors.DefaultSelector()  # One selector serves the listener, the wakeup and all peer connections
+        self.wakeup, self.wakeup_writer = socket.socketpair()  # stop() writes to it instead of connecting to the server
+        self.writable = collections.deque()  # Connections with data waiting for their socket
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        if self.listener is not None:
+            self.selector.register(self.listener, selectors.EVENT_READ)
+            self.chat_app.system_message(LANG['serverStarted'].format(self.port))
+
+    # Method called by threading on start
+    def run(self):
+        while not self.stop_socket:
+            for key, mask in self.selector.select(IDLE_CHECK):
+                if self.stop_socket:  # Stop the socket if interrupt is set to true
+                    break
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(1024)
+                elif key.data is None:
+                    self.accept()
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(key.data)
+                    if mask & selectors.EVENT_READ and not key.data.closed:
+                        self.receive(key.data)
+            while self.writable:
+                connection = self.writable.popleft()
+                try:
+                    self.selector.modify(connection.socket, self.events(connection), connection)
+                except (KeyError, ValueError):
+                    pass  # Closed meanwhile
+            self.close_idle()
+
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        self.selector.close()  # The listener stays open, stop() closes it unless the next server takes it over
+        self.wakeup.close()
+        self.wakeup_writer.close()
+
+    # Method to accept a new peer connection
+    def accept(self):
+        try:
+            conn, address = self.listener.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+        conn.setblocking(False)
+        set_nodelay(conn, self.tcp_nodelay)
+        connection = QueuedConnection(conn, limit=self.send_buffer_size, on_error=self.write_failed,
+                                      on_pending=self.schedule_write)
+        connection.address = address[0]
+        self.accept_tls(connection)
+        self.selector.register(conn, selectors.EVENT_READ, connection)
+
+    # Selector events of a connection | Writable is only watched while data waits
+    @staticmethod
+    def events(connection):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.queued else 0)
+
+    # Method to send the data waiting on a connection once its socket is writable
+    def flush(self, connection):
+        if connection.flush():
+            return
+        try:
+            self.selector.modify(connection.socket, selectors.EVENT_READ, connection)
+        except (KeyError, ValueError):
+            pass  # The connection failed and was closed
+
+    # Method called from any thread if data has to wait for the socket of a connection
+    def schedule_write(self, connection):
+        self.writable.append(connection)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass  # Stopped
+
+    # Method called by the server thread if waiting data could not be sent | The peer is gone
+    def write_failed(self, connection, _error):
+        self.close_connection(connection)
+        self.handle_disconnect(connection)
+
+    # Method to read from a peer connection
+    def receive(self, connection):
+        try:
+            messages = connection.reader.recv(connection.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError):
+            messages = None
+
+        if messages is None:
+            # If data is empty the peer is gone
+            self.close_connection(connection)
+            self.handle_disconnect(connection)
+            return
+
+        for data in messages:
+            if not self.handle_message(connection, data):
+                self.close_connection(connection)
+                return
+        self.acknowledge(connection)
+
+    # Method to drop peers that stopped sending heartbeats | Detects half-open connections
+    def close_idle(self):
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if connection is None:
+                continue
+            timeout = self.idle_timeout(connection)
+            if timeout is not None and now - connection.last_seen > timeout:
+                self.close_connection(connection)
+                self.handle_disconnect(connection)
+
+    def close_connection(self, connection):
+        try:
+            self.selector.unregister(connection.socket)
+        except (KeyError, ValueError):
+            pass
+        connection.close()
+
+    # Method called by Chat App to reset server socket | Returns once the connections are closed
+    def stop(self, close_listener=True):
+        self.stop_socket = True
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass  # Already stopped
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(STOP_TIMEOUT)
+        if close_listener:
+            self.close_listener()
@@ -0,0 +1,257 @@
+import collections
+import itertools
+import os
+import threading
+import time
+
+from src.control import BINARY, encode
+from src.protocol import FrameReader, encode_frame
+
+SEND_BUFFER_SIZE = 1024 * 1024  # Bytes queued for a peer before new chat messages are refused
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024  # Buffers one sendmsg() call may gather
+CLOSE_TIMEOUT = 1  # Seconds close() waits for queued data to be written
+
+
+class Connection:  # One direction of the link to a peer. Inbound connections are read, outbound ones are written
+    def __init__(self, sock, framed=False, capabilities=()):
+        self.socket = sock
+        self.framed = framed
+        self.capabilities = list(capabilities)  # Capabilities both peers support
+        self.reader = FrameReader(framed)
+        self.received = []  # Messages read before the connection was handed to its reader, handled first
+        self.initialized = False  # Set once the \b/init handshake was received
+        self.session = None
+        self.address = None  # IP address of the peer on inbound connections | File channels are matched by it
+        self.transfer = None  # Incoming file transfer if the connection is a file channel
+        self.codec = None  # Compression negotiated in the handshake
+        self.tls = None  # TLS channel if the connection is encrypted
+        self.last_seen = time.monotonic()  # Time the peer last sent something on this connection
+        self.last_ping = 0.0  # Time of the last heartbeat we sent
+        self.rtt = None  # Smoothed round trip time of the heartbeats in seconds
+        self.stream = None  # Stream of sequenced chat messages the peer sends on this connection
+        self.acked = 0  # Last sequence number we acknowledged on this connection
+        self.lock = threading.Lock()
+
+    # True if control messages are exchanged as binary frames instead of "\b/" strings
+    @property
+    def binary(self):
+        return BINARY in self.capabilities
+
+    # Method to send a message tuple like ("ack", 12) in the format both peers support | Returns the bytes written
+    def send_message(self, message):
+        return self.send_data(encode(message, self.binary))
+
+    # Method to send many message tuples with one write | Returns the bytes written
+    def send_messages(self, messages):
+        if not self.framed:  # Unframed peers take every chunk they read as one message
+            return sum(self.send_message(message) for message in messages)
+        binary = self.binary
+        if self.codec is None:
+            data = b"".join(encode_frame(encode(message, binary)) for message in messages)
+            self.write(data)
+            return len(data)
+        with self.lock:
+            data = b"".join(encode_frame(self.codec.encode(encode(message, binary))) for message in messages)
+            self.write(data)
+        return len(data)
+
+    # Method to send a string as it is, e.g. on file channels
+    def send(self, msg):
+        return self.send_data(msg.encode())
+
+    def send_data(self, data):
+        if self.codec is None:
+            data = encode_frame(data) if self.framed else data
+            self.write(data)
+            return len(data)
+        with self.lock:  # The compression stream has to see messages in the order they are written
+            data = encode_frame(self.codec.encode(data))
+            self.write(data)
+        return len(data)
+
+    # Method to write bytes to the peer | Encrypted first if the connection uses TLS
+    def write(self, data):
+        tls = self.tls
+        if tls is None:
+            self.write_raw(data)
+            return
+        with tls.lock:  # Records have to reach the peer in the order they were encrypted
+            self.write_raw(tls.encrypt(data))
+
+    # Method to write bytes to the socket as they are
+    def write_raw(self, data):
+        self.socket.sendall(data)
+
+    # Bytes written but not sent yet | Only queued connections buffer data
+    @property
+    def queued(self):
+        return 0
+
+    # True if the peer reads too slowly and new chat messages have to be refused
+    @property
+    def full(self):
+        return False
+
+    def close(self):
+        if self.transfer is not None:
+            self.transfer.close()
+        self.socket.close()
+
+
+class QueuedConnection(Connection):  # Connection of the threaded transport | Never blocks, the selector thread sends what the socket did not take
+    def __init__(self, sock, framed=False, capabilities=(), limit=SEND_BUFFER_SIZE, on_error=None, on_pending=None):
+        super(QueuedConnection, self).__init__(sock, framed, capabilities)
+        sock.setblocking(False)
+        self.limit = limit
+        self.on_error = on_error  # Called with the connection and the error if waiting data could not be sent
+        self.on_pending = on_pending  # Called once data has to wait | The selector thread flushes it when the socket is writable
+        self.queue = collections.deque()  # Data the socket did not take yet
+        self.queued_bytes = 0
+        self.write_lock = threading.Lock()  # Keeps direct writes and flushes of the selector thread in order
+        self.closed = False
+        self.writes = 0  # Send calls | Lower than the number of messages when writes were coalesced
+
+    # Method to write bytes | Sent right away if nothing waits, otherwise queued and sent with the waiting data
+    def write_raw(self, data):
+        with self.write_lock:
+            if self.closed:
+                raise ConnectionResetError("Connection is closed")
+            waiting = bool(self.queue)
+            self.queue.append(data)
+            self.queued_bytes += len(data)
+            if waiting:  # The client thread already waits for the socket
+                return
+            try:
+                self.send_queue()
+            except OSError:
+                self.fail()
+                raise
+            waiting = bool(self.queue)
+        if waiting and self.on_pending is not None:
+            self.on_pending(self)
+
+    @property
+    def queued(self):
+        return self.queued_bytes
+
+    @property
+    def full(self):
+        return self.queued_bytes >= self.limit
+
+    # Method called by the selector thread once the socket is writable | Returns True while data still waits
+    def flush(self):
+        with self.write_lock:
+            if not self.queue:
+                return False
+            try:
+                self.send_queue()
+                return bool(self.queue)
+            except OSError as error:
+                failure = error if not self.closed else None  # Errors after close() are expected
+                self.fail()
+        if failure is not None and self.on_error is not None:
+            self.on_error(self, failure)
+        return False
+
+    # Method to send as much of the queue as the socket takes | Everything queued goes out in one sendmsg()
+    def send_queue(self):
+        queue = self.queue
+        while queue:
+            buffers = list(itertools.islice(queue, IOV_MAX))
+            try:
+                if hasattr(self.socket, 'sendmsg'):
+                    sent = self.socket.sendmsg(buffers)
+                else:  # Windows has no sendmsg()
+                    sent = self.socket.send(b"".join(buffers))
+            except (BlockingIOError, InterruptedError):
+                return
+            self.writes += 1
+            self.queued_bytes -= sent
+            while sent:  # Drop what was sent, a partial write leaves the rest of one buffer
+                if sent >= len(queue[0]):
+                    sent -= len(queue.popleft())
+                else:
+                    queue[0] = memoryview(queue[0])[sent:]
+                    sent = 0
+            if self.queued_bytes and len(buffers) < IOV_MAX:
+                return  # The socket buffer is full
+
+    def fail(self):
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+
+    # Method to close the connection | Waiting data is still sent for up to CLOSE_TIMEOUT so messages sent right before reach the peer
+    def close(self):
+        with self.write_lock:
+            self.closed = True
+            if self.queue:
+                try:
+                    self.socket.settimeout(CLOSE_TIMEOUT)
+                    self.socket.sendall(b"".join(self.queue))
+                except OSError:
+                    pass
+                self.queue.clear()
+                self.queued_bytes = 0
+        super(QueuedConnection, self).close()
+
+
+class Session:  # Everything known about one peer
+    def __init__(self, nickname="Unknown", ip="unknown", port="unknown"):
+        self.nickname = nickname
+        self.ip = ip
+        self.port = str(port)
+        self.inbound = None  # Connection the peer opened to our server
+        self.outbound = None  # Connection our client opened to the peers server
+
+    @property
+    def address_known(self):
+        return self.ip != "unknown" and self.port != "unknown"
+
+    def __repr__(self):
+        return f"<Session {self.nickname} {self.ip}:{self.port}>"
+
+
+class SessionRegistry:  # Thread safe collection of all sessions of the app
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session):
+        with self.lock:
+            self.sessions.append(session)
+        return session
+
+    def remove(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    # Method to find the session of a peer by the address of its server
+    def get(self, ip, port):
+        for session in self:
+            if session.ip == ip and session.port == str(port):
+                return session
+        return None
+
+    # Method to find a session by nickname | Nicknames are not unique, the first match wins
+    def by_nickname(self, nickname, predicate=None):
+        for session in self:
+            if session.nickname == nickname and (predicate is None or predicate(session)):
+                return session
+        return None
+
+    # Method to get all sessions our client can send to
+    def connected(self):
+        return [session for session in self if session.outbound is not None]
+
+    def clear(self):
+        with self.lock:
+            self.sessions = []
@@ -1,25 +1,43 @@
 import json
 from pathlib import Path
-from typing import Literal, Dict
+from typing import Literal, Dict, Optional
 
 BASE_DIR = Path(__file__).resolve().parent.parent
-LANG = {}  # Inits later
 
 
-def change_settings(key: str, value):
+class Language(dict):  # Strings of the interface language | The file is read on the first lookup instead of on import
+    def __missing__(self, key: str):
+        if self:
+            raise KeyError(key)
+        change_lang(get_setting('language', 'en'))
+        return dict.__getitem__(self, key)
+
+
+LANG = Language()  # Filled on first use | change_lang() updates it in place so every module sees the new language
+__settings: Optional[Dict] = None  # Read from settings.json on first use
+
+
+def load_settings() -> Dict:
     global __settings
-    __settings[key] = value
-    with open('settings.json', 'w') as file:
-        file.write(json.dumps(__settings))
+    if __settings is None:
+        with open(str(BASE_DIR / 'settings.json'), encoding="utf-8") as settings_file:
+            __settings = json.loads(settings_file.read())
+    return __settings
 
 
-def change_lang(language: Literal['en', 'ru', 'de']):
-    global LANG
-    with open(str(BASE_DIR / f'lang/{language}.json'), encoding='utf-8') as lang_file:
-        LANG = json.loads(lang_file.read())
+def change_settings(key: str, value):
+    settings = load_settings()
+    settings[key] = value
+    with open('settings.json', 'w') as file:
+        file.write(json.dumps(settings))
 
 
-with open(str(BASE_DIR / 'settings.json'), encoding="utf-8") as settings_file:
-    __settings = json.loads(settings_file.read())
+def get_setting(key: str, default=None):
+    return load_settings().get(key, default)
 
-change_lang(__settings['language'])
+
+def change_lang(language: Literal['en', 'ru', 'de']):
+    with open(str(BASE_DIR / f'lang/{language}.json'), encoding='utf-8') as lang_file:
+        strings = json.loads(lang_file.read())
+    LANG.clear()
+    LANG.update(strings)
@@ -0,0 +1,23 @@
+import time
+
+
+class StartupProfile:  # Durations of the startup phases | Shown as system messages with run.py --profile-startup
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.phases = []  # (name, seconds) in the order the phases ended
+
+    # Method to end the phase that began at the previous mark
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    # Seconds from the start of run.py until the last mark
+    @property
+    def total(self):
+        return self.last - self.start
+
+
+PROFILE = StartupProfile()  # Started when run.py imports this module, before anything else is imported
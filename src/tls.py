@@ -0,0 +1,229 @@
+import collections
+import hashlib
+import os
+import shutil
+import ssl
+import threading
+from pathlib import Path
+
+from src.protocol import RECV_SIZE
+
+HANDSHAKE = b"\x16"  # First byte of a TLS handshake record | Plain peers start with \b/init or \b/file
+CERTIFICATE = "cert.pem"
+KEY = "key.pem"
+CERTIFICATE_DAYS = 3650  # Self-signed, peers pin the fingerprint instead of checking the expiry
+SESSION_CACHE_SIZE = 256  # Peers whose last session is kept for resumption
+
+
+# Method to get the SHA-256 fingerprint of a certificate in DER form as it is shown to users
+def fingerprint(certificate):
+    return hashlib.sha256(certificate).hexdigest()
+
+
+# Method to create a key and a self-signed certificate with the openssl command line tool | The ssl module can not
+def create_certificate(directory):
+    openssl = shutil.which("openssl")
+    if openssl is None:
+        raise FileNotFoundError("openssl was not found")
+    import subprocess  # Only needed on the first start
+
+    directory.mkdir(parents=True, exist_ok=True)
+    try:
+        subprocess.run([openssl, "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+                        "-keyout", str(directory / KEY), "-out", str(directory / CERTIFICATE),
+                        "-days", str(CERTIFICATE_DAYS), "-subj", "/CN=p2p-chat"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as error:
+        raise OSError(f"openssl failed with exit code {error.returncode}") from error
+    os.chmod(directory / KEY, 0o600)
+
+
+class TLS:  # Certificate, contexts and resumable sessions of the app | Kept by the engine so restarts can resume sessions
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        certificate, key = self.directory / CERTIFICATE, self.directory / KEY
+        if not certificate.exists() or not key.exists():
+            create_certificate(self.directory)
+
+        # Session tickets are encrypted with keys of the server context, so it has to outlive the server
+        self.server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.server_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.server_context.load_cert_chain(certificate, key)
+
+        # Peer certificates are self-signed | The fingerprint is pinned per peer instead of verifying a chain
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.client_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+
+        with open(certificate, encoding="ascii") as file:
+            self.fingerprint = fingerprint(ssl.PEM_cert_to_DER_cert(file.read()))
+        self.channels = collections.OrderedDict()  # "ip:port" -> channel of the last connection to the peer
+        self.lock = threading.Lock()
+
+    # Method to start a TLS client | Resumes the session of the last connection to the same address
+    def client(self, address):
+        with self.lock:
+            previous = self.channels.pop(address, None)
+            session = previous.object.session if previous is not None else None  # Tickets arrive after the handshake
+            channel = TLSChannel(self.client_context, False, session)
+            self.channels[address] = channel
+            if len(self.channels) > SESSION_CACHE_SIZE:
+                self.channels.popitem(last=False)
+        return channel
+
+    def server(self):
+        return TLSChannel(self.server_context, True)
+
+
+class TLSChannel:  # TLS over memory buffers | The transports move the encrypted bytes, so threads and asyncio share it
+    def __init__(self, context, server_side, session=None):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.object = context.wrap_bio(self.incoming, self.outgoing, server_side=server_side, session=session)
+        self.established = False
+        self.lock = threading.Lock()  # One record at a time, the order of the records is the order of the bytes
+
+    # Method to continue the handshake with received bytes | Returns the bytes to send to the peer
+    def handshake(self, data=b""):
+        if data:
+            self.incoming.write(data)
+        try:
+            self.object.do_handshake()
+            self.established = True
+        except ssl.SSLWantReadError:
+            pass
+        return self.outgoing.read()
+
+    def encrypt(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self.object.write(view):]
+        return self.outgoing.read()
+
+    # Method to decrypt received bytes | Returns what is complete, the rest of a record waits for the next bytes
+    def decrypt(self, data):
+        self.incoming.write(data)
+        chunks = []
+        while True:
+            try:
+                chunk = self.object.read(RECV_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLZeroReturnError):
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    # True if the handshake resumed an earlier session instead of a full key exchange
+    @property
+    def resumed(self):
+        return self.object.session_reused
+
+    @property
+    def peer_fingerprint(self):
+        certificate = self.object.getpeercert(binary_form=True)
+        return fingerprint(certificate) if certificate else None
+
+
+class TLSReader:  # Decrypts received bytes before the frame reader sees them | Finishes the handshake of inbound connections
+    def __init__(self, connection, channel, reader):
+        self.connection = connection
+        self.channel = channel
+        self.reader = reader  # Frame reader or file transfer the plain bytes are handed to
+
+    @property
+    def framed(self):
+        return self.reader.framed
+
+    @framed.setter
+    def framed(self, framed):
+        self.reader.framed = framed
+
+    # Method to read once from a socket | Returns None if the peer closed the connection
+    def recv(self, sock):
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        return self.feed(data)
+
+    def feed(self, data):
+        channel = self.channel
+        with channel.lock:
+            if not channel.established:
+                output = channel.handshake(bytes(data))
+                if output:
+                    self.connection.write_raw(output)
+                if not channel.established:
+                    return []
+                data = b""
+            plain = channel.decrypt(data)
+            output = channel.outgoing.read()  # E.g. the answer to a key update of the peer
+            if output:
+                self.connection.write_raw(output)
+        return self.reader.feed(plain) if plain else []
+
+
+class TLSDetector:  # First reader of an inbound connection | Switches to TLS if the peer starts with a handshake record
+    # tls is None if TLS is disabled | A handshake record ends the connection then
+    def __init__(self, connection, tls):
+        self.connection = connection
+        self.tls = tls
+        self.reader = connection.reader
+
+    def recv(self, sock):
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        return self.feed(data)
+
+    def feed(self, data):
+        connection = self.connection
+        if data[:1] == HANDSHAKE and self.tls is None:
+            raise ValueError("TLS handshake of a peer, but TLS is disabled")
+        if data[:1] == HANDSHAKE:
+            connection.tls = self.tls.server()
+            connection.reader = TLSReader(connection, connection.tls, self.reader)
+        else:  # Plain peer
+            connection.reader = self.reader
+        return connection.reader.feed(data)
+
+
+class TLSSocket:  # Blocking socket that encrypts with a TLS channel | Used while connecting and for file channels
+    def __init__(self, sock, channel):
+        self.socket = sock
+        self.channel = channel
+
+    def handshake(self):
+        output = self.channel.handshake()
+        while True:
+            if output:
+                self.socket.sendall(output)
+            if self.channel.established:
+                return
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed during the TLS handshake")
+            output = self.channel.handshake(data)
+
+    def sendall(self, data):
+        self.socket.sendall(self.channel.encrypt(data))
+
+    # Method to receive the next plain bytes | May return more than size bytes, callers treat them as a stream
+    def recv(self, _size):
+        while True:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                return b""
+            plain = self.channel.decrypt(data)
+            if plain:
+                return plain
+
+    # Method to send a part of a file | Encrypted data can not be copied by the kernel
+    def sendfile(self, file, offset, count):
+        file.seek(offset)
+        self.sendall(file.read(count))
+
+    # settimeout(), shutdown(), close() and the rest act on the socket
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
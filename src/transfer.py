@@ -0,0 +1,444 @@
+import collections
+import hashlib
+import os
+import shutil
+import socket
+import struct
+import threading
+import time
+
+from src.protocol import FrameReader
+from src.settings import LANG
+from src.tls import TLSSocket
+
+CHUNK_SIZE = 1024 * 1024  # Every chunk is hashed and acknowledged on its own
+WINDOW = 8  # Chunks the sender may send ahead of the last acknowledgement
+CHUNK_HEADER = struct.Struct("!QI32s")  # Offset, length and sha256 digest in front of every chunk
+FILE_INIT = b"\b/file "  # First bytes of a file channel, followed by the size, the chunk size and four text fields
+FILE_HEADER = struct.Struct("!QI")  # Size of the file and of its chunks
+FIELD_LENGTH = struct.Struct("!H")  # Length in front of every text field | Nicknames and file names may contain spaces
+MAX_FILE_SIZE = 4 * 1024 ** 3  # Largest file accepted unless max_file_size in settings.json says otherwise
+FREE_SPACE_RESERVE = 64 * 1024 * 1024  # Bytes left free on the disk of the download directory
+RECV_SIZE = 1024 * 1024  # Size of the receive buffer of a file channel
+ACK_TIMEOUT = 30  # Seconds the sender waits for an answer of the receiver
+RETRIES = 5  # Reconnects of the sender before a transfer is given up
+PROGRESS_STEP = 10  # Percent between two progress messages
+
+
+# Method to format a number of bytes for the user
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+# Method to build the first message of a file channel | Sent instead of \b/init
+def build_file_init(transfer_id, size, digest, chunk_size, nickname, name):
+    parts = [FILE_INIT, FILE_HEADER.pack(size, chunk_size)]
+    for field in (transfer_id, digest, nickname, name):
+        data = field.encode()
+        parts.append(FIELD_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+# Method to parse the first message of a file channel | Returns the transfer ID, size, digest, chunk size, nickname and name
+def parse_file_init(init):
+    view = memoryview(init)
+    offset = len(FILE_INIT) + FILE_HEADER.size
+    if len(view) < offset:
+        raise ValueError(LANG['peerInvalidSyntax'])
+    size, chunk_size = FILE_HEADER.unpack(view[len(FILE_INIT):offset])
+    fields = []
+    for _ in range(4):
+        if len(view) < offset + FIELD_LENGTH.size:
+            raise ValueError(LANG['peerInvalidSyntax'])
+        length, = FIELD_LENGTH.unpack(view[offset:offset + FIELD_LENGTH.size])
+        offset += FIELD_LENGTH.size
+        if len(view) < offset + length:
+            raise ValueError(LANG['peerInvalidSyntax'])
+        fields.append(str(view[offset:offset + length], 'utf-8', 'replace'))
+        offset += length
+    if offset != len(view):
+        raise ValueError(LANG['peerInvalidSyntax'])
+    transfer_id, digest, nickname, name = fields
+    return transfer_id, size, digest, chunk_size, nickname, name
+
+
+# Method to parse a control message of a file channel | Returns the command and its number argument
+def parse_file_reply(reply):
+    reply = reply.decode(errors='replace').split(' ')
+    command = reply[0][2:]
+    try:
+        value = int(reply[1]) if len(reply) > 1 else None
+    except ValueError:
+        value = None
+    return command, value
+
+
+class TransferRefused(ValueError):  # A file the peer is not allowed to send or that does not fit | The message is for the user
+    pass
+
+
+class Progress:  # Prints the progress of a transfer to the chat feed every PROGRESS_STEP percent
+    def __init__(self, chat_app, name, size, done=0):
+        self.chat_app = chat_app
+        self.name = name
+        self.size = size
+        self.start = time.perf_counter()
+        self.start_done = done  # Bytes done before this connection, excluded from the speed
+        self.next_step = (done * 100 // max(size, 1)) // PROGRESS_STEP * PROGRESS_STEP + PROGRESS_STEP
+
+    def update(self, done):
+        percent = done * 100 // max(self.size, 1)
+        if percent < self.next_step or percent >= 100:
+            return
+        self.next_step = percent // PROGRESS_STEP * PROGRESS_STEP + PROGRESS_STEP
+        speed = (done - self.start_done) / max(time.perf_counter() - self.start, 1e-6)
+        self.chat_app.system_message(LANG['fileProgress'].format(self.name, percent, format_size(speed)))
+
+
+class FileSource:  # A file offered to peers | Hashed once, no matter how many peers it is sent to
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.digest = None  # sha256 of the whole file
+        self.chunks = []  # sha256 of every chunk
+        self.lock = threading.Lock()
+
+    # ID of the transfer | Derived from the content so a later /send of the same file resumes
+    @property
+    def transfer_id(self):
+        return self.digest[:16]
+
+    # Method to hash the file and all chunks in one pass | The data itself is later sent without being read again
+    def prepare(self):
+        with self.lock:
+            if self.digest is not None:
+                return
+            digest = hashlib.sha256()
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            with open(self.path, 'rb') as file:
+                while True:
+                    size = file.readinto(buffer)
+                    if not size:
+                        break
+                    digest.update(view[:size])
+                    self.chunks.append(hashlib.sha256(view[:size]).digest())
+            self.digest = digest.hexdigest()
+
+
+class FileSender(threading.Thread):  # Streams a file to one peer on its own connection so chat messages keep flowing
+    def __init__(self, chat_app, source, host, port, nickname):
+        super(FileSender, self).__init__(daemon=True)
+        self.chat_app = chat_app
+        self.source = source
+        self.host = host
+        self.port = port
+        self.nickname = nickname  # Nickname of the receiving peer
+        self.socket = None
+        self.stopped = threading.Event()
+        self.replies = collections.deque()  # Control messages received but not handled yet
+
+    # Start method called by threading module | Reconnects and resumes after a lost connection
+    def run(self):
+        try:
+            self.source.prepare()
+        except OSError as error:
+            self.chat_app.system_message(LANG['fileFailed'].format(self.source.name, self.nickname))
+            self.chat_app.system_message(error)
+            return
+
+        for attempt in range(RETRIES + 1):
+            try:
+                done = self.transfer()
+            except (OSError, ValueError) as error:
+                done = None
+                if self.stopped.is_set():
+                    return
+                self.chat_app.system_message(error)
+
+            if done is not None:
+                message = LANG['fileSent'] if done else LANG['fileFailed']
+                self.chat_app.system_message(message.format(self.source.name, self.nickname))
+                return
+
+            if attempt == RETRIES:
+                break
+            delay = min(2 ** attempt, 30)
+            self.chat_app.system_message(LANG['fileConnectionLost'].format(self.source.name, delay))
+            if self.stopped.wait(delay):
+                return
+
+        self.chat_app.system_message(LANG['fileFailed'].format(self.source.name, self.nickname))
+
+    # Method to send the file over a new connection | Returns True once the peer verified the whole file
+    def transfer(self):
+        source = self.source
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self.socket = sock
+        if self.chat_app.uses_tls(self.host, self.port):  # Encrypted chunks can't be copied by the kernel, sendfile() reads them instead
+            channel = self.chat_app.tls.client(f"{self.host}:{self.port}")
+            sock = self.socket = TLSSocket(sock, channel)
+            try:
+                sock.handshake()
+            except OSError:
+                sock.close()
+                if not self.chat_app.tls_failed(self.host, self.port):
+                    raise
+                sock = self.socket = socket.create_connection((self.host, self.port), timeout=5)
+                channel = None
+            if channel is not None and not self.chat_app.client.verify_peer(self.host, self.port, channel):
+                sock.close()
+                return False
+        self.replies.clear()
+        reader = FrameReader(True)
+        try:
+            sock.settimeout(ACK_TIMEOUT)
+            sock.sendall(build_file_init(source.transfer_id, source.size, source.digest,
+                                         source.chunk_size, self.chat_app.nickname, source.name))
+            command, offset = self.receive(reader)
+            if command != "file-ack" or offset is None:
+                return False
+
+            if offset:
+                self.chat_app.system_message(LANG['fileResuming'].format(source.name, offset * 100 // max(source.size, 1)))
+            else:
+                self.chat_app.system_message(LANG['fileSending'].format(source.name, format_size(source.size), self.nickname))
+            progress = Progress(self.chat_app, source.name, source.size, offset)
+
+            acknowledged = sent = offset
+            corrupt = None  # Offset of the last corrupt chunk | Corrupt twice means the file changed after hashing
+            with open(source.path, 'rb') as file:
+                while acknowledged < source.size:
+                    # Keep up to WINDOW chunks in flight so the link never waits for an acknowledgement
+                    while sent < source.size and sent - acknowledged < WINDOW * source.chunk_size:
+                        length = min(source.chunk_size, source.size - sent)
+                        sock.sendall(CHUNK_HEADER.pack(sent, length, source.chunks[sent // source.chunk_size]))
+                        sock.sendfile(file, sent, length)  # Copied by the kernel, the data never enters python
+                        sent += length
+
+                    command, offset = self.receive(reader)
+                    if command == "file-ack" and offset is not None:
+                        acknowledged = offset
+                        progress.update(acknowledged)
+                    elif command == "file-nack" and offset is not None and offset != corrupt:
+                        self.chat_app.system_message(LANG['fileChunkCorrupt'].format(source.name, offset))
+                        acknowledged = sent = corrupt = offset  # Send everything from the corrupt chunk again
+                    else:
+                        return False
+
+            while True:  # Acknowledgements of the last chunks may still be queued
+                command, _offset = self.receive(reader)
+                if command != "file-ack":
+                    return command == "file-done"
+        finally:
+            self.socket = None
+            sock.close()
+
+    # Method to wait for the next control message of the receiver
+    def receive(self, reader):
+        while not self.replies:
+            data = self.socket.recv(1024)
+            if not data:
+                raise ConnectionResetError(LANG['peerConnectionLost'].format(self.nickname))
+            self.replies.extend(reader.feed(data))
+        return parse_file_reply(self.replies.popleft())
+
+    # Method to cancel the transfer | A later /send of the same file resumes where it stopped
+    def stop(self):
+        self.stopped.set()
+        sock = self.socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class IncomingTransfer(threading.Thread):  # Receiving end of a file channel | Replaces the frame reader of the connection
+    # The server thread only hands the received bytes over | Writing and hashing run on this thread so chat keeps flowing
+    def __init__(self, chat_app, connection, init, max_size=MAX_FILE_SIZE):
+        super(IncomingTransfer, self).__init__(daemon=True)
+        self.chat_app = chat_app
+        self.connection = connection
+        self.chunk = bytearray(RECV_SIZE)  # Reusable receive buffer
+        self.view = memoryview(self.chunk)
+        self.received = collections.deque()  # Bytes the server thread handed over and this thread did not write yet
+        self.received_bytes = 0
+        self.condition = threading.Condition()
+        self.closed = False  # Set by close(), the thread writes what is left and stops
+        self.error = None  # Error of this thread | Raised on the server thread with the next received bytes
+        self.header = bytearray()  # Bytes of an incomplete chunk header
+        self.remaining = 0  # Bytes of the current chunk not received yet
+        self.discard = False  # Set while chunks sent after a corrupt one arrive
+        self.expected = None  # Digest of the current chunk
+        self.file = None
+
+        self.transfer_id, self.size, self.digest, self.chunk_size, _nickname, name = init  # From parse_file_init()
+        self.name = os.path.basename(name)
+        if self.name in ("", ".", "..") or not self.transfer_id.isalnum() or self.chunk_size <= 0:
+            raise ValueError(LANG['peerInvalidSyntax'])
+        self.nickname = connection.session.nickname
+        if self.size > max_size:
+            raise TransferRefused(LANG['fileTooLarge'].format(self.name, format_size(self.size), self.nickname,
+                                                              format_size(max_size)))
+        # The sender waits for acknowledgements after WINDOW chunks, a peer that sends more is dropped
+        self.max_received = (WINDOW + 1) * self.chunk_size + RECV_SIZE
+
+        # Chunks verified before the last connection dropped are kept in a .part file
+        directory = chat_app.download_dir
+        directory.mkdir(parents=True, exist_ok=True)
+        self.part_path = directory / f"{self.transfer_id}.part"
+        received = self.part_path.stat().st_size if self.part_path.exists() else 0
+        if shutil.disk_usage(directory).free < max(self.size - received, 0) + FREE_SPACE_RESERVE:
+            raise TransferRefused(LANG['fileNoSpace'].format(self.name, format_size(self.size), self.nickname))
+        self.file = open(self.part_path, 'r+b' if self.part_path.exists() else 'w+b')
+        self.file.seek(0, os.SEEK_END)
+        self.verified = min(self.file.tell() // self.chunk_size * self.chunk_size, self.size)
+
+        self.file_hash = None  # Hash of the verified part | The .part file of a resumed transfer is hashed by run()
+        self.chunk_hash = None
+        self.pending_hash = None  # Whole-file hash including the current chunk, kept once the chunk is verified
+
+        if self.verified:
+            chat_app.system_message(LANG['fileResuming'].format(self.name, self.verified * 100 // max(self.size, 1)))
+        else:
+            chat_app.system_message(LANG['fileReceiving'].format(self.name, format_size(self.size), self.nickname))
+        self.progress = Progress(chat_app, self.name, self.size, self.verified)
+
+        connection.send(f"\b/file-ack {self.verified}")  # The sender starts right away, its chunks wait for run()
+
+    # Method to read once from the socket | Returns None if the peer closed the connection
+    def recv(self, sock):
+        size = sock.recv_into(self.chunk)
+        if not size:
+            return None
+        return self.feed(self.view[:size])
+
+    # Method called by the server thread with received bytes | Returns no messages as the channel carries file data only
+    def feed(self, data):
+        if self.error is not None:
+            raise self.error
+        with self.condition:
+            if self.received_bytes + len(data) > self.max_received:
+                raise ValueError(LANG['peerInvalidSyntax'])
+            self.received.append(bytes(data))  # The receive buffer is reused for the next read
+            self.received_bytes += len(data)
+            self.condition.notify()
+        return []
+
+    def run(self):
+        try:
+            self.file.truncate(self.verified)
+            self.file_hash = hashlib.sha256()
+            self.file.seek(0)
+            while self.file.tell() < self.verified:
+                self.file_hash.update(self.file.read(min(RECV_SIZE, self.verified - self.file.tell())))
+            if self.verified == self.size:
+                self.finish()
+                return
+
+            while True:
+                with self.condition:
+                    while not self.received and not self.closed:
+                        self.condition.wait()
+                    if not self.received:
+                        break
+                    data = self.received.popleft()
+                    self.received_bytes -= len(data)
+                self.write(data)
+                if self.file.closed:  # Finished
+                    return
+        except (OSError, ValueError) as error:
+            self.error = error
+            self.chat_app.system_message(LANG['fileFailedReceiving'].format(self.name, error))
+            try:
+                self.connection.send("\b/file-failed")
+            except OSError:
+                pass
+        finally:
+            if not self.file.closed:  # Verified chunks stay in the .part file
+                try:
+                    self.file.truncate(self.verified)
+                finally:
+                    self.file.close()
+
+    # Method to write received bytes to the .part file and check every chunk they complete
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            if not self.remaining:
+                needed = CHUNK_HEADER.size - len(self.header)
+                self.header += data[:needed]
+                data = data[needed:]
+                if len(self.header) == CHUNK_HEADER.size:
+                    self.start_chunk(*CHUNK_HEADER.unpack(self.header))
+                    self.header.clear()
+                continue
+
+            part = data[:self.remaining]
+            data = data[self.remaining:]
+            self.remaining -= len(part)
+            if not self.discard:
+                self.file.write(part)
+                self.chunk_hash.update(part)
+                self.pending_hash.update(part)
+            if not self.remaining and not self.discard:
+                self.end_chunk()
+
+    def start_chunk(self, offset, length, digest):
+        if length > self.chunk_size or offset + length > self.size:
+            raise ValueError(LANG['peerInvalidSyntax'])
+        self.remaining = length
+        self.discard = offset != self.verified  # Sent before the sender learned about a corrupt chunk
+        self.expected = digest
+        self.chunk_hash = hashlib.sha256()
+        self.pending_hash = self.file_hash.copy()
+        if not length and not self.discard:
+            self.end_chunk()
+
+    def end_chunk(self):
+        if self.chunk_hash.digest() != self.expected:
+            self.file.seek(self.verified)
+            self.file.truncate()
+            self.chat_app.system_message(LANG['fileChunkCorrupt'].format(self.name, self.verified))
+            self.connection.send(f"\b/file-nack {self.verified}")
+            return
+
+        self.verified = self.file.tell()
+        self.file_hash = self.pending_hash
+        self.connection.send(f"\b/file-ack {self.verified}")
+        self.progress.update(self.verified)
+        if self.verified == self.size:
+            self.finish()
+
+    # Method to check the whole file and move it out of the .part file
+    def finish(self):
+        self.file.close()
+        if self.file_hash.hexdigest() != self.digest:
+            self.part_path.unlink()
+            self.chat_app.system_message(LANG['fileCorrupt'].format(self.name))
+            self.connection.send("\b/file-failed")
+            return
+
+        path = self.part_path.with_name(self.name)
+        number = 1
+        while path.exists():  # Never overwrite a file that is already there
+            path = self.part_path.with_name(f"{os.path.splitext(self.name)[0]} ({number}){os.path.splitext(self.name)[1]}")
+            number += 1
+        self.part_path.rename(path)
+        self.chat_app.system_message(LANG['fileReceived'].format(self.name, path))
+        self.connection.send("\b/file-done")
+
+    # Method called when the connection is closed | The thread writes what was received, verified chunks stay in the .part file
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if not self.is_alive() and self.file is not None and not self.file.closed:  # Refused before it was started
+            self.file.close()